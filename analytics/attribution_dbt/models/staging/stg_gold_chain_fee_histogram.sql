@@ -0,0 +1,3 @@
+﻿{{ config(enabled=false) }}
+
+select * from read_parquet('s3://dp-gold/chain_fee_histogram/date=*/*.parquet')
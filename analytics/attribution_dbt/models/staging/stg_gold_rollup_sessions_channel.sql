@@ -0,0 +1,4 @@
+﻿{{ config(enabled=false) }}
+
+-- una sesión cuenta en cada canal que tocó: no sumar entre canales (totales en stg_gold_rollup_sessions)
+select * from read_parquet('s3://dp-gold/rollups/web2_sessions_channel_daily/*.parquet')
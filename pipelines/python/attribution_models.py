@@ -0,0 +1,175 @@
+﻿from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+try:
+    import scipy.sparse as sp
+    import scipy.sparse.linalg as spla
+except ImportError:  # opcional: sin scipy la cadena de Markov se resuelve con matrices densas de numpy
+    sp = spla = None
+
+import metrics
+
+# Registro de modelos de atribución. build_attribution (gold_attribution.py) arma una sola vez los
+# caminos de todas las conversiones (Paths) y cada modelo devuelve arrays (conv, tp, crédito):
+# conv indexa las conversiones, tp los touchpoints (canal/campaña/ts salen de ahí). Las conversiones
+# sin touchpoints en ventana no llegan a los modelos: build_attribution las manda a direct/none.
+# ATTR_MODELS (coma) elige qué modelos corre gold; uno nuevo es una función con @register("nombre").
+#
+# Dentro de un modelo, el orden de emisión de las filas de una misma (conv, canal, campaña) es el
+# orden de suma del crédito: cambiarlo cambia el último bit de los float.
+
+class Paths:
+    # CSR de touchpoints por conversión: la conversión i usa los touchpoints lo[i] .. lo[i]+n[i]-1
+    # (ordenados por usuario, ts). Los arrays "expandidos" tienen una fila por (conversión, touchpoint).
+    def __init__(self, lo: np.ndarray, n: np.ndarray, value: np.ndarray, conv_t: np.ndarray,
+                 tp_t: np.ndarray, tp_ch: np.ndarray, n_ch: int, tp_user: np.ndarray, halflife_d: float):
+        self.lo, self.n, self.value, self.conv_t = lo, n, value, conv_t
+        self.tp_t, self.tp_ch, self.n_ch, self.tp_user = tp_t, tp_ch, n_ch, tp_user
+        self.halflife_d = halflife_d
+        self.has = np.flatnonzero(n > 0)
+        self.lo_h, self.n_h, self.v_h = lo[self.has], n[self.has], value[self.has]
+        # expandido: owner = índice en has, pos = touchpoint, within = posición en el camino
+        self.owner = np.repeat(np.arange(len(self.n_h)), self.n_h)
+        offs = np.cumsum(self.n_h) - self.n_h
+        self.within = np.arange(int(self.n_h.sum())) - offs[self.owner]
+        self.pos = self.lo_h[self.owner] + self.within
+
+Model = Callable[[Paths], Tuple[np.ndarray, np.ndarray, np.ndarray]]
+MODELS: Dict[str, Model] = {}
+
+def register(name: str):
+    def deco(fn: Model) -> Model:
+        MODELS[name] = fn
+        return fn
+    return deco
+
+def resolve(names: List[str]) -> List[str]:
+    unknown = [m for m in names if m not in MODELS]
+    if unknown:
+        raise ValueError(f"ATTR_MODELS: modelos desconocidos {unknown} (disponibles: {sorted(MODELS)})")
+    return names
+
+# modelos con parámetros estimados sobre todos los caminos de la corrida: en un modo que solo ve una
+# parte (lote, ventana, bucket) darían otro crédito para la misma fecha, así que esos modos los rechazan
+GLOBAL_MODELS = {"markov"}
+
+def require_full(names: List[str], mode: str):
+    bad = sorted(set(names) & GLOBAL_MODELS)
+    if bad:
+        raise ValueError(f"ATTR_MODELS: {bad} se estima con todos los caminos y {mode} solo ve una parte; "
+                         "correrlo en la corrida completa sin --buckets")
+
+# ---------- heurísticos ----------
+@register("last_touch")
+def last_touch(p: Paths):
+    return p.has, p.lo_h + p.n_h - 1, p.v_h
+
+@register("linear")
+def linear(p: Paths):
+    # si el valor es 0 reparte 1/n: se mantiene el comportamiento histórico
+    per = np.where(p.v_h != 0, p.v_h / p.n_h, 1.0 / p.n_h)
+    return p.has[p.owner], p.pos, per[p.owner]
+
+@register("u_shaped")
+def u_shaped(p: Paths):
+    # 40% first, 40% last, 20% resto; orden first, last, medio como antes
+    lo, nn, within = p.lo_h[p.owner], p.n_h[p.owner], p.within
+    u_pos = np.where(within == 0, lo, np.where(within == 1, lo + nn - 1, lo + within - 1))
+    vv = p.v_h[p.owner]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cr = np.where(nn == 1, vv, np.where(within <= 1, vv * 0.4, (vv * 0.2) / (nn - 2)))
+    return p.has[p.owner], u_pos, cr
+
+@register("time_decay")
+def time_decay(p: Paths):
+    # w = 0.5^(delta_días / half-life), normalizado por conversión
+    delta_days = np.maximum((p.conv_t[p.has][p.owner] - p.tp_t[p.pos]) / 1e9 / 86400.0, 0.0)
+    w = np.power(0.5, delta_days / p.halflife_d)
+    denom = np.add.reduceat(w, np.cumsum(p.n_h) - p.n_h) if len(w) else np.zeros(0)
+    denom[denom == 0] = 1.0
+    return p.has[p.owner], p.pos, p.v_h[p.owner] * (w / denom[p.owner])
+
+# ---------- Markov (removal effect) ----------
+# Cadena de primer orden sobre estados START, un estado por canal, CONV y NULL. Caminos que convierten:
+# touchpoints en ventana de cada conversión -> CONV; caminos que no: por usuario, los touchpoints que
+# no caen en ninguna ventana -> NULL. Las transiciones se cuentan vectorizadas (una matriz dispersa
+# de conteos sobre todos los caminos) y la probabilidad de conversión desde START es la de absorción
+# en CONV: (I - Q) x = r. Quitar el canal c = x_c := 0; removal effect RE_c = 1 - P(-c) / P.
+# Cada conversión reparte su valor entre los canales de su camino en proporción a RE_c, y el crédito
+# de un canal se divide en partes iguales entre sus touchpoints (así conserva la campaña).
+# La matriz se estima con todos los caminos de la corrida: solo la corrida completa en memoria ve el
+# historial entero; --incremental, --date, --buckets y el daemon rechazan el modelo (require_full).
+def _transitions(p: Paths) -> np.ndarray:
+    K = p.n_ch
+    S, CONV, NULL = K + 3, K + 1, K + 2
+    st = 1 + p.tp_ch  # estado de cada touchpoint
+
+    # caminos con conversión (expandidos)
+    s = st[p.pos]
+    last = p.within == p.n_h[p.owner] - 1
+    src = [np.zeros(len(p.has), dtype="int64"), s[~last], s[last]]
+    dst = [st[p.lo_h], s[1:][~last[:-1]] if len(s) else s, np.full(int(last.sum()), CONV)]
+
+    # caminos sin conversión: touchpoints fuera de toda ventana, agrupados por usuario
+    cov = np.zeros(len(st) + 1, dtype="int64")
+    np.add.at(cov, p.lo_h, 1); np.add.at(cov, p.lo_h + p.n_h, -1)
+    free = np.flatnonzero(np.cumsum(cov)[:-1] == 0)
+    if len(free):
+        u = p.tp_user[free]
+        first = np.r_[True, u[1:] != u[:-1]]
+        endp = np.r_[u[1:] != u[:-1], True]
+        fs = st[free]
+        src += [np.zeros(int(first.sum()), dtype="int64"), fs[~endp], fs[endp]]
+        dst += [fs[first], fs[1:][~endp[:-1]], np.full(int(endp.sum()), NULL)]
+
+    src, dst = np.concatenate(src), np.concatenate(dst)
+    counts = np.bincount(src * S + dst, minlength=S * S).reshape(S, S).astype("float64") \
+        if sp is None else sp.coo_matrix((np.ones(len(src)), (src, dst)), shape=(S, S)).tocsr()
+    metrics.count("markov", paths=len(p.has) + (int(first.sum()) if len(free) else 0), transitions=len(src))
+    return counts
+
+def _conv_prob(Q, r: np.ndarray, removed: int = -1) -> float:
+    # absorción en CONV desde START (estado 0) con el estado `removed` anulado (x_removed = 0)
+    T = Q.shape[0]
+    if sp is not None:
+        A = (sp.identity(T, format="csr") - Q).tolil()
+        rr = r.copy()
+        if removed >= 0:
+            A[removed, :] = 0; A[removed, removed] = 1; rr[removed] = 0
+        return float(spla.spsolve(A.tocsc(), rr)[0])
+    A = np.eye(T) - Q
+    rr = r.copy()
+    if removed >= 0:
+        A[removed, :] = 0; A[removed, removed] = 1; rr[removed] = 0
+    return float(np.linalg.solve(A, rr)[0])
+
+def removal_effects(p: Paths) -> np.ndarray:
+    K = p.n_ch
+    counts = _transitions(p)
+    T = K + 1  # transitorios: START + canales
+    out = np.asarray(counts.sum(axis=1)).ravel()[:T]
+    out[out == 0] = 1.0
+    if sp is not None:
+        P = sp.diags(1.0 / out) @ counts[:T]
+        Q, r = P[:, :T], np.asarray(P[:, K + 1].todense()).ravel()
+    else:
+        P = counts[:T] / out[:, None]
+        Q, r = P[:, :T], P[:, K + 1]
+    base = _conv_prob(Q, r)
+    if base <= 0:
+        return np.zeros(K)
+    return np.array([max(0.0, 1.0 - _conv_prob(Q, r, 1 + c) / base) for c in range(K)])
+
+@register("markov")
+def markov(p: Paths):
+    re = removal_effects(p)
+    ch = p.tp_ch[p.pos]
+    # canales distintos por conversión y cuántos touchpoints de cada uno
+    pair, inv, cnt = np.unique(p.owner * p.n_ch + ch, return_inverse=True, return_counts=True)
+    inv = inv.ravel()
+    re_sum = np.bincount(pair // p.n_ch, weights=re[pair % p.n_ch], minlength=len(p.has))
+    vv = p.v_h[p.owner]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cr = np.where(re_sum[p.owner] > 0, vv * re[ch] / re_sum[p.owner] / cnt[inv], vv / p.n_h[p.owner])
+    return p.has[p.owner], p.pos, cr
@@ -0,0 +1,163 @@
+﻿import os, sys, json, time
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional
+
+from dotenv import load_dotenv
+
+import s3fetch
+import catalog
+import metrics
+
+# --- Carga .env.dev / .env ---
+for p in ["./.env.dev", "./.env"]:
+    if os.path.exists(p):
+        load_dotenv(p); break
+
+S3_ENDPOINT   = os.getenv("S3_ENDPOINT", "http://localhost:9000")
+S3_REGION     = os.getenv("S3_REGION", "us-east-1")
+AWS_ACCESS    = os.getenv("MINIO_ROOT_USER", "admin")
+AWS_SECRET    = os.getenv("MINIO_ROOT_PASSWORD", "adminadmin")
+BUCKET_BRONZE = os.getenv("S3_BUCKET_BRONZE", "dp-bronze")
+BUCKET_SILVER = os.getenv("S3_BUCKET_SILVER", "dp-silver")
+
+# Backfill por rango de fechas: bronze -> silver por fecha en un pool de procesos (una fecha por
+# worker, en orden dentro de la fecha) y gold una sola vez al final, cuando todo silver terminó.
+# Cada etapa OK deja un marker _backfill/<stage>/date=D.json en su bucket; sin --force se retoma
+# salteando lo ya marcado.
+STAGES = {"bronze": BUCKET_BRONZE, "silver": BUCKET_SILVER}
+MARKER_PREFIX = "_backfill"
+
+def date_range(start: str, end: str) -> List[str]:
+    d0 = datetime.strptime(start, "%Y-%m-%d"); d1 = datetime.strptime(end, "%Y-%m-%d")
+    return [(d0 + timedelta(days=i)).strftime("%Y-%m-%d") for i in range((d1 - d0).days + 1)]
+
+def marker_key(stage: str, date_str: str) -> str:
+    return f"{MARKER_PREFIX}/{stage}/date={date_str}.json"
+
+def has_marker(s3, stage: str, date_str: str) -> bool:
+    try:
+        s3.head_object(Bucket=STAGES[stage], Key=marker_key(stage, date_str))
+        return True
+    except Exception:
+        return False
+
+def write_marker(s3, stage: str, date_str: str, info: Dict[str, Any]):
+    s3fetch.put_bytes(s3, STAGES[stage], marker_key(stage, date_str), json.dumps(info).encode("utf-8"), "application/json")
+
+def run_date(date_str: str, stages: List[str], force: bool) -> Dict[str, Any]:
+    # corre en el worker: los módulos (y sus clientes S3) se importan una vez por proceso
+    import bronze_normalize, silver_build
+    silver_build.FORCE = force
+    runners = {"bronze": bronze_normalize.run, "silver": lambda d: silver_build.run(d, strict=True)}
+    s3 = bronze_normalize.s3
+    out: Dict[str, Any] = {"date": date_str, "ok": True, "stages": {}}
+    for stage in stages:
+        if not force and has_marker(s3, stage, date_str):
+            out["stages"][stage] = {"status": "skip"}
+            continue
+        t0 = time.perf_counter()
+        metrics.start(stage, date_str)
+        try:
+            written = runners[stage](date_str)
+        except Exception as e:
+            # las etapas siguientes de esta fecha dependen de esta: se cortan acá
+            out["ok"] = False
+            out["stages"][stage] = {"status": "error", "error": f"{type(e).__name__}: {e}",
+                                    "seconds": round(time.perf_counter() - t0, 3)}
+            break
+        secs = round(time.perf_counter() - t0, 3)
+        out["stages"][stage] = {"status": "ok", "seconds": secs, "files": len(written),
+                                "report": metrics.finish(print_path=False)}
+        write_marker(s3, stage, date_str, {"date": date_str, "stage": stage, "seconds": secs, "keys": written,
+                                           "finished_at": datetime.now(timezone.utc).isoformat()})
+    return out
+
+def print_report(results: List[Dict[str, Any]], stages: List[str]):
+    print(f"{'date':<12}" + "".join(f"{s:>16}" for s in stages))
+    for r in sorted(results, key=lambda r: r["date"]):
+        cells = []
+        for s in stages:
+            st = r["stages"].get(s, {"status": "-"})
+            cells.append(f"{st['seconds']:>15.2f}s" if st["status"] == "ok" else f"{st['status']:>16}")
+        print(f"{r['date']:<12}" + "".join(cells))
+
+def main():
+    # uso: backfill.py --start YYYY-MM-DD --end YYYY-MM-DD [--workers N] [--stages bronze,silver]
+    #                  [--gold full|incremental|none] [--force] [--report backfill.json]
+    args = sys.argv[1:]
+    def opt(name: str, default: Optional[str] = None) -> Optional[str]:
+        return args[args.index(name)+1] if name in args else default
+
+    start, end = opt("--start"), opt("--end")
+    if not start or not end:
+        print("uso: backfill.py --start YYYY-MM-DD --end YYYY-MM-DD [--workers N]"); sys.exit(2)
+    workers = int(opt("--workers", str(os.cpu_count() or 2)))
+    stages = [s for s in opt("--stages", "bronze,silver").split(",") if s]
+    gold_mode = opt("--gold", "full")
+    force = "--force" in args
+    dates = date_range(start, end)
+    if gold_mode == "incremental" and "silver" in stages:
+        # antes de correr silver: --incremental rechaza los modelos que necesitan todos los caminos
+        import attribution_models, gold_attribution
+        attribution_models.require_full(gold_attribution.MODELS, "--gold incremental")
+    if "silver" in stages and workers > 1:
+        import silver_build
+        if silver_build.MEMPOOL_SEEN:
+            # el dedup entre días lee los sets de las fechas anteriores: fechas en orden, de a una
+            print(f"[backfill] SILVER_MEMPOOL_SEEN=1: se ignora --workers {workers}, fechas en serie")
+            workers = 1
+
+    t0 = time.perf_counter()
+    results: List[Dict[str, Any]] = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futs = {pool.submit(run_date, d, stages, force): d for d in dates}
+        for f in as_completed(futs):
+            try:
+                r = f.result()
+            except Exception as e:  # el worker murió
+                r = {"date": futs[f], "ok": False, "stages": {}, "error": str(e)}
+            results.append(r)
+            print(f"[backfill] {r['date']} {'OK' if r['ok'] else 'FAIL'}", json.dumps(r["stages"]))
+
+    # los _index.json se escriben read-modify-write: con workers en paralelo se reconstruyen al final
+    s3 = s3fetch.make_client(S3_ENDPOINT, AWS_ACCESS, AWS_SECRET, S3_REGION)
+    for stage in stages:
+        for table in ["web2", "chain_mempool", "chain_blocks"]:
+            try: catalog.rebuild_index(s3, STAGES[stage], table)
+            except Exception as e: print(f"[backfill] índice {stage}/{table} no reconstruido:", e)
+
+    failed = [r["date"] for r in results if not r["ok"]]
+    gold_secs = None
+    if gold_mode != "none" and "silver" in stages:
+        if failed:
+            print("[backfill] gold no se corre: fallaron", failed)
+        else:
+            import gold_attribution, gold_chain
+            g0 = time.perf_counter()
+            metrics.start("gold", gold_mode)
+            gold_attribution.run_incremental() if gold_mode == "incremental" else gold_attribution.run_full()
+            gold_attribution.flush_rollups()
+            import silver_build
+            if silver_build.MEMPOOL_SEEN:
+                print("[backfill] SILVER_MEMPOOL_SEEN=1: gold_chain no se corre (necesita las txids repetidas de D+1)")
+            else:
+                gold_chain.run(dates)
+            metrics.finish()
+            gold_secs = round(time.perf_counter() - g0, 3)
+
+    print_report(results, stages)
+    total = round(time.perf_counter() - t0, 3)
+    print(f"[backfill] {len(dates)} fechas, {len(failed)} con error, {total}s total" +
+          (f", gold {gold_secs}s" if gold_secs is not None else ""))
+
+    report = opt("--report")
+    if report:
+        with open(report, "w", encoding="utf-8") as fh:
+            json.dump({"start": start, "end": end, "workers": workers, "stages": stages, "seconds": total,
+                       "gold_seconds": gold_secs, "dates": sorted(results, key=lambda r: r["date"])}, fh, indent=2)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+﻿import os, io, sys, json, time, shutil, platform, subprocess, tempfile, contextlib
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+
+from botocore.exceptions import ClientError
+
+import synth
+import metrics
+
+# Benchmark de bronze -> silver -> gold sobre datos sintéticos (synth.py) contra un S3 local en disco.
+# Cada tamaño corre en un proceso aparte (pico de memoria limpio) y agrega una línea a --out:
+#   bench_pipeline.py [--sizes 1e5,1e6,1e7] [--days 1] [--users U] [--conv-rate 0.02] [--skew 0.5]
+#                     [--per-object 1000] [--seed 0] [--stages bronze,silver,gold] [--out bench_results.jsonl]
+#                     [--root DIR] [--keep]
+# El pico de memoria es el del proceso (ru_maxrss) al terminar cada etapa: acumulado, no por etapa.
+
+class _Body:
+    def __init__(self, data: bytes): self._data = data
+    def read(self) -> bytes: return self._data
+
+class LocalS3:
+    # subconjunto del cliente boto3 que usa el pipeline (s3fetch, catalog, raw_compact, los tres scripts);
+    # cada bucket es un directorio y cada key un archivo
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str = "") -> str:
+        return os.path.join(self.root, bucket, *key.split("/")) if key else os.path.join(self.root, bucket)
+
+    def _err(self, code: str, op: str):
+        return ClientError({"Error": {"Code": code, "Message": code}}, op)
+
+    def _bucket(self, bucket: str, op: str) -> str:
+        p = self._path(bucket)
+        if not os.path.isdir(p):
+            raise self._err("NoSuchBucket", op)
+        return p
+
+    def head_bucket(self, Bucket: str):
+        self._bucket(Bucket, "HeadBucket"); return {}
+
+    def create_bucket(self, Bucket: str, **kw):
+        os.makedirs(self._path(Bucket), exist_ok=True); return {}
+
+    def put_object(self, Bucket: str, Key: str, Body, ContentType: str = None, **kw):
+        self._bucket(Bucket, "PutObject")
+        p = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        data = Body if isinstance(Body, (bytes, bytearray)) else Body.read()
+        tmp = p + ".tmp"
+        with open(tmp, "wb") as fh: fh.write(data)
+        os.replace(tmp, p)
+        return {}
+
+    def _read(self, bucket: str, key: str, op: str) -> str:
+        self._bucket(bucket, op)
+        p = self._path(bucket, key)
+        if not os.path.isfile(p):
+            raise self._err("NoSuchKey" if op == "GetObject" else "404", op)
+        return p
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None, **kw):
+        p = self._read(Bucket, Key, "GetObject")
+        with open(p, "rb") as fh:
+            if Range:
+                lo, hi = Range.replace("bytes=", "").split("-")
+                fh.seek(int(lo))
+                data = fh.read(int(hi) - int(lo) + 1)
+            else:
+                data = fh.read()
+        return {"Body": _Body(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket: str, Key: str, **kw):
+        return {"ContentLength": os.path.getsize(self._read(Bucket, Key, "HeadObject"))}
+
+    def delete_object(self, Bucket: str, Key: str, **kw):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(Bucket, Key))
+        return {}
+
+    def delete_objects(self, Bucket: str, Delete: Dict[str, Any], **kw):
+        for o in Delete.get("Objects", []):
+            self.delete_object(Bucket, o["Key"])
+        return {}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", Delimiter: Optional[str] = None, **kw):
+        base = self._bucket(Bucket, "ListObjectsV2")
+        # se recorre desde el directorio más profundo que cubre el prefijo
+        start = os.path.join(base, *Prefix.split("/")[:-1]) if "/" in Prefix else base
+        keys: List[Dict[str, Any]] = []
+        dirs = set()
+        for dp, _, files in os.walk(start):
+            rel = os.path.relpath(dp, base).replace(os.sep, "/")
+            rel = "" if rel == "." else rel + "/"
+            for f in files:
+                if f.endswith(".tmp"):
+                    continue
+                k = rel + f
+                if not k.startswith(Prefix):
+                    continue
+                if Delimiter and Delimiter in k[len(Prefix):]:
+                    dirs.add(k[:k.index(Delimiter, len(Prefix)) + 1])
+                    continue
+                st = os.stat(os.path.join(dp, f))
+                keys.append({"Key": k, "Size": st.st_size,
+                             "LastModified": datetime.fromtimestamp(st.st_mtime, timezone.utc)})
+        out: Dict[str, Any] = {"Contents": sorted(keys, key=lambda o: o["Key"]), "IsTruncated": False}
+        if Delimiter:
+            out["CommonPrefixes"] = [{"Prefix": d} for d in sorted(dirs)]
+        return out
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_one(n: int, opts: Dict[str, Any]) -> Dict[str, Any]:
+    root = opts["root"] or tempfile.mkdtemp(prefix="bench-s3-")
+    s3 = LocalS3(root)
+    import bronze_normalize, silver_build, gold_attribution, raw_compact
+    for mod in (bronze_normalize, silver_build, gold_attribution, raw_compact):
+        mod.s3 = s3
+    s3.create_bucket(Bucket=bronze_normalize.BUCKET_RAW)
+    put = lambda k, b: s3.put_object(Bucket=bronze_normalize.BUCKET_RAW, Key=k, Body=b)
+
+    res: Dict[str, Any] = {"events": n, "days": opts["days"], "users": opts["users"], "conv_rate": opts["conv_rate"],
+                           "skew": opts["skew"], "per_object": opts["per_object"], "seed": opts["seed"], "stages": {}}
+    t0 = time.perf_counter()
+    gen = synth.generate(put, n, opts["users"], conv_rate=opts["conv_rate"], skew=opts["skew"], start=opts["start"],
+                         days=opts["days"], per_object=opts["per_object"], seed=opts["seed"])
+    res["generate"] = {"seconds": round(time.perf_counter() - t0, 3), "peak_rss_mb": metrics.peak_rss_mb(),
+                       **{k: v for k, v in gen.items() if k != "dates"}}
+    dates = gen["dates"]
+
+    runners = {
+        "bronze": lambda: [bronze_normalize.run(d) for d in dates],
+        "silver": lambda: [silver_build.run(d, strict=True) for d in dates],
+        "gold": lambda: (gold_attribution.run_full(), gold_attribution.flush_rollups()),
+    }
+    for stage in opts["stages"]:
+        metrics.start(stage)
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            runners[stage]()
+        secs = time.perf_counter() - t0
+        rep = metrics.current().report()
+        res["stages"][stage] = {"seconds": round(secs, 3), "events_per_s": round(n / secs, 1) if secs else None,
+                                "peak_rss_mb": metrics.peak_rss_mb(),
+                                "spans": {s["name"]: s["seconds"] for s in rep["spans"]},
+                                "s3_bytes_in": rep["counters"].get("s3_get", {}).get("bytes", 0),
+                                "s3_bytes_out": rep["counters"].get("s3_put", {}).get("bytes", 0)}
+    if not opts["root"] and not opts["keep"]:
+        shutil.rmtree(root, ignore_errors=True)
+    else:
+        res["root"] = root
+    return res
+
+def main():
+    args = sys.argv[1:]
+    def opt(name: str, default: Optional[str] = None) -> Optional[str]:
+        return args[args.index(name)+1] if name in args else default
+
+    opts = {
+        "days": int(opt("--days", "1")), "users": int(opt("--users")) if opt("--users") else None,
+        "conv_rate": float(opt("--conv-rate", "0.02")), "skew": float(opt("--skew", "0.5")),
+        "per_object": int(opt("--per-object", "1000")), "seed": int(opt("--seed", "0")),
+        "start": opt("--start", "2025-01-01"), "stages": [s for s in opt("--stages", "bronze,silver,gold").split(",") if s],
+        "root": opt("--root"), "keep": "--keep" in args,
+    }
+
+    # --one N: corrida de un tamaño (proceso hijo); imprime el resultado como JSON
+    if "--one" in args:
+        print(json.dumps(run_one(int(float(opt("--one"))), opts)))
+        return
+
+    out = opt("--out", "bench_results.jsonl")
+    sizes = [int(float(s)) for s in opt("--sizes", "1e5,1e6,1e7").split(",") if s]
+    child = [a for i, a in enumerate(args) if a not in ("--sizes", "--out") and (i == 0 or args[i-1] not in ("--sizes", "--out"))]
+    meta = {"run_at": datetime.now(timezone.utc).isoformat(), "git": git_rev(), "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count(), "s3_concurrency": int(os.getenv("S3_CONCURRENCY", "16"))}
+    for n in sizes:
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), "--one", str(n)] + child,
+                           capture_output=True, text=True)
+        if p.returncode != 0:
+            # returncode negativo / 137: el hijo murió por señal (típicamente OOM)
+            print(f"[bench] {n:,} eventos FALLÓ (rc={p.returncode}):\n{p.stderr[-2000:]}")
+            rec = {**meta, "events": n, "returncode": p.returncode, "error": p.stderr[-2000:]}
+        else:
+            rec = {**meta, **json.loads(p.stdout.strip().splitlines()[-1])}
+            print(f"[bench] {n:,} eventos: " + ", ".join(
+                f"{s} {v['seconds']}s ({v['events_per_s']:,.0f} ev/s, {v['peak_rss_mb']} MB)" for s, v in rec["stages"].items()))
+        with open(out, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(rec) + "\n")
+    print("BENCH OK →", out)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
-﻿import os, io, json, argparse
+﻿import os, io, json
 from datetime import datetime, timezone
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Iterable, Tuple, Optional
 
 from dotenv import load_dotenv
-import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import s3fetch
+import raw_compact
+import catalog
+import metrics
 
 # --- Carga .env.dev de la raíz (si existe) ---
 for p in ["./.env.dev", "./.env"]:
@@ -19,152 +26,241 @@ AWS_SECRET    = os.getenv("MINIO_ROOT_PASSWORD", "adminadmin")
 BUCKET_RAW    = os.getenv("S3_BUCKET_RAW", "dp-raw")
 BUCKET_BRONZE = os.getenv("S3_BUCKET_BRONZE", "dp-bronze")
 
-s3 = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=AWS_ACCESS,
-    aws_secret_access_key=AWS_SECRET,
-    region_name=S3_REGION,
-)
+# Streaming: filas por record batch y tamaño máximo (comprimido) de cada part de bronze
+BATCH_ROWS     = int(os.getenv("BRONZE_BATCH_ROWS", "50000"))
+PART_MAX_BYTES = int(os.getenv("BRONZE_PART_MAX_MB", "128")) * 1024 * 1024
+
+s3 = s3fetch.make_client(S3_ENDPOINT, AWS_ACCESS, AWS_SECRET, S3_REGION)
 
 def list_keys(prefix: str) -> List[str]:
-    keys: List[str] = []
-    token = None
-    while True:
-        resp = s3.list_objects_v2(Bucket=BUCKET_RAW, Prefix=prefix, ContinuationToken=token) if token else \
-               s3.list_objects_v2(Bucket=BUCKET_RAW, Prefix=prefix)
-        for it in resp.get("Contents", []):
-            if it["Key"].endswith(".jsonl"):
-                keys.append(it["Key"])
-        if resp.get("IsTruncated"):
-            token = resp.get("NextContinuationToken")
-        else:
-            break
-    return keys
-
-def read_jsonl(key: str) -> List[Dict[str, Any]]:
-    obj = s3.get_object(Bucket=BUCKET_RAW, Key=key)
-    data = obj["Body"].read()
-    rows: List[Dict[str, Any]] = []
+    return s3fetch.list_keys(s3, BUCKET_RAW, prefix, ".jsonl")
+
+def parse_line(line: bytes) -> Dict[str, Any]:
+    try:
+        return json.loads(line)
+    except Exception:
+        return {"raw_text": line.decode("utf-8", errors="ignore")}
+
+def parse_jsonl(data: bytes) -> Iterator[Dict[str, Any]]:
     for line in data.splitlines():
         if not line.strip():
             continue
-        try:
-            rows.append(json.loads(line))
-        except Exception:
-            rows.append({"raw_text": line.decode("utf-8", errors="ignore")})
-    return rows
-
-def to_parquet_upload(df: pd.DataFrame, bronze_key_prefix: str) -> str:
-    # WINDOWS-SAFE: escribir Parquet a memoria y subirlo directo (sin archivos temporales)
-    buf = io.BytesIO()
-    df.to_parquet(buf, index=False)
-    buf.seek(0)
-    key = f"{bronze_key_prefix}/part-{datetime.now(timezone.utc).strftime('%H%M%S%f')}.parquet"
-    s3.put_object(Bucket=BUCKET_BRONZE, Key=key, Body=buf.getvalue(), ContentType="application/octet-stream")
-    return key
+        yield parse_line(line)
 
-def normalize_web2(date_str: str):
-    prefix = f"web2/date={date_str}/"
-    keys = list_keys(prefix)
-    if not keys:
-        return []
-    records = []
-    for k in keys:
-        for r in read_jsonl(k):
-            utm = r.get("utm",{}) or {}
-            client = r.get("client",{}) or {}
-            ids = r.get("ids",{}) or {}
-            device = r.get("device",{}) or {}
-            rec = {
-                "event_id": r.get("event_id"),
-                "ts": r.get("ts"),
-                "type": r.get("type"),
-                "url": r.get("url"),
-                "referrer": r.get("referrer"),
-                "utm_source": utm.get("source",""),
-                "utm_medium": utm.get("medium",""),
-                "utm_campaign": utm.get("campaign",""),
-                "utm_content": utm.get("content",""),
-                "utm_term": utm.get("term",""),
-                "client_ua": client.get("ua",""),
-                "client_lang": client.get("lang",""),
-                "ids_cookie": ids.get("cookie",""),
-                "ids_ga": ids.get("ga",""),
-                "ids_uid": ids.get("uid"),
-                "ids_email_sha256": ids.get("email_sha256"),
-                "device_os": device.get("os",""),
-                "device_browser": device.get("browser",""),
-                "device_device": device.get("device",""),
-                "properties_json": json.dumps(r.get("properties",{}) or {}, ensure_ascii=False),
-                "_raw_key": k,
-            }
-            records.append(rec)
-    if not records:
+def iter_raw(keys: Iterable[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # GETs concurrentes; se entregan en orden de key para que la salida sea estable
+    for k, data in s3fetch.fetch_many(s3, BUCKET_RAW, keys):
+        for r in parse_jsonl(data):
+            yield k, r
+
+def write_stream(rows: Iterable[Dict[str, Any]], schema: pa.Schema, bronze_key_prefix: str,
+                 ts_col: Optional[str] = None) -> List[str]:
+    # Acumula record batches tipados de BATCH_ROWS filas y corta un part nuevo cada PART_MAX_BYTES:
+    # el pico de memoria queda acotado por el tamaño del part, no por el volumen del día.
+    # parts por contenido + commit del manifest al final (ver catalog.py): re-run = misma partición
+    written: List[str] = []
+    entries: List[Dict[str, Any]] = []
+    live = set(catalog.live_keys(s3, BUCKET_BRONZE, bronze_key_prefix))
+    state = {"buf": None, "writer": None, "rows": 0, "lo": None, "hi": None}
+
+    def upload():
+        state["writer"].close()
+        body = state["buf"].getvalue()
+        key = catalog.put_part(s3, BUCKET_BRONZE, bronze_key_prefix, body, live)
+        written.append(key)
+        lo, hi = state["lo"], state["hi"]
+        if isinstance(lo, int):  # epoch (chain_blocks.timestamp)
+            lo, hi = catalog.ts_bounds(pd.Series([lo, hi]))
+        entries.append(catalog.part_entry(key, len(body), state["rows"], lo, hi))
+        state.update(buf=None, writer=None, rows=0, lo=None, hi=None)
+
+    def flush(batch: List[Dict[str, Any]]):
+        if state["writer"] is None:
+            state["buf"] = io.BytesIO()
+            state["writer"] = pq.ParquetWriter(state["buf"], schema)
+        rb = pa.RecordBatch.from_pylist(batch, schema=schema)
+        state["writer"].write_batch(rb)
+        state["rows"] += rb.num_rows
+        if ts_col:
+            mm = pc.min_max(rb.column(ts_col)).as_py()
+            if mm["min"] is not None:
+                state["lo"] = mm["min"] if state["lo"] is None else min(state["lo"], mm["min"])
+                state["hi"] = mm["max"] if state["hi"] is None else max(state["hi"], mm["max"])
+        if state["buf"].tell() >= PART_MAX_BYTES:
+            upload()
+
+    batch: List[Dict[str, Any]] = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) >= BATCH_ROWS:
+            flush(batch); batch = []
+    if batch:
+        flush(batch)
+    if state["writer"] is not None:
+        upload()
+    if entries:
+        catalog.commit_partition(s3, BUCKET_BRONZE, bronze_key_prefix, entries, catalog.schema_hash(schema))
+    table = bronze_key_prefix.split("/date=", 1)[0]
+    metrics.count(table, rows_out=sum(e["rows"] for e in entries), bytes_out=sum(e["bytes"] for e in entries),
+                  parts=len(entries))
+    return written
+
+# ---------- coerciones a los tipos del schema ----------
+def _int(v):
+    try: return int(v) if v is not None and v != "" else None
+    except (TypeError, ValueError): return None
+
+def _str(v):
+    return v if v is None or isinstance(v, str) else str(v)
+
+def _float(v):
+    try: return float(v) if v is not None and v != "" else None
+    except (TypeError, ValueError): return None
+
+def _ts_str(v):
+    # epoch numérico -> ISO UTC (silver lo parsea igual que el epoch original)
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        try: return datetime.fromtimestamp(float(v), tz=timezone.utc).isoformat()
+        except (OverflowError, OSError, ValueError): return None
+    return _str(v)
+
+# claves conocidas de properties promovidas a columnas tipadas; el JSON crudo queda opcional
+# (BRONZE_PROPERTIES_JSON=0 lo omite y se ahorra el json.dumps por evento)
+KEEP_PROPERTIES_JSON = os.getenv("BRONZE_PROPERTIES_JSON", "1") == "1"
+WEB2_COLS = ["event_id","ts","type","url","referrer","utm_source","utm_medium","utm_campaign","utm_content","utm_term",
+             "client_ua","client_lang","ids_cookie","ids_ga","ids_uid","ids_email_sha256",
+             "device_os","device_browser","device_device"] + (["properties_json"] if KEEP_PROPERTIES_JSON else []) + ["_raw_key"]
+WEB2_SCHEMA = pa.schema([(c, pa.string()) for c in WEB2_COLS] +
+                        [("prop_value", pa.float64()), ("prop_currency", pa.string()), ("prop_order_id", pa.string())])
+
+MEMPOOL_SCHEMA = pa.schema([
+    ("txid", pa.string()), ("vsize", pa.int64()), ("fee", pa.int64()), ("value", pa.int64()),
+    ("first_seen", pa.string()), ("fetched_at", pa.string()), ("raw_json", pa.string()), ("_raw_key", pa.string()),
+])
+
+BLOCKS_SCHEMA = pa.schema([
+    ("height", pa.int64()), ("id", pa.string()), ("timestamp", pa.int64()), ("tx_count", pa.int64()),
+    ("size", pa.int64()), ("weight", pa.int64()), ("raw_json", pa.string()), ("_raw_key", pa.string()),
+])
+
+def web2_row(k: str, r: Dict[str, Any]) -> Dict[str, Any]:
+    utm = r.get("utm",{}) or {}
+    client = r.get("client",{}) or {}
+    ids = r.get("ids",{}) or {}
+    device = r.get("device",{}) or {}
+    props = r.get("properties",{}) or {}
+    known = props if isinstance(props, dict) else {}
+    row = {
+        "event_id": _str(r.get("event_id")),
+        "ts": _ts_str(r.get("ts")),
+        "type": _str(r.get("type")),
+        "url": _str(r.get("url")),
+        "referrer": _str(r.get("referrer")),
+        "utm_source": _str(utm.get("source","")),
+        "utm_medium": _str(utm.get("medium","")),
+        "utm_campaign": _str(utm.get("campaign","")),
+        "utm_content": _str(utm.get("content","")),
+        "utm_term": _str(utm.get("term","")),
+        "client_ua": _str(client.get("ua","")),
+        "client_lang": _str(client.get("lang","")),
+        "ids_cookie": _str(ids.get("cookie","")),
+        "ids_ga": _str(ids.get("ga","")),
+        "ids_uid": _str(ids.get("uid")),
+        "ids_email_sha256": _str(ids.get("email_sha256")),
+        "device_os": _str(device.get("os","")),
+        "device_browser": _str(device.get("browser","")),
+        "device_device": _str(device.get("device","")),
+        "_raw_key": k,
+        "prop_value": _float(known.get("value")),
+        "prop_currency": _str(known.get("currency")),
+        "prop_order_id": _str(known.get("order_id")),
+    }
+    if KEEP_PROPERTIES_JSON:
+        row["properties_json"] = json.dumps(props, ensure_ascii=False)
+    return row
+
+def mempool_row(k: str, r: Dict[str, Any]) -> Dict[str, Any]:
+    data = r.get("data", {}) or {}
+    return {
+        "txid": _str(data.get("txid")),
+        "vsize": _int(data.get("vsize")),
+        "fee": _int(data.get("fee")),
+        "value": _int(data.get("value")),
+        "first_seen": _ts_str(data.get("time") or r.get("fetched_at")),
+        "fetched_at": _ts_str(r.get("fetched_at")),
+        "raw_json": json.dumps(r, ensure_ascii=False),
+        "_raw_key": k,
+    }
+
+def blocks_row(k: str, r: Dict[str, Any]) -> Dict[str, Any]:
+    data = r.get("data", {}) or {}
+    return {
+        "height": _int(data.get("height")),
+        "id": _str(data.get("id")),
+        "timestamp": _int(data.get("timestamp") or data.get("time")),
+        "tx_count": _int(data.get("tx_count") or data.get("tx_count_approx")),
+        "size": _int(data.get("size")),
+        "weight": _int(data.get("weight")),
+        "raw_json": json.dumps(r, ensure_ascii=False),
+        "_raw_key": k,
+    }
+
+def iter_prefix(raw_prefix: str, manifests: List[Dict[str, Any]], loose: List[str]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    table = raw_prefix.split("/date=", 1)[0].replace("/", "_")
+    n = 0
+    for k, line in raw_compact.iter_segment_lines(s3, BUCKET_RAW, manifests):
+        n += 1
+        yield k, parse_line(line)
+    for k, r in iter_raw(loose):
+        n += 1
+        yield k, r
+    metrics.count(table, rows_in=n, objects_in=len(loose) + len(raw_compact.covered_keys(manifests)))
+
+def normalize_prefix(raw_prefix: str, bronze_prefix: str, row_fn, schema: pa.Schema, ts_col: str) -> List[str]:
+    # prefiere los segmentos compactados (raw_compact.py); objetos sueltos solo para keys fuera de los manifests
+    manifests = raw_compact.load_manifests(s3, BUCKET_RAW, raw_prefix)
+    covered = raw_compact.covered_keys(manifests)
+    loose = [k for k in list_keys(raw_prefix) if k not in covered]
+    if not manifests and not loose:
         return []
-    df = pd.DataFrame.from_records(records)
-    bronze_prefix = f"web2/date={date_str}"
-    return [to_parquet_upload(df, bronze_prefix)]
+    rows = (row_fn(k, r) for k, r in iter_prefix(raw_prefix, manifests, loose))
+    return write_stream(rows, schema, bronze_prefix, ts_col)
 
+@metrics.timed()
+def normalize_web2(date_str: str):
+    return normalize_prefix(f"web2/date={date_str}/", f"web2/date={date_str}", web2_row, WEB2_SCHEMA, "ts")
+
+@metrics.timed()
 def normalize_chain_mempool(date_str: str):
-    prefix = f"chain/mempool/date={date_str}/"
-    keys = list_keys(prefix)
-    if not keys:
-        return []
-    rows = []
-    for k in keys:
-        for r in read_jsonl(k):
-            data = r.get("data", {}) or {}
-            rows.append({
-                "txid": data.get("txid"),
-                "vsize": data.get("vsize"),
-                "fee": data.get("fee"),
-                "value": data.get("value"),
-                "first_seen": data.get("time") or r.get("fetched_at"),
-                "fetched_at": r.get("fetched_at"),
-                "raw_json": json.dumps(r, ensure_ascii=False),
-                "_raw_key": k,
-            })
-    if not rows:
-        return []
-    df = pd.DataFrame.from_records(rows)
-    bronze_prefix = f"chain_mempool/date={date_str}"
-    return [to_parquet_upload(df, bronze_prefix)]
+    return normalize_prefix(f"chain/mempool/date={date_str}/", f"chain_mempool/date={date_str}", mempool_row, MEMPOOL_SCHEMA, "fetched_at")
 
+@metrics.timed()
 def normalize_chain_blocks(date_str: str):
-    prefix = f"chain/blocks/date={date_str}/"
-    keys = list_keys(prefix)
-    if not keys:
-        return []
-    rows = []
-    for k in keys:
-        for r in read_jsonl(k):
-            data = r.get("data", {}) or {}
-            rows.append({
-                "height": data.get("height"),
-                "id": data.get("id"),
-                "timestamp": data.get("timestamp") or data.get("time"),
-                "tx_count": data.get("tx_count") or data.get("tx_count_approx"),
-                "size": data.get("size"),
-                "weight": data.get("weight"),
-                "raw_json": json.dumps(r, ensure_ascii=False),
-                "_raw_key": k,
-            })
-    if not rows:
-        return []
-    df = pd.DataFrame.from_records(rows)
-    bronze_prefix = f"chain_blocks/date={date_str}"
-    return [to_parquet_upload(df, bronze_prefix)]
+    return normalize_prefix(f"chain/blocks/date={date_str}/", f"chain_blocks/date={date_str}", blocks_row, BLOCKS_SCHEMA, "timestamp")
 
-def main():
-    import sys
-    # Fecha por defecto: hoy UTC (timezone-aware, sin deprecations)
-    date_str = None
-    if len(sys.argv) > 2 and sys.argv[1] == "--date":
-        date_str = sys.argv[2]
-    if not date_str:
-        date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+# prefijo raw -> (tabla bronze, fila, schema, columna ts); lo usa pipeline_daemon.py
+SOURCES = {
+    "web2":          ("web2", web2_row, WEB2_SCHEMA, "ts"),
+    "chain/mempool": ("chain_mempool", mempool_row, MEMPOOL_SCHEMA, "fetched_at"),
+    "chain/blocks":  ("chain_blocks", blocks_row, BLOCKS_SCHEMA, "timestamp"),
+}
+
+def normalize_keys(source: str, date_str: str, keys: List[str]) -> Tuple[str, pa.Table]:
+    # micro-batch: normaliza solo estas keys a un part y lo agrega al manifest de la partición
+    # (part por contenido => un reintento con las mismas keys pisa la misma entrada, no duplica)
+    table, row_fn, schema, ts_col = SOURCES[source]
+    tbl = pa.Table.from_pylist([row_fn(k, r) for k, r in iter_raw(keys)], schema=schema)
+    buf = io.BytesIO(); pq.write_table(tbl, buf)
+    body = buf.getvalue()
+    prefix = f"{table}/date={date_str}"
+    key = catalog.put_part(s3, BUCKET_BRONZE, prefix, body)
+    lo, hi = catalog.ts_bounds(tbl.column(ts_col).to_pandas())
+    catalog.commit_partition(s3, BUCKET_BRONZE, prefix, [catalog.part_entry(key, len(body), tbl.num_rows, lo, hi)],
+                             catalog.schema_hash(schema), append=True)
+    metrics.count(table, rows_in=len(keys), rows_out=tbl.num_rows, bytes_out=len(body), parts=1)
+    return key, tbl
 
+def run(date_str: str) -> List[str]:
     # Asegura bucket bronze
     try:
         s3.head_bucket(Bucket=BUCKET_BRONZE)
@@ -175,6 +271,20 @@ def main():
     written += normalize_web2(date_str)
     written += normalize_chain_mempool(date_str)
     written += normalize_chain_blocks(date_str)
+    return written
+
+def main():
+    import sys
+    # Fecha por defecto: hoy UTC (timezone-aware, sin deprecations)
+    date_str = None
+    if len(sys.argv) > 2 and sys.argv[1] == "--date":
+        date_str = sys.argv[2]
+    if not date_str:
+        date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    metrics.start("bronze", date_str)
+    written = run(date_str)
+    metrics.finish()
 
     if written:
         print("BRONZE OK →")
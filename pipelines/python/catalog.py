@@ -0,0 +1,213 @@
+﻿import json, hashlib
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import s3fetch
+import metrics
+
+# Índice de particiones basado en manifests (evita paginar list_objects_v2 sobre todo el historial):
+#   <table>/date=YYYY-MM-DD/_manifest.json   parts vivos de la partición + rows/bytes/min-max ts/schema hash
+#   <table>/_index.json                      resumen por fecha (rows, bytes, min/max ts, fingerprint)
+# Cada etapa escribe el manifest de lo que produce; las siguientes preguntan "qué archivos cubren
+# el rango X" leyendo el índice y los manifests, sin listar el bucket.
+MANIFEST = "_manifest.json"
+INDEX = "_index.json"
+# campos que write_manifest calcula; el resto del manifest son los extra de cada etapa
+MANIFEST_FIELDS = {"table", "date", "parts", "rows", "bytes", "min_ts", "max_ts", "schema_hash", "fingerprint", "written_at"}
+
+def split_partition(prefix: str) -> Optional[Tuple[str, str]]:
+    # "web2/date=2025-01-02" -> ("web2", "2025-01-02"); None si no es una partición por fecha
+    prefix = prefix.rstrip("/")
+    if "/date=" not in prefix:
+        return None
+    table, date = prefix.rsplit("/date=", 1)
+    return table, date
+
+def schema_hash(schema: pa.Schema) -> str:
+    sig = json.dumps([(f.name, str(f.type)) for f in schema], separators=(",", ":"))
+    return hashlib.sha256(sig.encode("utf-8")).hexdigest()[:16]
+
+def _iso(v: Any) -> Optional[str]:
+    if v is None or (not isinstance(v, str) and pd.isna(v)):
+        return None
+    if isinstance(v, (pd.Timestamp, datetime)):
+        return pd.Timestamp(v).isoformat()
+    return str(v)
+
+def ts_bounds(col: Optional[pd.Series]) -> Tuple[Optional[str], Optional[str]]:
+    if col is None:
+        return None, None
+    col = col.dropna()
+    if col.empty:
+        return None, None
+    if pd.api.types.is_numeric_dtype(col):
+        # epoch en segundos (chain_blocks.timestamp en bronze)
+        lo, hi = pd.to_datetime([col.min(), col.max()], unit="s", utc=True)
+        return lo.isoformat(), hi.isoformat()
+    if not pd.api.types.is_datetime64_any_dtype(col):
+        col = col.astype(str)
+    return _iso(col.min()), _iso(col.max())
+
+def part_entry(key: str, nbytes: int, rows: int, min_ts: Optional[str] = None, max_ts: Optional[str] = None) -> Dict[str, Any]:
+    return {"key": key, "rows": int(rows), "bytes": int(nbytes), "min_ts": min_ts, "max_ts": max_ts}
+
+def df_part_entry(key: str, nbytes: int, df: pd.DataFrame, ts_col: Optional[str]) -> Dict[str, Any]:
+    lo, hi = ts_bounds(df[ts_col] if ts_col and ts_col in df.columns else None)
+    return part_entry(key, nbytes, len(df), lo, hi)
+
+def fingerprint(parts: List[Dict[str, Any]], shash: str) -> str:
+    sig = json.dumps([shash] + sorted((p["key"], p["rows"], p["bytes"]) for p in parts), separators=(",", ":"))
+    return hashlib.sha256(sig.encode("utf-8")).hexdigest()[:16]
+
+def _get_json(client, bucket: str, key: str) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads(s3fetch.get_bytes(client, bucket, key))
+    except Exception:
+        return None
+
+def _put_json(client, bucket: str, key: str, obj: Dict[str, Any]):
+    s3fetch.put_bytes(client, bucket, key, json.dumps(obj, separators=(",", ":")).encode("utf-8"), "application/json")
+
+def write_manifest(client, bucket: str, prefix: str, parts: List[Dict[str, Any]], shash: str,
+                   extra: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    # prefijos que no son partición por fecha (estado de gold) llevan manifest pero no entran al índice
+    prefix = prefix.rstrip("/")
+    part = split_partition(prefix)
+    table, date = part if part is not None else (prefix, None)
+    mins = [p["min_ts"] for p in parts if p.get("min_ts")]
+    maxs = [p["max_ts"] for p in parts if p.get("max_ts")]
+    man = {
+        "table": table, "date": date, "parts": parts,
+        "rows": sum(p["rows"] for p in parts), "bytes": sum(p["bytes"] for p in parts),
+        "min_ts": min(mins) if mins else None, "max_ts": max(maxs) if maxs else None,
+        "schema_hash": shash, "fingerprint": fingerprint(parts, shash),
+        "written_at": datetime.now(timezone.utc).isoformat(),
+    }
+    if extra:
+        man.update(extra)
+    _put_json(client, bucket, f"{prefix}/{MANIFEST}", man)
+    if part is None:
+        return man
+
+    # read-modify-write del índice: un escritor por tabla (ver rebuild_index si se pisan).
+    # Primera vez: se arma desde el bucket para no esconder particiones previas al catálogo.
+    idx = read_index(client, bucket, table)
+    if idx is None:
+        rebuild_index(client, bucket, table)
+        return man
+    idx["dates"][date] = {k: man[k] for k in ("rows", "bytes", "min_ts", "max_ts", "schema_hash", "fingerprint")}
+    _put_json(client, bucket, f"{table}/{INDEX}", idx)
+    return man
+
+def read_manifest(client, bucket: str, table: str, date: str) -> Optional[Dict[str, Any]]:
+    return _get_json(client, bucket, f"{table}/date={date}/{MANIFEST}")
+
+def read_prefix_manifest(client, bucket: str, prefix: str) -> Optional[Dict[str, Any]]:
+    return _get_json(client, bucket, f"{prefix.rstrip('/')}/{MANIFEST}")
+
+def read_index(client, bucket: str, table: str) -> Optional[Dict[str, Any]]:
+    return _get_json(client, bucket, f"{table}/{INDEX}")
+
+def _legacy_manifest(client, bucket: str, table: str, date: str) -> Optional[Dict[str, Any]]:
+    # partición escrita antes del catálogo: parts por listado, filas/schema desde el footer
+    prefix = f"{table}/date={date}/"
+    objs = s3fetch.list_objects(client, bucket, prefix, ".parquet")
+    if not objs:
+        return None
+    parts, shash = [], None
+    for o in objs:
+        md = pq.read_metadata(s3fetch.RangedReader(client, bucket, o["Key"], o["Size"]))
+        shash = shash or schema_hash(md.schema.to_arrow_schema())
+        parts.append(part_entry(o["Key"], o["Size"], md.num_rows))
+    man = {"table": table, "date": date, "parts": parts,
+           "rows": sum(p["rows"] for p in parts), "bytes": sum(p["bytes"] for p in parts),
+           "min_ts": None, "max_ts": None, "schema_hash": shash, "fingerprint": fingerprint(parts, shash),
+           "written_at": datetime.now(timezone.utc).isoformat(), "migrated": True}
+    _put_json(client, bucket, f"{prefix}{MANIFEST}", man)
+    return man
+
+def rebuild_index(client, bucket: str, table: str) -> Dict[str, Any]:
+    # reconstruye _index.json desde los manifests (un listado de "directorios" + un GET por fecha);
+    # las particiones sin manifest (anteriores al catálogo) reciben uno armado por listado
+    idx = {"table": table, "dates": {}}
+    dirs = [d for d in s3fetch.list_dirs(client, bucket, f"{table}/") if "/date=" in d]
+
+    def load(d: str) -> Optional[Dict[str, Any]]:
+        date = d.rstrip("/").rsplit("date=", 1)[-1]
+        return _get_json(client, bucket, d + MANIFEST) or _legacy_manifest(client, bucket, table, date)
+
+    for man in s3fetch.map_bounded(load, dirs):
+        if man is not None:
+            idx["dates"][man["date"]] = {k: man.get(k) for k in ("rows", "bytes", "min_ts", "max_ts", "schema_hash", "fingerprint")}
+    _put_json(client, bucket, f"{table}/{INDEX}", idx)
+    return idx
+
+# ---------- escritura de particiones ----------
+# Los parts se nombran por contenido (part-<sha256[:16]>.parquet): reescribir los mismos datos da la
+# misma key, así un re-run no apila duplicados ni cambia el fingerprint (silver lo saltea), y un part
+# nuevo nunca pisa uno vivo. Reemplazar una partición:
+#   1) subir los parts nuevos; mientras el manifest no los nombre quedan en staging (quien lee por
+#      manifest no los ve); los que ya estaban vivos con la misma key no se vuelven a subir
+#   2) escribir el manifest nuevo: es el commit, un único PUT atómico
+#   3) GC: borrar los .parquet del prefijo que el manifest ya no lista (parts viejos, restos de
+#      corridas cortadas). Los globs date=*/*.parquet ven solo la partición viva después del GC.
+# Un reemplazo y un append (pipeline_daemon.py) sobre la misma partición no deben correr a la vez.
+def part_key(prefix: str, body: bytes) -> str:
+    return f"{prefix.rstrip('/')}/part-{hashlib.sha256(body).hexdigest()[:16]}.parquet"
+
+def live_keys(client, bucket: str, prefix: str) -> List[str]:
+    # parts vivos de un prefijo: los del manifest; sin manifest (datos previos al catálogo), listado
+    man = read_prefix_manifest(client, bucket, prefix)
+    if man is not None:
+        return [p["key"] for p in man["parts"]]
+    return s3fetch.list_keys(client, bucket, prefix.rstrip("/") + "/", ".parquet")
+
+def put_part(client, bucket: str, prefix: str, body: bytes, live: Iterable[str] = ()) -> str:
+    key = part_key(prefix, body)
+    if key in live:
+        metrics.count("catalog", parts_reused=1)
+    else:
+        s3fetch.put_bytes(client, bucket, key, body)
+    return key
+
+def gc_partition(client, bucket: str, prefix: str, live: Iterable[str]) -> List[str]:
+    prefix = prefix.rstrip("/") + "/"
+    live = set(live)
+    dead = [k for k in s3fetch.list_keys(client, bucket, prefix, ".parquet")
+            if k not in live and "/" not in k[len(prefix):]]
+    if dead:
+        s3fetch.delete_keys(client, bucket, dead)
+        metrics.count("catalog", parts_deleted=len(dead))
+    return dead
+
+def commit_partition(client, bucket: str, prefix: str, parts: List[Dict[str, Any]], shash: str,
+                     extra: Optional[Dict[str, Any]] = None, append: bool = False) -> Dict[str, Any]:
+    # append: los parts se suman a los del manifest actual (misma key => se reemplaza la entrada), sin GC;
+    # los campos extra del manifest actual se conservan salvo los que extra pisa
+    if append:
+        man = read_prefix_manifest(client, bucket, prefix)
+        keys = {p["key"] for p in parts}
+        parts = [p for p in (man["parts"] if man else []) if p["key"] not in keys] + parts
+        if man:
+            extra = {**{k: v for k, v in man.items() if k not in MANIFEST_FIELDS}, **(extra or {})}
+    man = write_manifest(client, bucket, prefix, parts, shash, extra)
+    if not append:
+        gc_partition(client, bucket, prefix, [p["key"] for p in parts])
+    return man
+
+def dates_in_range(idx: Dict[str, Any], start: Optional[str] = None, end: Optional[str] = None) -> List[str]:
+    return sorted(d for d in idx["dates"] if (start is None or d >= start) and (end is None or d <= end))
+
+def parts_for_dates(client, bucket: str, table: str, dates: Optional[List[str]] = None) -> Optional[List[Dict[str, Any]]]:
+    # entradas (key, bytes, rows, ts) de los parts vivos de las fechas pedidas (todas si None) que
+    # están en el índice; None si la tabla no tiene índice (caller lista)
+    idx = read_index(client, bucket, table)
+    if idx is None:
+        return None
+    want = dates_in_range(idx) if dates is None else [d for d in dates if d in idx["dates"]]
+    keys = [f"{table}/date={d}/{MANIFEST}" for d in want]
+    return [p for _, man in s3fetch.fetch_many(client, bucket, keys, json.loads) for p in man["parts"]]
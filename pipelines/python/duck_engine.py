@@ -0,0 +1,361 @@
+﻿import os, io, shutil, hashlib, tempfile
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+import s3fetch
+import metrics
+
+# Motor alternativo (--engine duckdb) para silver_build y gold_attribution: las mismas transformaciones
+# que el camino pandas, escritas en SQL y ejecutadas en un DuckDB embebido sobre los parquet de
+# bronze/silver (multi-thread, con spill a disco cuando no entra en memoria_limit).
+#   DUCKDB_THREADS       threads (default: núcleos)
+#   DUCKDB_MEMORY_LIMIT  p.ej. "4GB" (default: el de DuckDB, 80% de la RAM)
+#   DUCKDB_TEMP_DIR      directorio de spill y de staging local
+#   DUCKDB_HTTPFS=1      lee s3:// directo con httpfs (MinIO); si no, los parts se bajan a disco local
+#                        con s3fetch (concurrente) y DuckDB lee archivos locales
+# --verify corre también el camino pandas y compara: parquet canónico (orden por clave, dtypes de
+# pandas) idéntico byte a byte, o igual con tolerancia DUCKDB_VERIFY_RTOL en columnas float (el
+# np.power vectorizado de time_decay y el pow de libm difieren en el último ulp). Si no coincide,
+# no se escribe nada.
+THREADS      = int(os.getenv("DUCKDB_THREADS", "0")) or os.cpu_count() or 1
+MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "")
+TEMP_DIR     = os.getenv("DUCKDB_TEMP_DIR") or None
+HTTPFS       = os.getenv("DUCKDB_HTTPFS", "0") == "1"
+VERIFY_RTOL  = float(os.getenv("DUCKDB_VERIFY_RTOL", "1e-9"))
+
+class VerifyError(RuntimeError):
+    pass
+
+def require():
+    if duckdb is None:
+        raise RuntimeError("--engine duckdb necesita el paquete duckdb (pip install duckdb)")
+
+def _q(s: str) -> str:
+    return "'" + str(s).replace("'", "''") + "'"
+
+def connect(s3_conf: Optional[Dict[str, str]] = None):
+    require()
+    con = duckdb.connect(":memory:")
+    con.execute(f"SET threads={THREADS}")
+    if MEMORY_LIMIT:
+        con.execute(f"SET memory_limit={_q(MEMORY_LIMIT)}")
+    con.execute(f"SET temp_directory={_q(os.path.join(TEMP_DIR or tempfile.gettempdir(), 'duckdb-spill'))}")
+    # el orden de salida lo fija cada ORDER BY; sin esto DuckDB no puede paralelizar algunas etapas
+    con.execute("SET preserve_insertion_order=false")
+    con.execute("SET TimeZone='UTC'")
+    if HTTPFS and s3_conf:
+        con.execute("LOAD httpfs")
+        ep = s3_conf["endpoint"]
+        con.execute(f"""CREATE SECRET pipeline_s3 (TYPE s3, KEY_ID {_q(s3_conf['key'])}, SECRET {_q(s3_conf['secret'])},
+                        REGION {_q(s3_conf['region'])}, ENDPOINT {_q(ep.split('://', 1)[-1])},
+                        URL_STYLE 'path', USE_SSL {str(ep.startswith('https')).lower()})""")
+    return con
+
+@contextmanager
+def staged(client, bucket: str, keys: List[str], s3_conf: Optional[Dict[str, str]] = None) -> Iterator[Tuple[Any, List[str]]]:
+    # (conexión, rutas para read_parquet en el orden de keys)
+    con = connect(s3_conf)
+    d = None
+    try:
+        if HTTPFS:
+            files = [f"s3://{bucket}/{k}" for k in keys]
+        else:
+            d = tempfile.mkdtemp(prefix="duck-stage-", dir=TEMP_DIR)
+            files = []
+            with metrics.span("stage"):
+                for i, (_, data) in enumerate(s3fetch.fetch_many(client, bucket, keys)):
+                    p = os.path.join(d, f"{i:06d}.parquet")
+                    with open(p, "wb") as fh: fh.write(data)
+                    files.append(p)
+        yield con, files
+    finally:
+        con.close()
+        if d: shutil.rmtree(d, ignore_errors=True)
+
+def _scan(files: List[str]) -> str:
+    # _f/_r: posición de cada fila en la entrada (mismo orden que el concat de pandas)
+    lst = "[" + ",".join(_q(f) for f in files) + "]"
+    return (f"(SELECT * EXCLUDE (filename, file_row_number), list_position({lst}, filename) AS _f, "
+            f"file_row_number AS _r FROM read_parquet({lst}, union_by_name=true, filename=true, file_row_number=true))")
+
+def _columns(con, files: List[str]) -> Dict[str, str]:
+    rows = con.execute(f"DESCRIBE SELECT * FROM {_scan(files)}").fetchall()
+    return {r[0]: r[1] for r in rows if r[0] not in ("_f", "_r")}
+
+def count_rows(con, files: List[str]) -> int:
+    lst = "[" + ",".join(_q(f) for f in files) + "]"
+    return con.execute(f"SELECT count(*) FROM read_parquet({lst}, union_by_name=true)").fetchone()[0]
+
+# ---------- expresiones compartidas ----------
+_NUMERIC = ("TINYINT","SMALLINT","INTEGER","BIGINT","HUGEINT","UTINYINT","USMALLINT","UINTEGER","UBIGINT",
+            "FLOAT","DOUBLE","DECIMAL","\"NULL\"")
+# str.strip() de Python: espacios ASCII, \v, separadores 0x1c-0x1f y los espacios Unicode
+_WS = r"[\s\x0b\x1c-\x1f\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}]"
+
+def _strip(e: str) -> str:
+    return f"regexp_replace({e}, '^{_WS}+|{_WS}+$', '', 'g')"
+
+def _str(c: str) -> str:
+    # null -> "" (como fillna("") / astype(str) sobre los únicos en pandas)
+    return f"coalesce(CAST({c} AS VARCHAR), '')"
+
+def ts_expr(c: str, typ: str) -> str:
+    # mismo criterio que timeutil.parse_ts_col: epoch en segundos (número o string numérico) o ISO-8601
+    if typ.startswith("TIMESTAMP WITH TIME ZONE"):
+        return c
+    if typ.startswith("TIMESTAMP") or typ == "DATE":
+        return f"CAST({c} AS TIMESTAMPTZ)"
+    if typ == "BOOLEAN":
+        return "CAST(NULL AS TIMESTAMPTZ)"
+    if typ.startswith(_NUMERIC) or typ == "NULL":
+        return f"CASE WHEN isfinite(CAST({c} AS DOUBLE)) THEN to_timestamp(CAST({c} AS DOUBLE)) END"
+    t = f"trim(CAST({c} AS VARCHAR))"
+    n = f"TRY_CAST({t} AS DOUBLE)"
+    return f"CASE WHEN isfinite({n}) THEN to_timestamp({n}) WHEN {n} IS NULL THEN TRY_CAST({t} AS TIMESTAMPTZ) END"
+
+def _lower_in(c: str, values: List[str]) -> str:
+    return f"coalesce(lower(CAST({c} AS VARCHAR)) IN ({','.join(_q(v) for v in values)}), false)"
+
+# urllib.parse.urlparse(u).netloc / .path: se sacan los \t\r\n, se recorta el prefijo de control/espacio,
+# esquema opcional, "//netloc", y ";params" del último segmento para los esquemas de uses_params.
+# silver_build.split_url usa el mismo regex para las URLs que urlparse rechaza
+USES_PARAMS = ["", "ftp", "hdl", "prospero", "http", "imap", "https", "shttp", "rtsp", "rtsps", "rtspu",
+                "sip", "sips", "mms", "sftp", "tel"]
+URL_RE = r"^(?:([A-Za-z][A-Za-z0-9+.\-]*):)?(?://([^/?#]*))?([^?#]*)"
+
+def _clean_url(c: str) -> str:
+    return f"regexp_replace(regexp_replace({_str(c)}, '[\\t\\r\\n]', '', 'g'), '^[\\x00-\\x20]+', '')"
+
+def _url_parts(c: str) -> Tuple[str, str]:
+    u = _clean_url(c)
+    scheme = f"lower(regexp_extract({u}, '{URL_RE}', 1))"
+    host = f"regexp_extract({u}, '{URL_RE}', 2)"
+    path = f"regexp_extract({u}, '{URL_RE}', 3)"
+    path = (f"CASE WHEN {scheme} IN ({','.join(_q(s) for s in USES_PARAMS)}) "
+            f"THEN regexp_extract({path}, '^((?:.*/)?[^;/]*)', 1) ELSE {path} END")
+    return host, path
+
+def _query_param(c: str, name: str) -> str:
+    # como silver_build._query_param: primer valor no vacío, '+' como espacio y %XX decodificado
+    # (si no forma UTF-8 válido queda sin decodificar)
+    v = f"regexp_extract(regexp_extract({_clean_url(c)}, '^[^?#]*\\?([^#]*)', 1), '(?:^|&){name}=([^&]+)', 1)"
+    v = f"replace({v}, '+', ' ')"
+    return f"coalesce(TRY(url_decode({v})), {v})"
+
+def _fetch(con, sql: str) -> pd.DataFrame:
+    with metrics.span("duckdb"):
+        return con.execute(sql).df()
+
+# ---------- silver ----------
+WEB2_FILL = ["url","referrer","utm_source","utm_medium","utm_campaign","utm_content","utm_term",
+             "client_ua","client_lang","ids_cookie","ids_ga","device_os","device_browser","device_device"]
+WEB2_UTM = ["utm_source","utm_medium","utm_campaign","utm_content","utm_term"]
+
+def silver_web2(con, files: List[str], utm_from_url: bool = False) -> pd.DataFrame:
+    cols = _columns(con, files)
+    sel = []
+    for c, t in cols.items():
+        if c == "ts": sel.append(f"{ts_expr(c, t)} AS ts")
+        elif c in WEB2_FILL: sel.append(f"{_str(c)} AS {c}")
+        else: sel.append(c)
+    host, path = _url_parts("url") if "url" in cols else ("''", "''")
+    rhost = _url_parts("referrer")[0] if "referrer" in cols else "''"
+    # utm_* del query string de url si el evento no trae ninguno (silver_build.UTM_FROM_URL)
+    utm = [c for c in WEB2_UTM if c in cols]
+    repl = ""
+    if utm and "url" in cols and utm_from_url:
+        none = " AND ".join(f"{c} = ''" for c in utm)
+        repl = " REPLACE (" + ", ".join(f"CASE WHEN {none} THEN {_query_param('url', c)} ELSE {c} END AS {c}"
+                                       for c in utm) + ")"
+    # dedup por event_id: se queda el de ts más nuevo (empate: el último en la entrada)
+    df = _fetch(con, f"""
+        WITH t AS (SELECT {', '.join(sel)}, _f, _r FROM {_scan(files)})
+        SELECT * EXCLUDE (_f, _r, _k){repl}, {host} AS url_host, {path} AS url_path, {rhost} AS referrer_host FROM (
+          SELECT *, row_number() OVER (PARTITION BY event_id ORDER BY ts DESC NULLS FIRST, _f DESC, _r DESC) AS _k FROM t)
+        WHERE _k = 1 ORDER BY ts NULLS LAST, _f, _r""")
+    for c in ["event_id","type"] + WEB2_FILL + ["url_host","url_path","referrer_host"]:
+        if c in df.columns: df[c] = df[c].astype("string")
+    return df
+
+def silver_chain_mempool(con, files: List[str]) -> pd.DataFrame:
+    cols = _columns(con, files)
+    sel = []
+    for c, t in cols.items():
+        if c in ("vsize","fee","value"): sel.append(f"TRY_CAST({c} AS BIGINT) AS {c}")
+        elif c in ("first_seen","fetched_at"): sel.append(f"{ts_expr(c, t)} AS {c}")
+        else: sel.append(c)
+    if "fee" in cols and "vsize" in cols:
+        # fee/vsize con +inf (vsize 0) -> null, igual que el replace de pandas
+        r = "CAST(fee AS DOUBLE) / CAST(vsize AS DOUBLE)"
+        sel.append(f"CASE WHEN isnan({r}) OR {r} = 'inf'::DOUBLE THEN NULL ELSE {r} END AS fee_rate_sat_vb")
+    # snapshot más reciente de cada txid (empate: el último en la entrada; null pierde), como latest_per_key
+    # first_seen: el mínimo entre los snapshots de la txid
+    fa = "fetched_at DESC NULLS LAST, " if "fetched_at" in cols else ""
+    fs = " REPLACE (min(first_seen) OVER (PARTITION BY txid) AS first_seen)" if "first_seen" in cols else ""
+    df = _fetch(con, f"""
+        WITH t AS (SELECT {', '.join(sel)}, _f, _r FROM {_scan(files)})
+        SELECT * EXCLUDE (_f, _r, _k) FROM (
+          SELECT *{fs}, row_number() OVER (PARTITION BY txid ORDER BY {fa}_f DESC, _r DESC) AS _k FROM t)
+        WHERE _k = 1 ORDER BY {fa.replace("DESC NULLS LAST", "NULLS FIRST")}_f, _r""")
+    for c in ("vsize","fee","value"):
+        if c in df.columns: df[c] = df[c].astype("Int64")
+    df["txid"] = df["txid"].astype("string")
+    return df
+
+def silver_chain_blocks(con, files: List[str]) -> pd.DataFrame:
+    cols = _columns(con, files)
+    sel = []
+    for c, t in cols.items():
+        if c in ("height","tx_count","size","weight"): sel.append(f"TRY_CAST({c} AS BIGINT) AS {c}")
+        elif c == "timestamp": sel.append(f"{ts_expr(c, t)} AS {c}")
+        else: sel.append(c)
+    if "height" in cols:
+        df = _fetch(con, f"""
+            WITH t AS (SELECT {', '.join(sel)}, _f, _r FROM {_scan(files)})
+            SELECT * EXCLUDE (_f, _r, _k) FROM (
+              SELECT *, row_number() OVER (PARTITION BY height ORDER BY timestamp DESC NULLS FIRST, _f DESC, _r DESC) AS _k FROM t)
+            WHERE _k = 1 ORDER BY timestamp NULLS LAST, _f, _r""")
+    else:
+        df = _fetch(con, f"SELECT {', '.join(sel)} FROM {_scan(files)} ORDER BY _f, _r")
+    for c in ("height","tx_count","size","weight"):
+        if c in df.columns: df[c] = df[c].astype("Int64")
+    df["id"] = df["id"].astype("string")
+    return df
+
+# ---------- gold ----------
+def gold_events(con, files: List[str]):
+    # tabla events = prepare_web2 sobre todas las particiones de silver (ts, channel, user_key, conv_value)
+    cols = _columns(con, files)
+    col = lambda c: c if c in cols else "NULL"
+    src, med = (_strip(f"lower({_str(col(c))})") for c in ("utm_source", "utm_medium"))
+    channel = (f"CASE WHEN {src} = '' AND {med} = '' THEN 'direct/none' ELSE "
+               f"(CASE WHEN {src} = '' THEN 'unknown' ELSE {src} END) || '/' || "
+               f"(CASE WHEN {med} = '' THEN 'none' ELSE {med} END) END")
+    whens = " ".join(f"WHEN {_strip(_str(col(k)))} <> '' THEN '{k}:' || CAST({k} AS VARCHAR)"
+                     for k in ("ids_uid","ids_cookie","ids_ga") if k in cols)
+    user_key = (f"CASE {whens} ELSE 'ua:' || substr(sha256({_str(col('client_ua'))} || '|' || "
+                f"{_str(col('client_lang'))}), 1, 16) END")
+    is_conv = _lower_in(col("type"), ["lead","purchase"])
+    # prop_value; particiones previas sin prop_value: "value" del JSON de leads/purchases
+    conv_value = "coalesce(CAST(prop_value AS DOUBLE)" if "prop_value" in cols else "coalesce(NULL"
+    if "properties_json" in cols:
+        conv_value += (f", CASE WHEN {is_conv} AND json_valid(properties_json) THEN "
+                       f"TRY_CAST(json_extract_string(properties_json, '$.value') AS DOUBLE) END")
+    conv_value += ", 0.0)"
+    ts = ts_expr("ts", cols["ts"]) if "ts" in cols else "CAST(NULL AS TIMESTAMPTZ)"
+    with metrics.span("duckdb"):
+        con.execute(f"""
+            CREATE TEMP TABLE events AS
+            SELECT * FROM (
+              SELECT CAST({col('event_id')} AS VARCHAR) AS event_id, {ts} AS ts, CAST({col('type')} AS VARCHAR) AS type,
+                     CAST({col('utm_campaign')} AS VARCHAR) AS utm_campaign,
+                     {channel} AS channel, {user_key} AS user_key, {conv_value} AS conv_value,
+                     {_lower_in(col('type'), ['pageview','click'])} AS is_tp, {is_conv} AS is_conv, _f, _r
+              FROM {_scan(files)})
+            WHERE ts IS NOT NULL""")
+    return con.execute("SELECT count(*) FROM events").fetchone()[0]
+
+def _ns(df: pd.DataFrame, cols: List[str]) -> pd.DataFrame:
+    # pandas trabaja en ns; DuckDB devuelve us
+    for c in cols:
+        df[c] = df[c].astype("datetime64[ns, UTC]")
+    return df
+
+def gold_sessions(con, timeout_min: int) -> pd.DataFrame:
+    timeout_ns = int(pd.Timedelta(minutes=timeout_min).value)
+    df = _fetch(con, f"""
+        WITH g AS (
+          SELECT *, sum(CASE WHEN prev IS NULL OR epoch_ns(ts) - epoch_ns(prev) > {timeout_ns} THEN 1 ELSE 0 END)
+                      OVER (PARTITION BY user_key ORDER BY ts, _f, _r ROWS UNBOUNDED PRECEDING) AS sess
+          FROM (SELECT *, lag(ts) OVER (PARTITION BY user_key ORDER BY ts, _f, _r) AS prev FROM events))
+        SELECT md5(user_key || '|' || CAST(epoch_ns(min(ts)) AS VARCHAR)) AS session_id, user_key,
+               min(ts) AS start_ts, max(ts) AS end_ts, count(*) AS n_events,
+               string_agg(DISTINCT channel, ',' ORDER BY channel) AS channels,
+               CAST(sum(CAST(is_conv AS BIGINT)) AS BIGINT) AS conv_count,
+               sum(CASE WHEN is_conv THEN conv_value ELSE 0.0 END) AS conv_value_sum
+        FROM g GROUP BY user_key, sess ORDER BY user_key, start_ts""")
+    return _ns(df, ["start_ts","end_ts"])
+
+# modelos de attribution_models.py que tienen versión SQL (markov no: corre en pandas)
+SQL_MODELS = {"last_touch", "linear", "u_shaped", "time_decay"}
+
+def gold_attribution(con, lookback_days: int, halflife_d: float) -> pd.DataFrame:
+    look_ns = int(pd.Timedelta(days=lookback_days).value)
+    # ventana [conv_ts - lookback, conv_ts]; pos = orden del touchpoint (ts y orden de entrada) en la ventana.
+    # Para que los float salgan iguales a pandas se respeta su orden de suma: el denominador de
+    # time_decay es una suma secuencial en orden de pos (reduceat) y el crédito por grupo es una suma
+    # Kahan (groupby.sum) en el orden en que pandas emite las filas (seq).
+    df = _fetch(con, f"""
+        WITH cv AS (SELECT row_number() OVER () AS cid, event_id, user_key, ts, conv_value AS v FROM events WHERE is_conv),
+        tp AS (SELECT user_key, ts, channel, utm_campaign, _f, _r FROM events WHERE is_tp),
+        w AS (
+          SELECT cv.cid, cv.event_id, cv.ts AS conv_ts, cv.v, tp.channel, tp.utm_campaign,
+                 row_number() OVER (PARTITION BY cv.cid ORDER BY tp.ts, tp._f, tp._r) - 1 AS pos,
+                 count(*) OVER (PARTITION BY cv.cid) AS n,
+                 pow(0.5::DOUBLE, greatest((epoch_ns(cv.ts) - epoch_ns(tp.ts)) / 1e9::DOUBLE / 86400::DOUBLE, 0::DOUBLE)
+                     / {float(halflife_d)!r}::DOUBLE) AS wd
+          FROM cv JOIN tp ON tp.user_key = cv.user_key
+           AND epoch_ns(tp.ts) >= epoch_ns(cv.ts) - {look_ns} AND tp.ts <= cv.ts),
+        dn AS (SELECT cid, list_reduce(list(wd ORDER BY pos), (a, b) -> a + b) AS denom FROM w GROUP BY cid),
+        wd AS (SELECT w.*, dn.denom FROM w JOIN dn USING (cid)),
+        credits AS (
+          SELECT event_id, conv_ts, v, 'last_touch' AS model, channel, utm_campaign, v AS credit, 0 AS seq FROM wd WHERE pos = n - 1
+          UNION ALL
+          SELECT event_id, conv_ts, v, 'linear', channel, utm_campaign, CASE WHEN v <> 0 THEN v / n ELSE 1::DOUBLE / n END, pos FROM wd
+          UNION ALL
+          SELECT event_id, conv_ts, v, 'u_shaped', channel, utm_campaign,
+                 CASE WHEN n = 1 THEN v WHEN pos = 0 OR pos = n - 1 THEN v * 0.4::DOUBLE ELSE (v * 0.2::DOUBLE) / (n - 2) END,
+                 CASE WHEN pos = 0 THEN 0 WHEN pos = n - 1 THEN 1 ELSE pos + 1 END FROM wd
+          UNION ALL
+          SELECT event_id, conv_ts, v, 'time_decay', channel, utm_campaign,
+                 v * (wd / CASE WHEN denom = 0 THEN 1::DOUBLE ELSE denom END), pos FROM wd
+          UNION ALL
+          SELECT event_id, ts, v, m.model, 'direct/none', NULL, v, 0
+          FROM cv CROSS JOIN (VALUES ('last_touch'), ('linear'), ('u_shaped'), ('time_decay')) m(model)
+          WHERE NOT EXISTS (SELECT 1 FROM w WHERE w.cid = cv.cid))
+        SELECT event_id AS conv_event_id, conv_ts, v AS conv_value, model, channel, utm_campaign, fsum(credit ORDER BY seq) AS credit
+        FROM credits GROUP BY ALL ORDER BY conv_event_id, conv_ts, conv_value, model, channel, utm_campaign NULLS LAST""")
+    return _ns(df, ["conv_ts"])
+
+def gold_carry(con, cutoff: pd.Timestamp) -> pd.DataFrame:
+    # touchpoints que el próximo incremental todavía puede necesitar (carry_of)
+    df = _fetch(con, f"""SELECT event_id, ts, type, user_key, channel, utm_campaign, conv_value FROM events
+                         WHERE is_tp AND ts >= {_q(cutoff.isoformat())}::TIMESTAMPTZ ORDER BY user_key, ts, _f, _r""")
+    return _ns(df, ["ts"])
+
+# ---------- --verify ----------
+def _parquet_bytes(df: pd.DataFrame) -> bytes:
+    buf = io.BytesIO(); df.to_parquet(buf, index=False); return buf.getvalue()
+
+def _canonical(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+    return df.sort_values(keys, kind="stable", na_position="last").reset_index(drop=True)
+
+def verify(name: str, ref: pd.DataFrame, got: pd.DataFrame, keys: List[str]):
+    # ref: salida pandas; got: salida DuckDB. Se comparan en forma canónica con los dtypes de pandas.
+    if list(ref.columns) != list(got.columns):
+        raise VerifyError(f"[verify] {name}: columnas distintas\n pandas {list(ref.columns)}\n duckdb {list(got.columns)}")
+    if len(ref) != len(got):
+        raise VerifyError(f"[verify] {name}: {len(ref)} filas en pandas vs {len(got)} en duckdb")
+    ref = _canonical(ref, keys)
+    try:
+        got = _canonical(got.astype(ref.dtypes.to_dict()), keys)
+    except (TypeError, ValueError) as e:
+        raise VerifyError(f"[verify] {name}: dtypes incompatibles: {e}")
+    h_ref, h_got = (hashlib.sha256(_parquet_bytes(d)).hexdigest() for d in (ref, got))
+    if h_ref == h_got:
+        metrics.count("verify", identical=1)
+        print(f"[verify] {name}: {len(ref)} filas, parquet idéntico (sha256 {h_ref[:16]})")
+        return
+    try:
+        pd.testing.assert_frame_equal(ref, got, check_exact=False, rtol=VERIFY_RTOL, atol=VERIFY_RTOL)
+    except AssertionError as e:
+        raise VerifyError(f"[verify] {name}: duckdb != pandas\n{e}")
+    metrics.count("verify", within_rtol=1)
+    print(f"[verify] {name}: {len(ref)} filas, iguales salvo redondeo float (rtol {VERIFY_RTOL})")
@@ -1,11 +1,20 @@
-﻿import os, io, json, math, hashlib
-from datetime import datetime, timezone, timedelta
-from typing import List, Dict, Any, Optional
+﻿import os, io, json, hashlib
+from typing import List, Dict, Any, Optional, Tuple
 from collections import defaultdict
 
 from dotenv import load_dotenv
-import boto3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import s3fetch
+import catalog
+import metrics
+import duck_engine
+import attribution_models
+import identity_graph
+from timeutil import parse_ts_col
 
 # --- Carga .env.dev / .env ---
 for p in ["./.env.dev", "./.env"]:
@@ -23,262 +32,958 @@ BUCKET_GOLD     = os.getenv("S3_BUCKET_GOLD", "dp-gold")
 SESSION_TIMEOUT_MIN = int(os.getenv("SESSION_TIMEOUT_MIN", "30"))
 LOOKBACK_DAYS       = int(os.getenv("ATTR_LOOKBACK_DAYS", "7"))
 TIMEDECAY_HALFLIFE_D = float(os.getenv("ATTR_TIMEDECAY_HALFLIFE_D", "7"))
+# modelos de atribución (attribution_models.py); markov es opt-in
+MODELS = attribution_models.resolve([m.strip() for m in os.getenv("ATTR_MODELS", "last_touch,linear,u_shaped,time_decay").split(",") if m.strip()])
+# user_key por grafo de identidades (identity_graph.py) en vez del primer id no vacío; opt-in
+IDENTITY_STITCHING = os.getenv("IDENTITY_STITCHING", "0") == "1"
 
-s3 = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=AWS_ACCESS,
-    aws_secret_access_key=AWS_SECRET,
-    region_name=S3_REGION,
-)
+s3 = s3fetch.make_client(S3_ENDPOINT, AWS_ACCESS, AWS_SECRET, S3_REGION)
+S3_CONF = {"endpoint": S3_ENDPOINT, "key": AWS_ACCESS, "secret": AWS_SECRET, "region": S3_REGION}
 
 # ---------- util S3 ----------
-def list_parquet(prefix: str) -> List[str]:
-    keys: List[str] = []
-    token = None
-    while True:
-        resp = s3.list_objects_v2(Bucket=BUCKET_SILVER, Prefix=prefix, ContinuationToken=token) if token else \
-               s3.list_objects_v2(Bucket=BUCKET_SILVER, Prefix=prefix)
-        for it in resp.get("Contents", []):
-            if it["Key"].endswith(".parquet"):
-                keys.append(it["Key"])
-        if resp.get("IsTruncated"):
-            token = resp.get("NextContinuationToken")
-        else:
-            break
-    return keys
-
-def read_parquet(key: str) -> pd.DataFrame:
-    obj = s3.get_object(Bucket=BUCKET_SILVER, Key=key)
-    buf = io.BytesIO(obj["Body"].read())
-    return pd.read_parquet(buf)
-
-def write_parquet_gold(df: pd.DataFrame, prefix: str) -> str:
-    # asegura bucket
+def list_parquet(prefix: str, bucket: str = BUCKET_SILVER) -> List[str]:
+    return s3fetch.list_keys(s3, bucket, prefix, ".parquet")
+
+def list_dates(prefix: str, bucket: str = BUCKET_SILVER) -> List[str]:
+    # fechas desde el _index.json del catálogo; sin índice, solo los "directorios" date=.../ (Delimiter)
+    idx = catalog.read_index(s3, bucket, prefix.rstrip("/"))
+    if idx is not None:
+        return catalog.dates_in_range(idx)
+    dates = []
+    for d in s3fetch.list_dirs(s3, bucket, prefix):
+        part = d[len(prefix):].strip("/")
+        if part.startswith("date="):
+            dates.append(part[len("date="):])
+    return sorted(dates)
+
+def parquet_from_bytes(data: bytes) -> pd.DataFrame:
+    return pd.read_parquet(io.BytesIO(data))
+
+def read_parquet(key: str, bucket: str = BUCKET_SILVER) -> pd.DataFrame:
+    return parquet_from_bytes(s3fetch.get_bytes(s3, bucket, key))
+
+def read_parquets(keys: List[str], bucket: str = BUCKET_SILVER) -> List[pd.DataFrame]:
+    return [df for _, df in s3fetch.fetch_many(s3, bucket, keys, parquet_from_bytes)]
+
+def ensure_gold():
     try: s3.head_bucket(Bucket=BUCKET_GOLD)
     except Exception: s3.create_bucket(Bucket=BUCKET_GOLD)
 
-    buf = io.BytesIO(); df.to_parquet(buf, index=False); buf.seek(0)
-    ts = datetime.now(timezone.utc).strftime("%H%M%S%f")
-    key = f"{prefix}/part-{ts}.parquet"
-    s3.put_object(Bucket=BUCKET_GOLD, Key=key, Body=buf.getvalue(), ContentType="application/octet-stream")
+def write_parquet_gold(df: pd.DataFrame, prefix: str) -> str:
+    # reemplaza la partición completa: part por contenido, commit del manifest y GC de los
+    # parts anteriores (ver catalog.py); mismos datos => misma key, no se vuelve a subir
+    ensure_gold()
+
+    buf = io.BytesIO(); df.to_parquet(buf, index=False)
+    body = buf.getvalue()
+    key = catalog.put_part(s3, BUCKET_GOLD, prefix, body, catalog.live_keys(s3, BUCKET_GOLD, prefix))
+    metrics.count(prefix.split("/date=", 1)[0], rows_out=len(df), bytes_out=len(body), parts=1)
+    ts_col = "start_ts" if "start_ts" in df.columns else ("conv_ts" if "conv_ts" in df.columns else None)
+    catalog.commit_partition(s3, BUCKET_GOLD, prefix, [catalog.df_part_entry(key, len(body), df, ts_col)],
+                             catalog.schema_hash(pa.Schema.from_pandas(df, preserve_index=False)))
+    stage_rollup(prefix, df)
     return key
 
+def read_partition_gold(prefix: str) -> pd.DataFrame:
+    ks = catalog.live_keys(s3, BUCKET_GOLD, prefix)
+    if not ks: return pd.DataFrame()
+    return pd.concat(read_parquets(ks, BUCKET_GOLD), ignore_index=True)
+
+# ---------- rollups para dashboards ----------
+# Cubos chicos y ordenados en dp-gold/rollups/<cubo>/ (un part, manifest + GC como el resto):
+#   web2_attribution_daily       date × model × channel × utm_campaign: conversions, credit
+#   web2_sessions_daily          date: sessions, events, conversions, conv_value (totales, aditivos)
+#   web2_sessions_channel_daily  date × channel: lo mismo por canal tocado. NO aditivo entre canales:
+#                                una sesión cuenta en cada canal que tocó; los totales salen del anterior
+# Cada partición de web2_attribution / web2_sessions que se escribe (siempre completa) deja el
+# rollup de su fecha pendiente; flush_rollups() reemplaza esas fechas en el cubo al final de la
+# corrida (lee y escribe KBs, no re-escanea gold).
+ROLLUPS = os.getenv("GOLD_ROLLUPS", "1") == "1"
+ROLLUP_PREFIX = "rollups"
+ROLLUP_KEYS = {"web2_attribution_daily": ["date","model","channel","utm_campaign"],
+               "web2_sessions_daily": ["date"],
+               "web2_sessions_channel_daily": ["date","channel"]}
+_pending_rollups: Dict[str, Dict[str, pd.DataFrame]] = {c: {} for c in ROLLUP_KEYS}
+
+def rollup_attribution(df: pd.DataFrame, dt: str) -> pd.DataFrame:
+    if "utm_campaign" not in df.columns:  # particiones escritas antes de la columna
+        df = df.assign(utm_campaign=None)
+    g = df.groupby(["model","channel","utm_campaign"], dropna=False, observed=True) \
+          .agg(conversions=("conv_event_id", "nunique"), credit=("credit", "sum")).reset_index()
+    g.insert(0, "date", pd.Timestamp(dt).date())
+    return g
+
+SESSION_MEASURES = dict(sessions=("session_id", "size"), events=("n_events", "sum"),
+                        conversions=("conv_count", "sum"), conv_value=("conv_value_sum", "sum"))
+
+def rollup_sessions(df: pd.DataFrame, dt: str) -> pd.DataFrame:
+    g = df.assign(date=pd.Timestamp(dt).date()).groupby("date").agg(**SESSION_MEASURES).reset_index()
+    return g if not g.empty else pd.DataFrame({"date": [pd.Timestamp(dt).date()], "sessions": [0], "events": [0],
+                                                "conversions": [0], "conv_value": [0.0]})
+
+def rollup_sessions_channel(df: pd.DataFrame, dt: str) -> pd.DataFrame:
+    x = df.assign(channel=df["channels"].astype(str).str.split(",")).explode("channel")
+    g = x.groupby("channel", observed=True).agg(**SESSION_MEASURES).reset_index()
+    g.insert(0, "date", pd.Timestamp(dt).date())
+    return g
+
+ROLLUP_OF = {"web2_attribution": [("web2_attribution_daily", rollup_attribution)],
+             "web2_sessions": [("web2_sessions_daily", rollup_sessions),
+                               ("web2_sessions_channel_daily", rollup_sessions_channel)]}
+
+def stage_rollup(prefix: str, df: pd.DataFrame):
+    part = catalog.split_partition(prefix)
+    if not ROLLUPS or part is None or part[0] not in ROLLUP_OF:
+        return
+    for cube, fn in ROLLUP_OF[part[0]]:
+        _pending_rollups[cube][part[1]] = fn(df, part[1])
+
+def flush_rollups():
+    for cube, pend in _pending_rollups.items():
+        if not pend:
+            continue
+        prefix = f"{ROLLUP_PREFIX}/{cube}"
+        old = read_partition_gold(prefix)
+        cols = list(next(iter(pend.values())).columns)
+        if not old.empty and list(old.columns) != cols:
+            # cubo con otro esquema (p.ej. web2_sessions_daily por canal, antes de los totales): se
+            # descarta; las fechas que no se reescriban vuelven con la próxima corrida completa
+            print(f"GOLD rollup {cube}: esquema anterior {list(old.columns)}, se reconstruye")
+            old = pd.DataFrame(columns=cols)
+        if not old.empty:
+            old = old[~pd.to_datetime(old["date"]).dt.strftime("%Y-%m-%d").isin(list(pend))]
+        cur = concat_nonempty([old] + list(pend.values()), cols)
+        cur = cur.sort_values(ROLLUP_KEYS[cube], kind="stable").reset_index(drop=True)
+        write_parquet_gold(cur, prefix)
+        print(f"GOLD rollup {cube} → {len(pend)} fechas, {len(cur)} filas")
+        pend.clear()
+
 # ---------- helpers ----------
-def parse_ts(x: Any) -> Optional[pd.Timestamp]:
-    if x is None or (isinstance(x, float) and math.isnan(x)): return None
-    try:
-        return pd.to_datetime(x, utc=True)
-    except Exception:
-        try:
-            return pd.to_datetime(str(x).replace("Z","+00:00"), utc=True)
-        except Exception:
-            return None
-
-def channel_from_row(r) -> str:
-    src = (r.get("utm_source") or "").strip().lower()
-    med = (r.get("utm_medium") or "").strip().lower()
-    if not src and not med:
-        return "direct/none"
-    return f"{src or 'unknown'}/{med or 'none'}"
-
-def user_key_from_row(r) -> Optional[str]:
-    for k in ["ids_uid", "ids_cookie", "ids_ga"]:
-        v = r.get(k)
-        if v is not None and str(v).strip() != "":
-            return f"{k}:{str(v)}"
-    # fallback pobre (no ideal): hash de user agent + lang
-    raw = (r.get("client_ua") or "") + "|" + (r.get("client_lang") or "")
-    return "ua:"+hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
-
-def new_session(prev_ts: Optional[pd.Timestamp], cur_ts: pd.Timestamp) -> bool:
-    if prev_ts is None: return True
-    return (cur_ts - prev_ts) > pd.Timedelta(minutes=SESSION_TIMEOUT_MIN)
-
-def time_decay_weight(delta_days: float, halflife_d: float) -> float:
-    # w = 0.5^(delta/halflife)
-    return pow(0.5, max(delta_days, 0.0)/halflife_d)
-
-# ---------- build (lee TODO web2 de silver) ----------
-def load_all_web2() -> pd.DataFrame:
-    ks = list_parquet("web2/")
-    if not ks:
-        return pd.DataFrame()
-    dfs = [read_parquet(k) for k in ks]
-    df = pd.concat(dfs, ignore_index=True)
+# channel / user_key se calculan sobre los valores únicos (factorize) y se devuelven como
+# Categorical con categorías ordenadas: los codes son el id entero compacto y ordenar por codes
+# equivale a ordenar por el string. Null cuenta como "".
+def _uniques(col: pd.Series, strip: bool = True, lower: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    # (codes, valores únicos como str); el código -1 (null) cae en el último slot, ""
+    codes, uniq = pd.factorize(col)
+    vals = pd.Series(np.asarray(uniq, dtype=object), dtype=object).astype(str)
+    if strip: vals = vals.str.strip()
+    if lower: vals = vals.str.lower()
+    return codes, np.append(vals.to_numpy(dtype=object), "")
+
+def _sorted_categorical(labels: np.ndarray, codes: np.ndarray) -> pd.Categorical:
+    # labels[codes] como Categorical con categorías únicas y ordenadas
+    lc, lu = pd.factorize(labels, sort=True)
+    return pd.Categorical.from_codes(lc[codes], categories=lu).remove_unused_categories()
+
+def sorted_keys(df: pd.DataFrame) -> pd.DataFrame:
+    # sort_values sobre un Categorical ordena por codes: con categorías desordenadas (p.ej. concat
+    # con el carry) el orden no sería el del string
+    for c in ("user_key", "channel"):
+        if c in df.columns and isinstance(df[c].dtype, pd.CategoricalDtype) \
+                and not df[c].cat.categories.is_monotonic_increasing:
+            df = df.assign(**{c: df[c].cat.reorder_categories(df[c].cat.categories.sort_values())})
+    return df
+
+def lower_isin(col: pd.Series, values: List[str]) -> np.ndarray:
+    codes, vals = _uniques(col, strip=False, lower=True)
+    hit = np.isin(vals, values)
+    hit[-1] = False
+    return hit[codes]
+
+def channel_col(df: pd.DataFrame) -> pd.Categorical:
+    # "fuente/medio" en minúsculas; sin ninguno de los dos -> "direct/none"
+    sc, sv = _uniques(df["utm_source"], lower=True)
+    mc, mv = _uniques(df["utm_medium"], lower=True)
+    pcodes, pairs = pd.factorize((sc % len(sv)).astype("int64") * len(mv) + (mc % len(mv)))
+    labels = np.empty(len(pairs), dtype=object)
+    for i, p in enumerate(pairs):
+        src, med = sv[p // len(mv)], mv[p % len(mv)]
+        labels[i] = "direct/none" if not src and not med else f"{src or 'unknown'}/{med or 'none'}"
+    return _sorted_categorical(labels, pcodes)
+
+def user_key_col(df: pd.DataFrame) -> pd.Categorical:
+    # primer id no vacío entre ids_uid, ids_cookie, ids_ga -> "<col>:<valor>"; con IDENTITY_STITCHING
+    # el id canónico del grafo ("idg:<hash>", une uid/email/cookie/ga vistos en un mismo evento);
+    # fallback pobre (no ideal): hash de user agent + lang, calculado una vez por par distinto
+    n = len(df)
+    out = np.full(n, -1, dtype="int64")
+    labels: List[np.ndarray] = []
+    base = 0
+    if IDENTITY_STITCHING:
+        g = identity()
+        canon = g.canonical(g.link(df))
+        ok = canon != 0
+        codes, uniq = pd.factorize(canon[ok])
+        out[ok] = codes
+        labels.append(identity_graph.labels(np.asarray(uniq, dtype="uint64")))
+        base = len(uniq)
+    else:
+        for k in ["ids_uid", "ids_cookie", "ids_ga"]:
+            codes, uniq = pd.factorize(df[k])
+            raw = pd.Series(np.asarray(uniq, dtype=object), dtype=object).astype(str)
+            ok = np.append((raw.str.strip() != "").to_numpy(), False)
+            take = (out < 0) & ok[codes]
+            out[take] = base + codes[take]
+            labels.append((k + ":" + raw).to_numpy(dtype=object))
+            base += len(uniq)
+    rest = np.flatnonzero(out < 0)
+    if len(rest):
+        uc, uv = _uniques(df["client_ua"].iloc[rest], strip=False)
+        lc, lv = _uniques(df["client_lang"].iloc[rest], strip=False)
+        pcodes, pairs = pd.factorize((uc % len(uv)).astype("int64") * len(lv) + (lc % len(lv)))
+        labels.append(np.array(["ua:" + hashlib.sha256(f"{uv[p // len(lv)]}|{lv[p % len(lv)]}".encode("utf-8")).hexdigest()[:16]
+                                for p in pairs], dtype=object))
+        out[rest] = base + pcodes
+    return _sorted_categorical(np.concatenate(labels) if labels else np.array([], dtype=object), out)
+
+# ---------- build (lee web2 de silver) ----------
+def prepare_web2(df: pd.DataFrame) -> pd.DataFrame:
     # columnas necesarias
     need = ["event_id","ts","type","url","utm_source","utm_medium","utm_campaign","utm_content","utm_term",
-            "client_ua","client_lang","ids_cookie","ids_ga","ids_uid","properties_json"]
+            "client_ua","client_lang","ids_cookie","ids_ga","ids_uid","ids_email_sha256"]
     for c in need:
         if c not in df.columns: df[c] = None
-    df["ts"] = df["ts"].apply(parse_ts)
+    # silver escribe ts como timestamp[us, UTC]; particiones viejas (string ISO) se parsean vectorizado
+    df["ts"] = parse_ts_col(df["ts"]).astype("datetime64[ns, UTC]")
     df = df.dropna(subset=["ts"])
-    df["channel"] = df.apply(channel_from_row, axis=1)
-    df["user_key"] = df.apply(user_key_from_row, axis=1)
-    # valor de conversión si existe
+    df["channel"] = channel_col(df)
+    df["user_key"] = user_key_col(df)
+    if "conv_value" not in df.columns:
+        df["conv_value"] = conv_value_col(df)
+    return df
+
+def conv_value_col(df: pd.DataFrame) -> pd.Series:
+    # valor de conversión: prop_value (bronze lo promueve de properties.value); particiones anteriores
+    # solo traen properties_json y se parsea el JSON de leads/purchases, que son los únicos que lo usan
+    if "prop_value" in df.columns:
+        return pd.to_numeric(df["prop_value"], errors="coerce").fillna(0.0).astype("float64")
+    out = pd.Series(0.0, index=df.index)
+    if "properties_json" not in df.columns or "type" not in df.columns:
+        return out
+    conv = lower_isin(df["type"], ["lead","purchase"]) & df["properties_json"].notna().to_numpy()
     vals = []
-    for s in df["properties_json"].fillna("{}").astype(str):
+    for s in df["properties_json"].to_numpy(dtype=object)[conv]:
         try:
             v = json.loads(s).get("value", 0.0)
             vals.append(float(v) if v is not None else 0.0)
         except Exception:
             vals.append(0.0)
-    df["conv_value"] = pd.Series(vals)
+    out[conv] = vals
+    return out
+
+# columnas de silver web2 que usa gold: url/referrer/device no se bajan
+GOLD_WEB2_COLS = ["event_id","ts","type","utm_source","utm_medium","utm_campaign","utm_content","utm_term",
+                  "client_ua","client_lang","ids_cookie","ids_ga","ids_uid","ids_email_sha256","prop_value"]
+# baja cardinalidad: se leen como dictionary (=> Categorical) aunque silver las haya escrito planas
+GOLD_DICT_COLS = ["type","utm_source","utm_medium","utm_campaign","utm_content","utm_term","client_ua","client_lang"]
+
+def silver_web2_parts(dates: Optional[List[str]] = None) -> List[Tuple[str, Optional[int]]]:
+    # (key, bytes): con catálogo salen de los manifests; sin catálogo, listado del prefijo (size vía HEAD)
+    parts = catalog.parts_for_dates(s3, BUCKET_SILVER, "web2", dates)
+    if parts is not None:
+        return [(p["key"], p["bytes"]) for p in parts]
+    if dates is None:
+        return [(k, None) for k in list_parquet("web2/")]
+    return [(k, None) for d in dates for k in list_parquet(f"web2/date={d}/")]
+
+def row_groups_in_range(pf: pq.ParquetFile, ts_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]]) -> List[int]:
+    # poda por estadísticas min/max de ts en el footer; ts puede ser string ISO o timestamp
+    rgs = list(range(pf.num_row_groups))
+    if ts_range is None or "ts" not in pf.schema_arrow.names:
+        return rgs
+    lo, hi = ts_range
+    j = pf.schema_arrow.get_field_index("ts")
+    keep = []
+    for r in rgs:
+        st = pf.metadata.row_group(r).column(j).statistics
+        if st is None or not st.has_min_max:
+            keep.append(r); continue
+        if isinstance(st.min, (str, bytes)):
+            # granularidad de día (prefijo YYYY-MM-DD), el filtro exacto va después del parse
+            mn = st.min.decode() if isinstance(st.min, bytes) else st.min
+            mx = st.max.decode() if isinstance(st.max, bytes) else st.max
+            if mx[:10] < lo.strftime("%Y-%m-%d") or mn[:10] > hi.strftime("%Y-%m-%d"):
+                continue
+        else:
+            mn, mx = pd.Timestamp(st.min), pd.Timestamp(st.max)
+            if mn.tzinfo is None: mn, mx = mn.tz_localize("UTC"), mx.tz_localize("UTC")
+            if mx < lo or mn >= hi:
+                continue
+        keep.append(r)
+    return keep
+
+def read_web2_part(part: Tuple[str, Optional[int]], ts_range=None) -> pd.DataFrame:
+    # GETs por rango: footer + solo las columnas/row groups necesarios
+    key, size = part
+    src = s3fetch.RangedReader(s3, BUCKET_SILVER, key, size)
+    md = pq.read_metadata(src)
+    names = md.schema.to_arrow_schema().names
+    pf = pq.ParquetFile(src, metadata=md, pre_buffer=True, read_dictionary=[c for c in GOLD_DICT_COLS if c in names])
+    cols = [c for c in GOLD_WEB2_COLS if c in names]
+    if "prop_value" not in names and "properties_json" in names:
+        cols.append("properties_json")  # partición previa a prop_value
+    rgs = row_groups_in_range(pf, ts_range)
+    if not rgs:
+        return pd.DataFrame(columns=cols)
+    df = pf.read_row_groups(rgs, columns=cols).to_pandas()
+    return gold_frame(df)
+
+def gold_frame(df: pd.DataFrame) -> pd.DataFrame:
+    if "ts" in df.columns:
+        # por part: si se mezclan particiones string y timestamp el concat no queda en object
+        df["ts"] = parse_ts_col(df["ts"])
+    # conv_value por part: en un concat de particiones nuevas y viejas cada una usa su fuente
+    df["conv_value"] = conv_value_col(df)
+    return df.drop(columns=["prop_value","properties_json"], errors="ignore")
+
+def concat_categorical(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    # pd.concat degrada a object los Categorical con categorías distintas: se unifican antes
+    if len(dfs) > 1:
+        for c in dfs[0].columns:
+            if all(c in d.columns and isinstance(d[c].dtype, pd.CategoricalDtype) for d in dfs):
+                cats = pd.api.types.union_categoricals([d[c] for d in dfs], ignore_order=True).categories
+                for d in dfs:
+                    d[c] = d[c].cat.set_categories(cats)
+    return pd.concat(dfs, ignore_index=True)
+
+def concat_nonempty(dfs: List[pd.DataFrame], columns: List[str]) -> pd.DataFrame:
+    # pd.concat con frames vacíos cambia de comportamiento (FutureWarning): se descartan antes
+    dfs = [d for d in dfs if not d.empty]
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=columns)
+
+@metrics.timed()
+def load_web2(dates: Optional[List[str]] = None,
+              ts_range: Optional[Tuple[pd.Timestamp, pd.Timestamp]] = None) -> pd.DataFrame:
+    parts = silver_web2_parts(dates)
+    if not parts:
+        return pd.DataFrame()
+    dfs = [d for d in s3fetch.map_bounded(lambda p: read_web2_part(p, ts_range), parts) if not d.empty]
+    if not dfs:
+        return pd.DataFrame()
+    df = concat_categorical(dfs)
+    metrics.count("web2", rows_in=len(df))
+    with metrics.span("prepare_web2"):
+        df = prepare_web2(df)
+    if ts_range is not None:
+        df = df[(df["ts"] >= ts_range[0]) & (df["ts"] < ts_range[1])]
     return df
 
+def load_all_web2() -> pd.DataFrame:
+    return load_web2(None)
+
+SESSION_COLS = ["session_id","user_key","start_ts","end_ts","n_events","channels","conv_count","conv_value_sum"]
+
+@metrics.timed()
 def build_sessions(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
-        return pd.DataFrame(columns=[
-            "session_id","user_key","start_ts","end_ts","n_events","channels","conv_count","conv_value_sum"
-        ])
-    df = df.sort_values(["user_key","ts"]).reset_index(drop=True)
-
-    sess_ids = []
-    start_ts = []
-    end_ts = []
-    n_events = []
-    channels = []
-    conv_count = []
-    conv_value_sum = []
-
-    current_session = None
-    last_ts = None
-    current_user = None
-    cur_events = 0
-    chan_set = set()
-    convs = 0
-    conv_sum = 0.0
-
-    rows = []
-    for _, r in df.iterrows():
-        uk = r["user_key"]
-        t  = r["ts"]
-        if (current_user != uk) or new_session(last_ts, t):
-            # flush
-            if current_session is not None:
-                rows.append([current_session, current_user, st, last_ts, cur_events, ",".join(sorted(chan_set)), convs, conv_sum])
-            # start new
-            st = t
-            base = f"{uk}|{int(st.value)}"
-            current_session = hashlib.md5(base.encode("utf-8")).hexdigest()
-            current_user = uk
-            cur_events = 0
-            chan_set = set()
-            convs = 0
-            conv_sum = 0.0
-        # add event
-        cur_events += 1
-        chan_set.add(r["channel"])
-        if str(r["type"]).lower() in ("lead","purchase"):
-            convs += 1
-            conv_sum += float(r.get("conv_value",0.0) or 0.0)
-        last_ts = t
-    # flush last
-    if current_session is not None:
-        rows.append([current_session, current_user, st, last_ts, cur_events, ",".join(sorted(chan_set)), convs, conv_sum])
-
-    sess_df = pd.DataFrame(rows, columns=[
-        "session_id","user_key","start_ts","end_ts","n_events","channels","conv_count","conv_value_sum"
-    ])
-    return sess_df
-
+        return pd.DataFrame(columns=SESSION_COLS)
+    df = sorted_keys(df).sort_values(["user_key","ts"]).reset_index(drop=True)
+
+    # corte de sesión: cambio de usuario o gap > timeout (todo columnar, sobre el id entero del usuario)
+    ucode, uniq_users = pd.factorize(df["user_key"], sort=True)
+    ts = df["ts"]
+    t_ns = ts.to_numpy(dtype="datetime64[ns]").view("int64")
+    new_user = np.ones(len(df), dtype=bool)
+    new_user[1:] = ucode[1:] != ucode[:-1]
+    gap = np.zeros(len(df), dtype=bool)
+    gap[1:] = (t_ns[1:] - t_ns[:-1]) > pd.Timedelta(minutes=SESSION_TIMEOUT_MIN).value
+    is_start = new_user | gap
+    sess_no = np.cumsum(is_start) - 1
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], len(df)) - 1
+
+    is_conv = lower_isin(df["type"], ["lead","purchase"])
+    vals = pd.to_numeric(df["conv_value"], errors="coerce").to_numpy(dtype="float64") if "conv_value" in df.columns \
+        else np.zeros(len(df))
+    conv_count = np.add.reduceat(is_conv.astype("int64"), starts)
+    # suma secuencial por sesión (0.0 + v1 + v2 ...), igual que el loop de referencia: reduceat/groupby
+    # suman en otro orden y cambian el último bit; un NaN se propaga. Una pasada por k-ésima conversión
+    conv_sum = np.zeros(len(starts))
+    ci = np.flatnonzero(is_conv)
+    cs = sess_no[ci]
+    k = np.arange(len(ci)) - np.searchsorted(cs, cs, side="left")
+    by_k = ci[np.argsort(k, kind="stable")]
+    bounds = np.searchsorted(np.sort(k), np.arange(int(k.max()) + 2 if len(k) else 1))
+    for j in range(len(bounds) - 1):
+        sel = by_k[bounds[j]:bounds[j+1]]
+        conv_sum[sess_no[sel]] += vals[sel]
+
+    # canales únicos por sesión, ordenados y unidos con ",": dedup/orden sobre codes (sort=True => orden del string)
+    chc, chu = pd.factorize(df["channel"], sort=True)
+    ch = pd.DataFrame({"s": sess_no, "c": chc}).drop_duplicates().sort_values(["s","c"])
+    channels = pd.Series(np.asarray(chu, dtype=object)[ch["c"].to_numpy()]).groupby(ch["s"].to_numpy(), sort=True) \
+        .agg(",".join).to_numpy()
+
+    start_ts = ts.iloc[starts].reset_index(drop=True)
+    users = np.asarray(uniq_users, dtype=object)[ucode[starts]]
+    sess_ids = [hashlib.md5(f"{u}|{int(v)}".encode("utf-8")).hexdigest()
+                for u, v in zip(users, t_ns[starts])]
+
+    return pd.DataFrame({
+        "session_id": sess_ids,
+        "user_key": users,
+        "start_ts": start_ts,
+        "end_ts": ts.iloc[ends].reset_index(drop=True),
+        "n_events": (ends - starts + 1).astype("int64"),
+        "channels": channels,
+        "conv_count": conv_count,
+        "conv_value_sum": conv_sum,
+    }, columns=SESSION_COLS)
+
+# utm_campaign: campaña del touchpoint que recibe el crédito (null en direct/none)
+ATTR_COLS = ["conv_event_id","conv_ts","conv_value","model","channel","utm_campaign","credit"]
+ATTR_KEYS = ATTR_COLS[:-1]
+
+@metrics.timed()
 def build_attribution(df: pd.DataFrame) -> pd.DataFrame:
-    # Considera cada conversión y asigna crédito a los touchpoints previos en ventana
+    # Considera cada conversión y asigna crédito a los touchpoints previos en ventana según cada
+    # modelo de MODELS (attribution_models.py), todos sobre los mismos caminos
     if df.empty:
-        return pd.DataFrame(columns=[
-            "conv_event_id","conv_ts","conv_value","model","channel","credit"
-        ])
+        return pd.DataFrame(columns=ATTR_COLS)
 
-    df = df.sort_values(["user_key","ts"]).reset_index(drop=True)
+    df = sorted_keys(df).sort_values(["user_key","ts"]).reset_index(drop=True)
 
     # Por simplicidad: touchpoints = eventos pageview/click
-    is_tp = df["type"].str.lower().isin(["pageview","click"])
-    is_conv = df["type"].str.lower().isin(["lead","purchase"])
-
-    rows = []
+    tp_idx = np.flatnonzero(lower_isin(df["type"], ["pageview","click"]))
+    cv_idx = np.flatnonzero(lower_isin(df["type"], ["lead","purchase"]))
+    if len(cv_idx) == 0:
+        return pd.DataFrame(columns=ATTR_COLS)
+
+    # ventana [conv_ts - lookback, conv_ts] por usuario vía searchsorted sobre una clave
+    # compuesta (usuario, rango denso de ts); df ya viene ordenado por user_key, ts
+    ucode = pd.factorize(df["user_key"])[0].astype("int64")
+    t_ns = df["ts"].to_numpy(dtype="datetime64[ns]").view("int64")
+    cv_t = t_ns[cv_idx]
+    look = pd.Timedelta(days=LOOKBACK_DAYS).value
+    uniq, rank = np.unique(np.concatenate([t_ns[tp_idx], cv_t, cv_t - look]), return_inverse=True)
+    ntp, ncv, R = len(tp_idx), len(cv_idx), len(uniq)
+    tp_key = ucode[tp_idx] * R + rank[:ntp]
+    lo = np.searchsorted(tp_key, ucode[cv_idx] * R + rank[ntp+ncv:], side="left")
+    hi = np.searchsorted(tp_key, ucode[cv_idx] * R + rank[ntp:ntp+ncv], side="right")
+    n = hi - lo
+
+    # canal / campaña del touchpoint como rango ordenado (el último canal es direct/none de las
+    # conversiones sin touchpoints; campaña nula = última): la compactación agrupa sobre enteros
+    ch_rank, ch_lab = pd.factorize(np.append(np.asarray(df["channel"].take(tp_idx), dtype=object), "direct/none"), sort=True)
+    cp_rank, cp_lab = pd.factorize(np.asarray(df["utm_campaign"].take(tp_idx), dtype=object), sort=True)
+    cp_rank[cp_rank < 0] = len(cp_lab)
+    cval = pd.to_numeric(df["conv_value"], errors="coerce").to_numpy(dtype="float64")[cv_idx] \
+        if "conv_value" in df.columns else np.zeros(ncv)
+
+    paths = attribution_models.Paths(lo, n, cval, cv_t, t_ns[tp_idx], ch_rank[:-1], len(ch_lab), ucode[tp_idx],
+                                     TIMEDECAY_HALFLIFE_D)
+    models = sorted(MODELS)  # orden alfabético = orden de salida
+    empty = np.flatnonzero(n == 0)
+    conv, model, tps, credit = [], [], [], []
+    for mi, name in enumerate(models):
+        # sin touchpoints en ventana -> todo a "direct/none" (tp = -1)
+        with metrics.span(f"model_{name}"):
+            c, tp, cr = attribution_models.MODELS[name](paths)
+        for cc, tt, rr in ((empty, np.full(len(empty), -1), cval[empty]), (c, tp, cr)):
+            conv.append(cc); tps.append(tt); credit.append(rr); model.append(np.full(len(cc), mi))
+    tp = np.concatenate(tps).astype("int64")
+    chan = np.where(tp >= 0, ch_rank[tp], ch_rank[-1])
+    camp = np.where(tp >= 0, cp_rank[tp], len(cp_lab)) if ntp else np.full(len(tp), len(cp_lab))
+
+    # compactación: suma por (conversión, modelo, canal, campaña) en el orden de ATTR_KEYS; la clave
+    # es un entero compuesto de rangos (conversión = rango de (event_id, ts, valor)) y la suma es la
+    # de groupby (Kahan, en orden de emisión), igual que agrupando por las columnas
+    conv_ids = df["event_id"].to_numpy(dtype=object)[cv_idx]
+    cv_ts = df["ts"].array[cv_idx]
+    cv_rank = pd.DataFrame({"e": conv_ids, "t": cv_ts, "v": cval}).groupby(["e","t","v"], sort=True, dropna=False).ngroup().to_numpy()
+    c, m = (np.concatenate(x).astype("int64") for x in (conv, model))
+    ch, cp = chan.astype("int64"), camp.astype("int64")
+    key = ((cv_rank[c] * len(models) + m) * len(ch_lab) + ch) * (len(cp_lab) + 1) + cp
+    _, first, inv = np.unique(key, return_index=True, return_inverse=True)
+    credit_sum = pd.Series(np.concatenate(credit)).groupby(inv.ravel()).sum().to_numpy()
+    c = c[first]
+    attrib = pd.DataFrame({
+        "conv_event_id": conv_ids[c],
+        "conv_ts": cv_ts[c],
+        "conv_value": cval[c],
+        "model": np.array(models, dtype=object)[m[first]],
+        "channel": np.asarray(ch_lab, dtype=object)[ch[first]],
+        "utm_campaign": np.append(np.asarray(cp_lab, dtype=object), None)[cp[first]],
+        "credit": credit_sum,
+    }, columns=ATTR_COLS)
+    return attrib
 
-    for uk, g in df.groupby("user_key"):
-        g = g.reset_index(drop=True)
-        tps = g[is_tp].copy()
-        cvs = g[is_conv].copy()
-        if cvs.empty: 
-            continue
+# ---------- modo incremental ----------
+# Estado por usuario en dp-gold/_state/web2/:
+#   watermark.json     última fecha de silver procesada
+#   open_sessions      última sesión de cada usuario (puede continuar con eventos nuevos)
+#   carry_tps          touchpoints aún dentro de la ventana de lookback
+STATE_PREFIX = "_state/web2"
+CARRY_COLS = ["event_id","ts","type","user_key","channel","utm_campaign","conv_value"]
 
-        for _, conv in cvs.iterrows():
-            conv_ts = conv["ts"]
-            conv_val = float(conv.get("conv_value", 0.0) or 0.0)
-            lookback_start = conv_ts - pd.Timedelta(days=LOOKBACK_DAYS)
-            window = tps[(tps["ts"] <= conv_ts) & (tps["ts"] >= lookback_start)]
-            if window.empty:
-                # atribuir a "direct/none"
-                rows.append([conv["event_id"], conv_ts, conv_val, "last_touch", "direct/none", conv_val])
-                rows.append([conv["event_id"], conv_ts, conv_val, "linear", "direct/none", conv_val])
-                rows.append([conv["event_id"], conv_ts, conv_val, "u_shaped", "direct/none", conv_val])
-                rows.append([conv["event_id"], conv_ts, conv_val, "time_decay", "direct/none", conv_val])
-                continue
+def load_state(prefix: str = STATE_PREFIX) -> Optional[Dict[str, Any]]:
+    try:
+        wm = json.loads(s3fetch.get_bytes(s3, BUCKET_GOLD, f"{prefix}/watermark.json"))
+    except Exception:
+        return None
+    open_s = read_partition_gold(f"{prefix}/open_sessions")
+    carry = read_partition_gold(f"{prefix}/carry_tps")
+    return {
+        "last_date": wm["last_date"],
+        "open_sessions": open_s if not open_s.empty else pd.DataFrame(columns=SESSION_COLS),
+        "carry": carry if not carry.empty else pd.DataFrame(columns=CARRY_COLS),
+    }
+
+# grafo de identidades: uno por proceso, persistido junto al estado (<prefix>/identity.npz). Se carga
+# al primer uso (--incremental, --date, daemon); la corrida completa lo arma de cero.
+IDENTITY: Optional[identity_graph.IdentityGraph] = None
+
+def identity(prefix: str = STATE_PREFIX, fresh: bool = False) -> identity_graph.IdentityGraph:
+    global IDENTITY
+    if fresh:
+        IDENTITY = identity_graph.IdentityGraph()
+    elif IDENTITY is None:
+        IDENTITY = identity_graph.load(s3, BUCKET_GOLD, f"{prefix}/{identity_graph.STATE_NAME}")
+    return IDENTITY
+
+def rekey_state(st: Dict[str, Any]) -> Dict[str, Any]:
+    # un link nuevo puede fundir usuarios del estado: sus claves pasan a la canónica actual y de dos
+    # sesiones abiertas del mismo usuario queda la última
+    g = identity()
+    open_s, carry = st["open_sessions"].copy(), st["carry"].copy()
+    if not open_s.empty:
+        open_s["user_key"] = g.rekey(open_s["user_key"])
+        open_s = open_sessions_of(open_s.assign(start_ts=pd.to_datetime(open_s["start_ts"], utc=True)))
+    if not carry.empty:
+        carry["user_key"] = g.rekey(carry["user_key"])
+    return {**st, "open_sessions": open_s, "carry": carry}
+
+def open_sessions_of(sessions: pd.DataFrame) -> pd.DataFrame:
+    return sessions.sort_values(["user_key","start_ts"]).drop_duplicates("user_key", keep="last") \
+        if not sessions.empty else pd.DataFrame(columns=SESSION_COLS)
+
+def carry_of(events: pd.DataFrame, last_date: str) -> pd.DataFrame:
+    # el próximo día arranca en last_date+1; lo que quede fuera del lookback ya no puede recibir crédito
+    cutoff = pd.Timestamp(last_date, tz="UTC") + pd.Timedelta(days=1) - pd.Timedelta(days=LOOKBACK_DAYS)
+    carry = events[lower_isin(events["type"], ["pageview","click"]) & (events["ts"] >= cutoff).to_numpy()] \
+        if not events.empty else events
+    return carry.reindex(columns=CARRY_COLS)
+
+def save_state(last_date: str, sessions: pd.DataFrame, events: pd.DataFrame, prefix: str = STATE_PREFIX,
+               carry_date: Optional[str] = None):
+    # carry_date: fecha desde la que se siguen recibiendo eventos (daemon: la más vieja de su ventana)
+    ensure_gold()
+    open_s = open_sessions_of(sessions)
+    carry = carry_of(events, carry_date or last_date)
+    write_parquet_gold(open_s.reset_index(drop=True), f"{prefix}/open_sessions")
+    write_parquet_gold(carry.reset_index(drop=True), f"{prefix}/carry_tps")
+    if IDENTITY_STITCHING and IDENTITY is not None:
+        identity_graph.save(IDENTITY, s3, BUCKET_GOLD, f"{prefix}/{identity_graph.STATE_NAME}")
+    s3fetch.put_bytes(s3, BUCKET_GOLD, f"{prefix}/watermark.json",
+                      json.dumps({"last_date": last_date}).encode("utf-8"), "application/json")
+
+def merge_open_sessions(open_s: pd.DataFrame, sessions: pd.DataFrame):
+    # si la primera sesión nueva de un usuario empieza después del fin de su sesión abierta y dentro
+    # del timeout, se funden (mismo session_id/start_ts; agregados sumados). Una que empieza antes
+    # (batch fuera de orden) no se funde: esos usuarios van por resessionize
+    if open_s.empty or sessions.empty:
+        return sessions, pd.DataFrame(columns=SESSION_COLS)
+    first = sessions.sort_values(["user_key","start_ts"]).drop_duplicates("user_key", keep="first")
+    m = first.merge(open_s, on="user_key", suffixes=("", "_old"))
+    gap = m["start_ts"] - pd.to_datetime(m["end_ts_old"], utc=True)
+    m = m[(gap >= pd.Timedelta(0)) & (gap <= pd.Timedelta(minutes=SESSION_TIMEOUT_MIN))]
+    if m.empty:
+        return sessions, pd.DataFrame(columns=SESSION_COLS)
+    m = m.reset_index(drop=True)
+    merged = pd.DataFrame({
+        "session_id": m["session_id_old"],
+        "user_key": m["user_key"],
+        "start_ts": pd.to_datetime(m["start_ts_old"], utc=True),
+        "end_ts": m["end_ts"],
+        "n_events": m["n_events_old"].astype("int64") + m["n_events"],
+        "channels": [",".join(sorted(set(a.split(",")) | set(b.split(","))))
+                     for a, b in zip(m["channels_old"], m["channels"])],
+        "conv_count": m["conv_count_old"].astype("int64") + m["conv_count"],
+        "conv_value_sum": m["conv_value_sum_old"].astype("float64") + m["conv_value_sum"],
+    }, columns=SESSION_COLS)
+    rest = sessions[~sessions["session_id"].isin(m["session_id"])]
+    return rest, merged
+
+def late_users(open_s: pd.DataFrame, new: pd.DataFrame) -> pd.Series:
+    # user_key -> ts mínimo de los eventos nuevos, para los usuarios cuyos eventos nuevos empiezan
+    # antes del fin de su sesión abierta o justo en él (llegaron fuera de orden, o el daemon repite
+    # eventos que el estado ya tiene)
+    if open_s.empty or new.empty:
+        return pd.Series(dtype="datetime64[ns, UTC]")
+    t0 = new["ts"].groupby(new["user_key"].astype(str).to_numpy()).min()
+    end = pd.Series(pd.to_datetime(open_s["end_ts"], utc=True).to_numpy(), index=open_s["user_key"].astype(str).to_numpy())
+    end = end.reindex(t0.index)
+    return t0[(t0 <= end).to_numpy()]
+
+def resessionize(t0: pd.Series, open_s: pd.DataFrame, new: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Usuarios de late_users: sus sesiones se recalculan desde `cut`, el inicio de la primera sesión
+    # vieja que los eventos nuevos pueden tocar (fin >= t0 - timeout) o t0 si no hay; antes de cut
+    # hay un gap > timeout, así que sesionar sus eventos de silver desde cut da las sesiones exactas.
+    # Se reemplazan sus sesiones con start_ts >= cut en cada partición afectada. Devuelve (sesiones
+    # recalculadas, eventos desde cut): la última sesión de cada usuario es su nueva sesión abierta y
+    # con los eventos se re-atribuyen sus conversiones posteriores a los touchpoints tardíos
+    timeout = pd.Timedelta(minutes=SESSION_TIMEOUT_MIN)
+    users = t0.index
+    first = (t0.min() - timeout).normalize() - pd.Timedelta(days=1)
+    last = max(new["ts"].max(), pd.to_datetime(open_s["end_ts"], utc=True).max()).normalize()
+    days = [d.strftime("%Y-%m-%d") for d in pd.date_range(first, last, freq="D")]
+    parts = {d: read_partition_gold(f"web2_sessions/date={d}") for d in days}
+    old = [open_s[open_s["user_key"].astype(str).isin(users)]] + \
+          [p[p["user_key"].astype(str).isin(users)] for p in parts.values() if not p.empty]
+    old = pd.concat(old, ignore_index=True).drop_duplicates("session_id", keep="last")
+    old["start_ts"], old["end_ts"] = pd.to_datetime(old["start_ts"], utc=True), pd.to_datetime(old["end_ts"], utc=True)
+    uk = old["user_key"].astype(str)
+    hit = (old["end_ts"] >= uk.map(t0) - timeout).to_numpy()
+    cut = old["start_ts"][hit].groupby(uk[hit].to_numpy()).min().reindex(users)
+    cut = cut.where(cut < t0, t0)
+
+    lo = cut.min()
+    ev = load_web2([d.strftime("%Y-%m-%d") for d in pd.date_range(lo.normalize(), last, freq="D")],
+                   (lo, last + pd.Timedelta(days=1)))
+    ev = concat_categorical([d for d in (ev, new[new["user_key"].astype(str).isin(users).to_numpy()].copy()) if not d.empty])
+    ev = ev.drop_duplicates("event_id", keep="last")
+    ev = ev[(ev["ts"] >= ev["user_key"].astype(str).map(cut)).to_numpy()]
+    sessions = build_sessions(ev)
+
+    drop = old[(old["start_ts"] >= uk.map(cut)).to_numpy()]
+    dates = set(drop["start_ts"].dt.date.astype(str)) | set(sessions["start_ts"].dt.date.astype(str))
+    for dt in sorted(dates):
+        cur = parts[dt] if dt in parts else read_partition_gold(f"web2_sessions/date={dt}")
+        if not cur.empty:
+            cur = cur[~cur["session_id"].isin(drop["session_id"])]
+        g = concat_nonempty([cur, sessions[sessions["start_ts"].dt.date.astype(str) == dt]], SESSION_COLS)
+        print("GOLD sessions (resesión) →", write_parquet_gold(g.reset_index(drop=True), f"web2_sessions/date={dt}"))
+    metrics.count("late", users=len(users), events=len(ev), sessions_dropped=len(drop), sessions=len(sessions))
+    return sessions, ev
+
+def write_sessions_partitions(sessions: pd.DataFrame, last_date: Optional[str]):
+    # fechas nuevas (> watermark) se reescriben enteras; fechas ya escritas se actualizan por session_id
+    if sessions.empty: return
+    sessions = sessions.copy()
+    sessions["date"] = sessions["start_ts"].dt.date.astype(str)
+    for dt, g in sessions.groupby("date"):
+        g = g.drop(columns=["date"])
+        prefix = f"web2_sessions/date={dt}"
+        if last_date is not None and dt <= last_date:
+            old = read_partition_gold(prefix)
+            if not old.empty:
+                g = pd.concat([old[~old["session_id"].isin(g["session_id"])], g], ignore_index=True)
+        key = write_parquet_gold(g.reset_index(drop=True), prefix)
+        print("GOLD sessions →", key)
+
+def write_attribution_partitions(attrib: pd.DataFrame, upsert: bool = False):
+    # upsert: la partición ya tiene conversiones de otros micro-batches; se reemplazan solo las de attrib
+    if attrib.empty: return
+    attrib = attrib.copy()
+    attrib["date"] = pd.to_datetime(attrib["conv_ts"], utc=True).dt.date.astype(str)
+    for dt, g in attrib.groupby("date"):
+        g = g.drop(columns=["date"])
+        prefix = f"web2_attribution/date={dt}"
+        if upsert:
+            old = read_partition_gold(prefix)
+            if not old.empty:
+                g = pd.concat([old[~old["conv_event_id"].isin(g["conv_event_id"])], g], ignore_index=True)
+        key = write_parquet_gold(g.reset_index(drop=True), prefix)
+        print("GOLD attribution →", key)
+
+def run_incremental():
+    attribution_models.require_full(MODELS, "--incremental")
+    st = load_state()
+    dates = list_dates("web2/")
+    if st is None:
+        print("[gold] sin estado previo: corrida completa")
+        return run_full(dates)
+    new_dates = [d for d in dates if d > st["last_date"]]
+    if not new_dates:
+        print("Gold al día hasta", st["last_date"]); return
+    new = load_web2(new_dates)
+    if new.empty:
+        save_state(new_dates[-1], st["open_sessions"], st["carry"]); return
+    open_all, events = apply_new_events(st, new, st["last_date"])
+    save_state(new_dates[-1], open_all, events)
+
+def apply_new_events(st: Dict[str, Any], new: pd.DataFrame, upsert_until: Optional[str],
+                     upsert_attribution: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # sesiona/atribuye los eventos nuevos contra el estado (open_sessions + carry) y escribe gold;
+    # devuelve (sesiones abiertas, eventos) para el próximo estado
+    if IDENTITY_STITCHING:
+        st = rekey_state(st)
+    # usuarios con eventos anteriores al fin de su sesión abierta (fuera de orden): se resesionan
+    # desde silver después de escribir las sesiones del resto
+    late = late_users(st["open_sessions"], new)
+    sessions = build_sessions(new[~new["user_key"].astype(str).isin(late.index).to_numpy()] if len(late) else new)
+    sessions, merged = merge_open_sessions(st["open_sessions"], sessions)
+    all_s = concat_nonempty([sessions, merged], SESSION_COLS)
+    write_sessions_partitions(all_s, upsert_until)
+    redone_events = None
+    if len(late):
+        with metrics.span("resessionize"):
+            redone, redone_events = resessionize(late, st["open_sessions"], new)
+        all_s = concat_nonempty([all_s, redone], SESSION_COLS)
+
+    # el carry solo trae touchpoints: las conversiones son las de los eventos nuevos, más (usuarios
+    # fuera de orden) las ya atribuidas desde cut, que pueden recibir crédito de los touchpoints tardíos
+    carry = st["carry"].copy()
+    if not carry.empty:
+        carry["ts"] = pd.to_datetime(carry["ts"], utc=True)
+    events = pd.concat([carry, new], ignore_index=True) if not carry.empty else new
+    if redone_events is not None:
+        events = pd.concat([events, redone_events], ignore_index=True).drop_duplicates("event_id")
+    attrib = build_attribution(events)
+    write_attribution_partitions(attrib, upsert_attribution or redone_events is not None)
+
+    open_all = concat_nonempty([st["open_sessions"][~st["open_sessions"]["user_key"].isin(all_s["user_key"])], all_s],
+                               SESSION_COLS)
+    return open_all, events
+
+def write_full(sessions: pd.DataFrame, attrib: pd.DataFrame):
+    # Particionamos por fecha (UTC) del start de sesión / conv
+    if not sessions.empty:
+        for dt, g in sessions.groupby(sessions["start_ts"].dt.date.astype(str)):
+            key = write_parquet_gold(g, f"web2_sessions/date={dt}")
+            print("GOLD sessions →", key)
 
-            # LAST-TOUCH
-            last_ch = window.iloc[-1]["channel"]
-            rows.append([conv["event_id"], conv_ts, conv_val, "last_touch", last_ch, conv_val])
-
-            # LINEAR
-            uniq = window["channel"].tolist()
-            if len(uniq) > 0:
-                per = conv_val / len(uniq) if conv_val else (1.0/len(uniq))
-                for ch in uniq:
-                    rows.append([conv["event_id"], conv_ts, conv_val, "linear", ch, per])
-
-            # U-SHAPED (40% first, 40% last, 20% resto)
-            uniq = window["channel"].tolist()
-            n = len(uniq)
-            if n == 1:
-                rows.append([conv["event_id"], conv_ts, conv_val, "u_shaped", uniq[0], conv_val])
-            else:
-                first = uniq[0]; last = uniq[-1]; middle = uniq[1:-1]
-                first_c = conv_val * 0.4; last_c = conv_val * 0.4
-                rows.append([conv["event_id"], conv_ts, conv_val, "u_shaped", first, first_c])
-                rows.append([conv["event_id"], conv_ts, conv_val, "u_shaped", last,  last_c])
-                if len(middle) > 0:
-                    per_mid = (conv_val * 0.2) / len(middle)
-                    for ch in middle:
-                        rows.append([conv["event_id"], conv_ts, conv_val, "u_shaped", ch, per_mid])
-
-            # TIME-DECAY (half-life en días)
-            wts = []
-            for ts, ch in zip(window["ts"], window["channel"]):
-                delta_days = max((conv_ts - ts).total_seconds()/86400.0, 0.0)
-                w = pow(0.5, delta_days / TIMEDECAY_HALFLIFE_D)
-                wts.append((ch, w))
-            denom = sum(w for _,w in wts) or 1.0
-            for ch, w in wts:
-                rows.append([conv["event_id"], conv_ts, conv_val, "time_decay", ch, (conv_val * (w/denom))])
-
-    attrib = pd.DataFrame(rows, columns=["conv_event_id","conv_ts","conv_value","model","channel","credit"])
-    # compactación: agrupa por conversión/modelo/canal
     if not attrib.empty:
-        attrib = attrib.groupby(["conv_event_id","conv_ts","conv_value","model","channel"], as_index=False)["credit"].sum()
-    return attrib
+        for dt, g in attrib.groupby(pd.to_datetime(attrib["conv_ts"], utc=True).dt.date.astype(str)):
+            key = write_parquet_gold(g, f"web2_attribution/date={dt}")
+            print("GOLD attribution →", key)
 
-def main():
+def run_full(dates: Optional[List[str]] = None, buckets: int = 0, workers: int = 1):
+    if ENGINE == "duckdb":
+        if IDENTITY_STITCHING:
+            print("[gold] --engine duckdb no implementa IDENTITY_STITCHING; se usa pandas")
+        elif set(MODELS) <= duck_engine.SQL_MODELS:
+            return run_full_duckdb(dates)
+        else:
+            print(f"[gold] --engine duckdb no implementa {sorted(set(MODELS) - duck_engine.SQL_MODELS)}; se usa pandas")
+    if IDENTITY_STITCHING:
+        identity(fresh=True)
+    if buckets > 1:
+        return run_full_buckets(buckets, workers, dates)
     df = load_all_web2()
     if df.empty:
         print("No hay datos web2 en silver aún."); return
 
     sessions = build_sessions(df)
     attrib = build_attribution(df)
+    write_full(sessions, attrib)
+
+    # checkpoint para que las corridas --incremental sigan desde acá
+    dates = dates if dates is not None else list_dates("web2/")
+    if dates:
+        save_state(dates[-1], sessions, df)
+
+# ---------- motor DuckDB (--engine duckdb) ----------
+# Misma corrida completa en SQL (duck_engine.py): sesiones y atribución sobre todas las particiones
+# de silver con threads y spill a disco de DuckDB. --incremental y --date siguen en pandas.
+ENGINE = os.getenv("GOLD_ENGINE", "pandas")
+VERIFY = False
+
+def run_full_duckdb(dates: Optional[List[str]] = None):
+    dates = dates if dates is not None else list_dates("web2/")
+    parts = silver_web2_parts(None)
+    if not parts:
+        print("No hay datos web2 en silver aún."); return
+    with duck_engine.staged(s3, BUCKET_SILVER, [k for k, _ in parts], S3_CONF) as (con, files):
+        rows = duck_engine.gold_events(con, files)
+        metrics.count("web2", rows_in=rows)
+        with metrics.span("build_sessions"):
+            sessions = duck_engine.gold_sessions(con, SESSION_TIMEOUT_MIN)
+        with metrics.span("build_attribution"):
+            attrib = duck_engine.gold_attribution(con, LOOKBACK_DAYS, TIMEDECAY_HALFLIFE_D)
+            attrib = attrib[attrib["model"].isin(MODELS)].reset_index(drop=True)
+        carry = None
+        if dates:
+            cutoff = pd.Timestamp(dates[-1], tz="UTC") + pd.Timedelta(days=1) - pd.Timedelta(days=LOOKBACK_DAYS)
+            carry = duck_engine.gold_carry(con, cutoff)
+    if rows == 0:
+        print("No hay datos web2 en silver aún."); return
+    if VERIFY:
+        with metrics.span("verify"):
+            df = load_all_web2()
+            duck_engine.verify("web2_sessions", build_sessions(df), sessions, ["session_id"])
+            duck_engine.verify("web2_attribution", build_attribution(df), attrib,
+                               ATTR_KEYS)
+    write_full(sessions, attrib)
+    if carry is not None:
+        save_state(dates[-1], sessions, carry)
+
+# ---------- modo out-of-core (--buckets N) ----------
+# 1) shuffle: cada part de silver se prepara y se reparte por hash(user_key) % N en parquet local
+#    (GOLD_SPILL_DIR/in/b=NNNN/); 2) cada bucket (todos los eventos de sus usuarios) se sesioniza y
+#    atribuye por separado, opcionalmente en un pool de procesos, dejando salidas por fecha en
+#    out/; 3) merge por fecha a gold. El pico de memoria queda en un part de silver o un bucket.
+#    markov no corre acá: cada bucket vería solo los caminos de sus usuarios (require_full).
+SPILL_DIR = os.getenv("GOLD_SPILL_DIR") or None
+
+def user_buckets(user_key: pd.Series, n: int) -> np.ndarray:
+    # hash estable del string (no del code, que depende de cada part), calculado sobre los únicos
+    codes, uniq = pd.factorize(user_key)
+    h = pd.util.hash_array(np.asarray(uniq, dtype=object)) % np.uint64(n)
+    return h.astype("int64")[codes]
+
+def _bucket_dir(root: str, kind: str, b: int) -> str:
+    return os.path.join(root, kind, f"b={b:04d}")
+
+def _write_local(df: pd.DataFrame, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path, index=False)
+
+def _read_local_dir(d: str) -> pd.DataFrame:
+    files = sorted(os.path.join(d, f) for f in os.listdir(d) if f.endswith(".parquet")) if os.path.isdir(d) else []
+    return concat_categorical([pd.read_parquet(f) for f in files]) if files else pd.DataFrame()
+
+def read_ids_part(part: Tuple[str, Optional[int]]) -> pd.DataFrame:
+    key, size = part
+    pf = pq.ParquetFile(s3fetch.RangedReader(s3, BUCKET_SILVER, key, size), pre_buffer=True)
+    return pf.read(columns=[c for c in identity_graph.ID_COLS if c in pf.schema_arrow.names]).to_pandas()
+
+def shuffle_web2(root: str, n: int) -> int:
+    rows = 0
+    parts = silver_web2_parts(None)
+    if IDENTITY_STITCHING:
+        # pasada previa solo con las columnas de ids: el grafo tiene que ver todos los links antes
+        # de repartir, si no un usuario fundido por un part posterior caería en dos buckets
+        with metrics.span("identity"):
+            for ids in s3fetch.map_bounded(read_ids_part, parts):
+                identity().link(ids)
+    for i, part in enumerate(s3fetch.map_bounded(read_web2_part, parts)):
+        if part.empty:
+            continue
+        part = prepare_web2(part).reindex(columns=CARRY_COLS)
+        for b, g in part.groupby(user_buckets(part["user_key"], n), sort=False):
+            _write_local(g, os.path.join(_bucket_dir(root, "in", b), f"part-{i:06d}.parquet"))
+        rows += len(part)
+    return rows
+
+def gold_bucket(root: str, b: int, last_date: str) -> Dict[str, int]:
+    # corre en el worker: solo disco local, sin S3
+    df = _read_local_dir(_bucket_dir(root, "in", b))
+    if df.empty:
+        return {"rows": 0, "sessions": 0, "attribution": 0}
+    sessions = build_sessions(df)
+    attrib = build_attribution(df)
+    out = _bucket_dir(root, "out", b)
+    if not sessions.empty:
+        for dt, g in sessions.groupby(sessions["start_ts"].dt.date.astype(str)):
+            _write_local(g, os.path.join(out, "sessions", f"date={dt}.parquet"))
+    if not attrib.empty:
+        for dt, g in attrib.groupby(pd.to_datetime(attrib["conv_ts"], utc=True).dt.date.astype(str)):
+            _write_local(g, os.path.join(out, "attribution", f"date={dt}.parquet"))
+    _write_local(open_sessions_of(sessions), os.path.join(out, "state", "open_sessions.parquet"))
+    _write_local(carry_of(df, last_date), os.path.join(out, "state", "carry_tps.parquet"))
+    return {"rows": len(df), "sessions": len(sessions), "attribution": len(attrib)}
+
+def _merge_by_date(root: str, n: int, kind: str) -> Dict[str, List[str]]:
+    by_date: Dict[str, List[str]] = defaultdict(list)
+    for b in range(n):
+        d = os.path.join(_bucket_dir(root, "out", b), kind)
+        if os.path.isdir(d):
+            for f in os.listdir(d):
+                by_date[f[len("date="):-len(".parquet")]].append(os.path.join(d, f))
+    return by_date
+
+def run_full_buckets(n: int, workers: int = 1, dates: Optional[List[str]] = None):
+    import shutil, tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    attribution_models.require_full(MODELS, "--buckets")
+    dates = dates if dates is not None else list_dates("web2/")
+    if not dates:
+        print("No hay datos web2 en silver aún."); return
+    root = tempfile.mkdtemp(prefix="gold-buckets-", dir=SPILL_DIR)
+    try:
+        with metrics.span("shuffle"):
+            rows = shuffle_web2(root, n)
+        metrics.count("web2", rows_in=rows)
+        with metrics.span("buckets"):
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    stats = list(pool.map(gold_bucket, [root] * n, range(n), [dates[-1]] * n))
+            else:
+                stats = [gold_bucket(root, b, dates[-1]) for b in range(n)]
+        print(f"[gold] {n} buckets, filas por bucket máx {max(st['rows'] for st in stats)} / total {rows}")
+
+        # merge por fecha: mismo orden que la corrida en memoria
+        with metrics.span("merge"):
+            for dt, files in sorted(_merge_by_date(root, n, "sessions").items()):
+                g = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+                g = g.sort_values(["user_key","start_ts"], kind="stable").reset_index(drop=True)
+                print("GOLD sessions →", write_parquet_gold(g, f"web2_sessions/date={dt}"))
+            for dt, files in sorted(_merge_by_date(root, n, "attribution").items()):
+                g = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+                g = g.sort_values(ATTR_KEYS).reset_index(drop=True)
+                print("GOLD attribution →", write_parquet_gold(g, f"web2_attribution/date={dt}"))
+            # checkpoint para --incremental: los usuarios no se repiten entre buckets
+            done = [b for b in range(n) if stats[b]["rows"]]
+            if done:
+                state = lambda b, name: pd.read_parquet(os.path.join(_bucket_dir(root, "out", b), "state", name))
+                save_state(dates[-1], pd.concat([state(b, "open_sessions.parquet") for b in done], ignore_index=True),
+                           pd.concat([state(b, "carry_tps.parquet") for b in done], ignore_index=True))
+    finally:
+        if os.getenv("GOLD_KEEP_SPILL", "0") != "1":
+            shutil.rmtree(root, ignore_errors=True)
+
+def run_date(date_str: str):
+    # recalcula una fecha: lee solo [date - LOOKBACK_DAYS, date + 1] con pushdown de columnas y de ts.
+    # Una sesión que empieza en D puede seguir pasada la medianoche: se lee D+1 entero y, mientras
+    # alguna sesión de D siga abierta al borde de lo leído, un día más
+    attribution_models.require_full(MODELS, "--date")
+    day = pd.Timestamp(date_str, tz="UTC")
+    end = day + pd.Timedelta(days=1)
+    lo, hi = day - pd.Timedelta(days=LOOKBACK_DAYS), end + pd.Timedelta(days=1)
+    dates = [d.strftime("%Y-%m-%d") for d in pd.date_range(lo, end, freq="D")]
+    df = load_web2(dates, (lo, hi))
+    if df.empty:
+        print("No hay datos web2 en silver para", date_str); return
 
-    # Particionamos por fecha (UTC) del start de sesión / conv
+    timeout = pd.Timedelta(minutes=SESSION_TIMEOUT_MIN)
+    while True:
+        sessions = build_sessions(df)
+        sessions = sessions[(sessions["start_ts"] >= day) & (sessions["start_ts"] < end)].reset_index(drop=True)
+        if not (sessions["end_ts"] >= hi - timeout).any():
+            break
+        more = load_web2([hi.strftime("%Y-%m-%d")], (hi, hi + pd.Timedelta(days=1)))
+        if more.empty:
+            break
+        df = concat_categorical([df, more])
+        hi += pd.Timedelta(days=1)
     if not sessions.empty:
-        sessions["date"] = sessions["start_ts"].dt.date.astype(str)
-        for dt, g in sessions.groupby("date"):
-            key = write_parquet_gold(g.drop(columns=["date"]), f"web2_sessions/date={dt}")
-            print("GOLD sessions →", key)
+        print("GOLD sessions →", write_parquet_gold(sessions, f"web2_sessions/date={date_str}"))
 
+    attrib = build_attribution(df)
     if not attrib.empty:
-        attrib["date"] = pd.to_datetime(attrib["conv_ts"], utc=True).dt.date.astype(str)
-        for dt, g in attrib.groupby("date"):
-            key = write_parquet_gold(g.drop(columns=["date"]), f"web2_attribution/date={dt}")
-            print("GOLD attribution →", key)
+        conv_ts = pd.to_datetime(attrib["conv_ts"], utc=True)
+        attrib = attrib[(conv_ts >= day) & (conv_ts < end)].reset_index(drop=True)
+    if not attrib.empty:
+        print("GOLD attribution →", write_parquet_gold(attrib, f"web2_attribution/date={date_str}"))
+
+def main():
+    import sys
+    args = sys.argv[1:]
+    # --incremental: solo fechas nuevas de silver + estado de carry-over
+    # --date D: recalcula solo la fecha D (con su ventana de lookback)
+    # --buckets N [--workers W]: corrida completa out-of-core, N buckets por hash de user_key
+    # --engine duckdb [--verify]: corrida completa en DuckDB (opcionalmente comparada contra pandas)
+    global ENGINE, VERIFY
+    ENGINE = args[args.index("--engine")+1] if "--engine" in args else ENGINE
+    VERIFY = "--verify" in args
+    if ENGINE == "duckdb":
+        duck_engine.require()
+        if "--incremental" in args or "--date" in args:
+            print("[gold] --engine duckdb solo aplica a la corrida completa; se usa pandas")
+    if "--incremental" in args:
+        metrics.start("gold", "incremental")
+        run_incremental()
+    elif "--date" in args:
+        metrics.start("gold", args[args.index("--date")+1])
+        run_date(args[args.index("--date")+1])
+    else:
+        metrics.start("gold")
+        buckets = int(args[args.index("--buckets")+1]) if "--buckets" in args else 0
+        workers = int(args[args.index("--workers")+1]) if "--workers" in args else 1
+        run_full(buckets=buckets, workers=workers)
+    flush_rollups()
+    metrics.finish()
 
 if __name__ == "__main__":
     main()
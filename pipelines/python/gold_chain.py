@@ -0,0 +1,192 @@
+﻿import os, io, sys
+from datetime import datetime, timedelta
+from typing import List, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import s3fetch
+import catalog
+import metrics
+import gold_attribution as gold
+from timeutil import parse_ts_col
+
+# Gold de chain: confirmación estimada mempool -> bloque y mercado de fees por día.
+# silver no dice en qué bloque entró cada tx; se estima como el primer bloque con timestamp posterior
+# al último snapshot en que se vio la tx (fetched_at, silver deja el más reciente) y la demora es
+# ese timestamp - first_seen. Es un as-of hacia adelante contra el índice ordenado de timestamps de
+# bloques (searchsorted), sin join entre días: se recorren las fechas en orden, una sola vez, con
+#   - los bloques de D .. D+CHAIN_CONFIRM_HORIZON_DAYS (el bloque siguiente suele caer en D+1)
+#   - los txids de D+1 como lookahead: una tx que sigue en el mempool al día siguiente se cuenta en
+#     D+1 (su último snapshot) con el first_seen mínimo de los dos días
+# Salidas (dp-gold, una partición por fecha, reemplazo completo como el resto de gold):
+#   chain_confirmations/date=D    una fila: txs, confirmadas, percentiles de fee rate y de demora
+#   chain_fee_histogram/date=D    una fila por banda de fee rate: txs, vbytes, demora p50/p90
+# Sin bloques posteriores todavía (D+1 sin ingerir) las txs quedan sin confirmar: re-correr la fecha.
+# El lookahead necesita que silver de D+1 conserve las txids ya vistas en D: una partición escrita con
+# SILVER_MEMPOOL_SEEN=1 (settings del manifest de silver) se rechaza en vez de confirmar de más.
+#   gold_chain.py [--date D]
+HORIZON_DAYS = int(os.getenv("CHAIN_CONFIRM_HORIZON_DAYS", "1"))
+PCTS = [10, 25, 50, 75, 90, 99]
+# bandas de fee rate (sat/vB) al estilo de los gráficos de mempool; la última es abierta
+FEE_EDGES = np.array([0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30, 40, 50, 70, 100, 150, 200, 300, 500, 1000, np.inf])
+
+MEMPOOL_COLS = ["txid", "fee_rate_sat_vb", "vsize", "first_seen", "fetched_at"]
+BLOCK_COLS = ["height", "timestamp"]
+
+def read_silver(table: str, date_str: str, cols: List[str]) -> pd.DataFrame:
+    # parts vivos de la partición (manifest; sin catálogo, listado) y solo las columnas pedidas
+    man = catalog.read_manifest(gold.s3, gold.BUCKET_SILVER, table, date_str)
+    if man and man.get("settings", {}).get("mempool_seen"):
+        raise ValueError(f"gold_chain: silver {table}/date={date_str} se escribió con SILVER_MEMPOOL_SEEN=1 y no "
+                         "trae las txids vistas los días anteriores; re-correr silver con SILVER_MEMPOOL_SEEN=0")
+    keys = [p["key"] for p in man["parts"]] if man else gold.list_parquet(f"{table}/date={date_str}/")
+
+    def load(b: bytes) -> pd.DataFrame:
+        pf = pq.ParquetFile(io.BytesIO(b))
+        return pf.read(columns=[c for c in cols if c in pf.schema_arrow.names]).to_pandas()
+
+    dfs = [df for _, df in s3fetch.fetch_many(gold.s3, gold.BUCKET_SILVER, keys, load)]
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    df = df.reindex(columns=cols)
+    for c in ("first_seen", "fetched_at", "timestamp"):
+        if c in df.columns:
+            df[c] = parse_ts_col(df[c])
+    return df
+
+def _ns(s: pd.Series) -> np.ndarray:
+    return s.to_numpy(dtype="datetime64[ns]").view("int64")
+
+def next_day(date_str: str, n: int = 1) -> str:
+    return (datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=n)).strftime("%Y-%m-%d")
+
+class Stream:
+    # ventana de particiones leídas: cada fecha se lee una vez aunque la usen dos días
+    def __init__(self):
+        self.mempool: Dict[str, pd.DataFrame] = {}
+        self.blocks: Dict[str, pd.DataFrame] = {}
+
+    def get(self, cache: Dict[str, pd.DataFrame], table: str, date_str: str, cols: List[str]) -> pd.DataFrame:
+        if date_str not in cache:
+            cache[date_str] = read_silver(table, date_str, cols)
+        return cache[date_str]
+
+    def mem(self, date_str: str) -> pd.DataFrame:
+        return self.get(self.mempool, "chain_mempool", date_str, MEMPOOL_COLS)
+
+    def blk(self, date_str: str) -> pd.DataFrame:
+        return self.get(self.blocks, "chain_blocks", date_str, BLOCK_COLS)
+
+    def forget_before(self, date_str: str):
+        for d in (self.mempool, self.blocks):
+            for k in [k for k in d if k < date_str]:
+                del d[k]
+
+def deferred(m: pd.DataFrame, nxt: pd.DataFrame) -> np.ndarray:
+    # txs de m que siguen en el mempool al día siguiente
+    if m.empty or nxt.empty:
+        return np.zeros(len(m), dtype=bool)
+    return m["txid"].isin(nxt["txid"].dropna()).to_numpy(dtype=bool)
+
+def carry_first_seen(m: pd.DataFrame, prev: pd.DataFrame) -> pd.DataFrame:
+    # first_seen mínimo entre el día y los snapshots del día anterior de las mismas txs
+    if m.empty or prev.empty:
+        return m
+    p = prev[["txid", "first_seen"]].dropna(subset=["txid"])
+    p = p[p["txid"].isin(m["txid"])]
+    if p.empty:
+        return m
+    fs = m["txid"].map(p.set_index("txid")["first_seen"])
+    return m.assign(first_seen=m["first_seen"].where(m["first_seen"].notna() & ~(fs < m["first_seen"]), fs))
+
+def confirm(m: pd.DataFrame, blocks: pd.DataFrame) -> pd.DataFrame:
+    # as-of hacia adelante: primer bloque con timestamp > último snapshot de la tx
+    b = blocks.dropna(subset=["timestamp"]).sort_values("timestamp", kind="stable")
+    bt, bh = _ns(b["timestamp"]), pd.to_numeric(b["height"]).to_numpy(dtype="float64", na_value=np.nan)
+    seen = m["fetched_at"].fillna(m["first_seen"])
+    pos = np.searchsorted(bt, _ns(seen), side="right")
+    hit = seen.notna().to_numpy() & (pos < len(bt))
+    height = np.full(len(m), np.nan)
+    ts = np.full(len(m), np.datetime64("NaT"), dtype="datetime64[ns]")
+    height[hit], ts[hit] = bh[pos[hit]], bt[pos[hit]]
+    out = m.assign(block_height=pd.Series(height, index=m.index).astype("Int64"),
+                   block_ts=pd.Series(ts, index=m.index).dt.tz_localize("UTC"))
+    out["delay_s"] = (out["block_ts"] - out["first_seen"]).dt.total_seconds().clip(lower=0)
+    return out
+
+def _pcts(x: np.ndarray, prefix: str) -> Dict[str, float]:
+    x = x[~np.isnan(x)]
+    return {f"{prefix}_p{p}": (float(np.percentile(x, p)) if len(x) else np.nan) for p in PCTS}
+
+def summarize(c: pd.DataFrame, date_str: str, n_blocks: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    fee = pd.to_numeric(c["fee_rate_sat_vb"], errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    # fee rate negativo o infinito (fee < 0, vsize 0) no cae en ninguna banda: se descarta como el nulo
+    bad = ~np.isnan(fee) & ~(np.isfinite(fee) & (fee >= 0))
+    metrics.count("chain_fee_histogram", fee_rate_missing=int(np.isnan(fee).sum()), fee_rate_invalid=int(bad.sum()))
+    fee[bad] = np.nan
+    delay = c["delay_s"].to_numpy(dtype="float64", na_value=np.nan)
+    vs = pd.to_numeric(c["vsize"], errors="coerce").fillna(0).to_numpy(dtype="float64")
+    conf = c["block_height"].notna().to_numpy()
+    day = pd.Timestamp(date_str).date()
+    row = {"date": day, "txs": len(c), "confirmed": int(conf.sum()), "vbytes": float(vs.sum()), "blocks": n_blocks}
+    row.update(_pcts(fee, "fee_rate")); row.update(_pcts(delay, "delay_s"))
+    summary = pd.DataFrame([row])
+
+    band = np.searchsorted(FEE_EDGES, fee, side="right") - 1  # NaN -> última posición: fuera
+    ok = ~np.isnan(fee)
+    rows = []
+    for k in np.unique(band[ok]):
+        sel = ok & (band == k)
+        d = delay[sel & conf]
+        n_conf = len(d)
+        d = d[~np.isnan(d)]
+        rows.append({"date": day, "fee_lo": float(FEE_EDGES[k]), "fee_hi": float(FEE_EDGES[k + 1]),
+                     "txs": int(sel.sum()), "vbytes": float(vs[sel].sum()), "confirmed": n_conf,
+                     "delay_s_p50": float(np.percentile(d, 50)) if len(d) else np.nan,
+                     "delay_s_p90": float(np.percentile(d, 90)) if len(d) else np.nan})
+    hist = pd.DataFrame(rows, columns=["date","fee_lo","fee_hi","txs","vbytes","confirmed","delay_s_p50","delay_s_p90"])
+    return summary, hist
+
+@metrics.timed()
+def run(dates: List[str]) -> List[str]:
+    written: List[str] = []
+    st = Stream()
+    prev = st.mem(next_day(dates[0], -1)) if dates else pd.DataFrame()
+    for d in dates:
+        m = st.mem(d)
+        nxt = st.mem(next_day(d))
+        # las txs que el día anterior difirió (siguen acá) traen su first_seen de allá
+        m = carry_first_seen(m.dropna(subset=["txid"]), prev)
+        prev = m
+        m = m[~deferred(m, nxt)]
+        blocks = [b for b in (st.blk(next_day(d, i)) for i in range(HORIZON_DAYS + 1)) if not b.empty]
+        blocks = pd.concat(blocks, ignore_index=True) if blocks else pd.DataFrame(columns=BLOCK_COLS)
+        metrics.count("chain_confirmations", rows_in=len(m))
+        if m.empty:
+            st.forget_before(next_day(d)); continue
+        c = confirm(m, blocks)
+        summary, hist = summarize(c, d, len(st.blk(d)))
+        written.append(gold.write_parquet_gold(summary, f"chain_confirmations/date={d}"))
+        written.append(gold.write_parquet_gold(hist, f"chain_fee_histogram/date={d}"))
+        print(f"GOLD chain {d} → {len(c)} txs, {int(summary['confirmed'].iloc[0])} confirmadas")
+        st.forget_before(next_day(d))
+    return written
+
+def run_all() -> List[str]:
+    return run(gold.list_dates("chain_mempool/"))
+
+def main():
+    args = sys.argv[1:]
+    gold.ensure_gold()
+    if "--date" in args:
+        d = args[args.index("--date")+1]
+        metrics.start("gold_chain", d)
+        run([d])
+    else:
+        metrics.start("gold_chain")
+        run_all()
+    metrics.finish()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+﻿import io
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    import scipy.sparse as sp
+    from scipy.sparse.csgraph import connected_components
+except ImportError:  # opcional: sin scipy las componentes se calculan con propagación de etiquetas en numpy
+    sp = connected_components = None
+
+import s3fetch
+import metrics
+
+# Grafo de identidades (IDENTITY_STITCHING=1 en gold): union-find incremental sobre los ids de cada
+# evento. Dos ids que aparecen en el mismo evento (cookie + uid al loguearse, uid + email, ...) quedan
+# en la misma componente; user_key = "idg:<hash>" del id de hash mínimo de la componente, así la clave
+# no depende del orden en que se vieron los links (corrida full e incremental dan la misma).
+# Todo vive en arrays, sin un objeto por id (16 bytes por id en memoria, 12 en disco):
+#   keys[i]    hash uint64 (tipo, valor) del nodo i, en orden de alta
+#   parent[i]  padre en el union-find; la raíz es el nodo de hash mínimo de la componente
+#   índice     keys ordenados -> nodo: uno principal + un delta chico con las altas recientes, que se
+#              funde cuando crece (un lote no reordena decenas de millones de keys); no se guarda,
+#              se arma con un argsort al cargar
+# Un lote: hash de los ids (sobre únicos), alta de los nuevos, unión de los pares (ancla del evento,
+# resto de sus ids) sobre las raíces tocadas y lookup por searchsorted. La compresión de caminos
+# completa (O(n)) se hace al guardar. Colisiones de hash de 64 bits: despreciables a esta escala.
+ID_COLS = {"ids_uid": "uid", "ids_email_sha256": "email", "ids_cookie": "cookie", "ids_ga": "ga"}
+PREFIX = "idg:"
+STATE_NAME = "identity.npz"
+
+def id_hashes(df: pd.DataFrame) -> np.ndarray:
+    # (eventos, ids) uint64; 0 = vacío. Hash del valor con una clave por tipo (un mismo valor como
+    # cookie y como ga son nodos distintos), calculado una vez por valor distinto
+    out = np.zeros((len(df), len(ID_COLS)), dtype="uint64")
+    for j, (c, kind) in enumerate(ID_COLS.items()):
+        if c not in df.columns:
+            continue
+        codes, uniq = pd.factorize(df[c])
+        if not len(uniq):
+            continue
+        raw = pd.Series(np.asarray(uniq, dtype=object), dtype=object).astype(str)
+        h = pd.util.hash_array(raw.to_numpy(dtype=object), hash_key=kind.ljust(16, "_"), categorize=False)
+        blank = pc.equal(pc.utf8_trim_whitespace(pa.array(raw.to_numpy(dtype=object), type=pa.string())), "")
+        h[blank.to_numpy(zero_copy_only=False)] = 0
+        out[:, j] = np.append(h, np.uint64(0))[codes]
+    return out
+
+def _components(k: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # etiqueta de cada uno de los k nodos = menor índice de su componente
+    if connected_components is not None:
+        g = sp.coo_matrix((np.ones(len(a), dtype="int8"), (a, b)), shape=(k, k))
+        _, lab = connected_components(g, directed=False)
+        low = np.full(lab.max() + 1 if k else 0, k, dtype="int64")
+        np.minimum.at(low, lab, np.arange(k))
+        return low[lab]
+    lab = np.arange(k)
+    while True:
+        nl = lab.copy()
+        np.minimum.at(nl, a, lab[b]); np.minimum.at(nl, b, lab[a])
+        nl = nl[nl]
+        if np.array_equal(nl, lab):
+            return lab
+        lab = nl
+
+class IdentityGraph:
+    def __init__(self, keys: Optional[np.ndarray] = None, parent: Optional[np.ndarray] = None):
+        keys = np.zeros(0, dtype="uint64") if keys is None else keys.astype("uint64")
+        self.n = len(keys)
+        self.keys, self.parent = keys, (np.arange(self.n) if parent is None else parent.astype("int64"))
+        order = np.argsort(keys, kind="stable")
+        self.skeys, self.sids = keys[order], order.astype("int64")
+        self.dkeys, self.dids = np.zeros(0, dtype="uint64"), np.zeros(0, dtype="int64")
+
+    def __len__(self) -> int:
+        return self.n
+
+    def lookup(self, h: np.ndarray) -> np.ndarray:
+        # nodo de cada hash; -1 si no está
+        out = np.full(len(h), -1, dtype="int64")
+        for sk, si in ((self.skeys, self.sids), (self.dkeys, self.dids)):
+            if not len(sk):
+                continue
+            pos = np.minimum(np.searchsorted(sk, h), len(sk) - 1)
+            hit = sk[pos] == h
+            out[hit] = si[pos[hit]]
+        return out
+
+    def _add(self, h: np.ndarray) -> np.ndarray:
+        # alta de los hashes que faltan; devuelve el nodo de cada h. El lookup va sobre los únicos
+        # ordenados: searchsorted contra el índice grande es mucho más rápido con consultas en orden
+        codes, u = pd.factorize(h)
+        o = np.argsort(u, kind="stable")
+        node = np.empty(len(u), dtype="int64")
+        node[o] = self.lookup(u[o])
+        new = u[o][node[o] < 0]
+        if len(new):
+            if self.n + len(new) > len(self.keys):
+                cap = max(self.n + len(new), 2 * len(self.keys), 1024)
+                self.keys = np.concatenate([self.keys[:self.n], np.zeros(cap - self.n, dtype="uint64")])
+                self.parent = np.concatenate([self.parent[:self.n], np.zeros(cap - self.n, dtype="int64")])
+            ids = np.arange(self.n, self.n + len(new))
+            self.keys[ids], self.parent[ids] = new, ids
+            self.n += len(new)
+            node[o[node[o] < 0]] = ids
+            self.dkeys, self.dids = self._merge(self.dkeys, self.dids, new, ids)
+            if len(self.dkeys) > max(1 << 16, len(self.skeys) // 8):
+                self.skeys, self.sids = self._merge(self.skeys, self.sids, self.dkeys, self.dids)
+                self.dkeys, self.dids = self.dkeys[:0], self.dids[:0]
+            metrics.count("identity", ids_new=len(new))
+        return node[codes]
+
+    @staticmethod
+    def _merge(k1: np.ndarray, i1: np.ndarray, k2: np.ndarray, i2: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # k2 ordenado y disjunto de k1
+        at = np.searchsorted(k1, k2)
+        return np.insert(k1, at, k2), np.insert(i1, at, i2)
+
+    def find(self, idx: np.ndarray) -> np.ndarray:
+        r = self.parent[idx]
+        while True:
+            p = self.parent[r]
+            if np.array_equal(p, r):
+                return r
+            r = p
+
+    def union(self, a: np.ndarray, b: np.ndarray) -> int:
+        ra, rb = self.find(a), self.find(b)
+        m = ra != rb
+        if not m.any():
+            return 0
+        # raíces tocadas ordenadas por hash: la etiqueta mínima de cada componente es la de hash mínimo
+        e = int(m.sum())
+        inv, u = pd.factorize(np.concatenate([ra[m], rb[m]]), sort=True)
+        order = np.argsort(self.keys[u], kind="stable")
+        rank = np.empty_like(order); rank[order] = np.arange(len(u))
+        u, inv = u[order], rank[inv]
+        lab = _components(len(u), inv[:e], inv[e:])
+        self.parent[u] = u[lab]
+        merged = int((lab != np.arange(len(u))).sum())
+        metrics.count("identity", merges=merged)
+        return merged
+
+    def link(self, df: pd.DataFrame) -> np.ndarray:
+        # agrega los ids y links de los eventos; devuelve el nodo de cada id (eventos, ids), -1 = vacío
+        H = id_hashes(df)
+        present = H != 0
+        rows = np.flatnonzero(present.any(axis=1))
+        idx = np.full(H.shape, -1, dtype="int64")
+        if not len(rows):
+            return idx
+        idx[present] = self._add(H[present])
+        anchor = idx[rows, present[rows].argmax(axis=1)]
+        a, b = [], []
+        for j in range(H.shape[1]):
+            m = present[rows, j] & (idx[rows, j] != anchor)
+            a.append(anchor[m]); b.append(idx[rows[m], j])
+        a, b = np.concatenate(a), np.concatenate(b)
+        if len(a):
+            pair = pd.unique(a * self.n + b)
+            self.union(pair // self.n, pair % self.n)
+        return idx
+
+    def canonical(self, idx: np.ndarray) -> np.ndarray:
+        # hash canónico (raíz) por evento a partir de los nodos de link(); 0 si el evento no trae ids
+        out = np.zeros(len(idx), dtype="uint64")
+        present = idx >= 0
+        rows = np.flatnonzero(present.any(axis=1))
+        if len(rows):
+            out[rows] = self.keys[self.find(idx[rows, present[rows].argmax(axis=1)])]
+        return out
+
+    def rekey(self, user_key: pd.Series) -> pd.Series:
+        # claves "idg:" emitidas antes de un merge -> clave canónica actual (el hash de la clave es un nodo)
+        codes, uniq = pd.factorize(user_key)
+        raw = pd.Series(np.asarray(uniq, dtype=object), dtype=object).astype(str)
+        ok = raw.str.startswith(PREFIX).to_numpy()
+        if not ok.any():
+            return user_key
+        h = np.array([int(v[len(PREFIX):], 16) for v in raw[ok]], dtype="uint64")
+        node = self.lookup(h)
+        found = node >= 0
+        new = raw.to_numpy(dtype=object).copy()
+        sel = np.flatnonzero(ok)[found]
+        new[sel] = labels(self.keys[self.find(node[found])])
+        return pd.Series(np.append(new, None)[codes], index=user_key.index, dtype=object)
+
+    def compress(self):
+        p = self.parent[:self.n]
+        while True:
+            q = p[p]
+            if np.array_equal(q, p):
+                break
+            p = q
+        self.parent[:self.n] = p
+
+def labels(h: np.ndarray) -> np.ndarray:
+    return np.array([f"{PREFIX}{v:016x}" for v in h.tolist()], dtype=object)
+
+def load(client, bucket: str, key: str) -> IdentityGraph:
+    try:
+        body = s3fetch.get_bytes(client, bucket, key)
+    except Exception:
+        return IdentityGraph()
+    z = np.load(io.BytesIO(body))
+    g = IdentityGraph(z["keys"], z["parent"])
+    metrics.count("identity", ids_loaded=len(g))
+    return g
+
+def save(g: IdentityGraph, client, bucket: str, key: str):
+    g.compress()
+    # int32 alcanza hasta 2^31 ids
+    dt = "int32" if g.n < 2 ** 31 else "int64"
+    buf = io.BytesIO()
+    np.savez(buf, keys=g.keys[:g.n], parent=g.parent[:g.n].astype(dt))
+    s3fetch.put_bytes(client, bucket, key, buf.getvalue())
+    metrics.count("identity", ids_saved=g.n, bytes_out=buf.tell())
@@ -0,0 +1,156 @@
+﻿import os, sys, json, time, threading, functools
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, List
+
+# Instrumentación liviana para bronze/silver/gold:
+#   - spans con nombre (tiempo de pared + pico de memoria del proceso al cerrar)
+#   - contadores de filas / bytes / requests / segundos acumulados (thread-safe)
+#   - reporte JSON por corrida en PIPELINE_REPORT_DIR (default ./reports)
+#   - PIPELINE_PROFILE=build_sessions,build_attribution (o "all") vuelca un .prof de cProfile
+#     por span; PIPELINE_PROFILER=pyinstrument usa el profiler por muestreo si está instalado
+REPORT_DIR = os.getenv("PIPELINE_REPORT_DIR", "./reports")
+PROFILE    = {s.strip() for s in os.getenv("PIPELINE_PROFILE", "").split(",") if s.strip()}
+PROFILER   = os.getenv("PIPELINE_PROFILER", "cprofile")
+
+_lock = threading.Lock()
+_local = threading.local()
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux en KB, macOS en bytes
+        return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+    except ImportError:
+        pass
+    try:
+        import psutil  # Windows
+        mi = psutil.Process().memory_info()
+        return round(getattr(mi, "peak_wset", mi.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+class Run:
+    def __init__(self, stage: str, date: Optional[str] = None):
+        self.stage, self.date = stage, date
+        self.started_at = datetime.now(timezone.utc)
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.counters: Dict[str, Dict[str, float]] = {}
+        self.profiles: List[str] = []
+
+    def count(self, name: str, **vals: float):
+        with _lock:
+            c = self.counters.setdefault(name, {})
+            for k, v in vals.items():
+                c[k] = c.get(k, 0) + v
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "stage": self.stage, "date": self.date,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(time.perf_counter() - self.t0, 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "spans": self.spans,
+            "counters": {k: {kk: (round(vv, 4) if isinstance(vv, float) else vv) for kk, vv in v.items()}
+                         for k, v in sorted(self.counters.items())},
+            "profiles": self.profiles,
+        }
+
+    def write(self) -> Optional[str]:
+        try:
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            name = f"{self.stage}-{self.date or 'all'}-{self.started_at.strftime('%Y%m%dT%H%M%S')}.json"
+            path = os.path.join(REPORT_DIR, name)
+            with open(path, "w", encoding="utf-8") as fh:
+                json.dump(self.report(), fh, indent=2)
+            return path
+        except OSError as e:
+            print("[metrics] no se pudo escribir el reporte:", e)
+            return None
+
+_run = Run("adhoc")
+
+def start(stage: str, date: Optional[str] = None) -> Run:
+    global _run
+    _run = Run(stage, date)
+    return _run
+
+def current() -> Run:
+    return _run
+
+def count(name: str, **vals: float):
+    _run.count(name, **vals)
+
+def _profile_dump(name: str, prof) -> Optional[str]:
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    base = os.path.join(REPORT_DIR, f"{_run.stage}-{_run.date or 'all'}-{name}")
+    if PROFILER == "pyinstrument":
+        path = base + ".html"
+        with open(path, "w", encoding="utf-8") as fh:
+            fh.write(prof.output_html())
+    else:
+        path = base + ".prof"
+        prof.dump_stats(path)
+    return path
+
+def _profiler():
+    if PROFILER == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+            return Profiler()
+        except ImportError:
+            pass
+    import cProfile
+    return cProfile.Profile()
+
+@contextmanager
+def span(name: str, **attrs: Any):
+    # los spans anidados se registran como "padre/hijo"
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    full = "/".join(stack)
+    prof = _profiler() if ("all" in PROFILE or name in PROFILE) else None
+    if prof is not None:
+        prof.start() if hasattr(prof, "start") else prof.enable()
+    t0 = time.perf_counter()
+    try:
+        yield _run
+    finally:
+        secs = time.perf_counter() - t0
+        if prof is not None:
+            prof.stop() if hasattr(prof, "stop") else prof.disable()
+            path = _profile_dump(full.replace("/", "."), prof)
+            if path: _run.profiles.append(path)
+        stack.pop()
+        rec = {"name": full, "seconds": round(secs, 4), "peak_rss_mb": peak_rss_mb()}
+        rec.update(attrs)
+        with _lock:
+            _run.spans.append(rec)
+
+def timed(name: Optional[str] = None):
+    # decorador: span con el nombre de la función; cuenta filas (DataFrame) o ítems (lista) de salida
+    def deco(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            with span(label):
+                out = fn(*a, **kw)
+            if hasattr(out, "columns"):
+                count(label, calls=1, rows_out=len(out))
+            elif isinstance(out, (list, tuple)):
+                count(label, calls=1, items_out=len(out))
+            else:
+                count(label, calls=1)
+            return out
+        return wrapper
+    return deco
+
+def finish(print_path: bool = True) -> Optional[str]:
+    path = _run.write()
+    if path and print_path:
+        print(f"[metrics] {_run.stage} {round(time.perf_counter() - _run.t0, 2)}s → {path}")
+    return path
@@ -0,0 +1,251 @@
+﻿import os, io, sys, json, time, signal, hashlib
+from datetime import datetime, timezone, timedelta
+from typing import List, Dict, Any, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+import pandas as pd
+
+import s3fetch
+import catalog
+import metrics
+import attribution_models
+import bronze_normalize as bronze
+import silver_build as silver
+import gold_attribution as gold
+
+# --- Carga .env.dev / .env ---
+for p in ["./.env.dev", "./.env"]:
+    if os.path.exists(p):
+        load_dotenv(p); break
+
+# Daemon de micro-batches: cada DAEMON_INTERVAL_S lista las keys nuevas de dp-raw (hoy y los
+# DAEMON_LATE_DAYS días anteriores, para eventos tardíos) y las lleva raw -> bronze -> silver -> gold
+# incremental sin releer la partición del día:
+#   - bronze: solo las keys nuevas, en un part agregado al manifest
+#   - silver: la misma tabla (sin volver a leer bronze) transformada y deduplicada contra las claves
+#             ya emitidas ese día (en memoria; la primera llegada gana), part agregado al manifest
+#   - gold:   sesiones/atribución de los eventos nuevos contra open_sessions + carry en memoria
+#             (estado propio en dp-gold/_state/web2_daemon, no pisa el de --incremental)
+# web2 se acumula y se confirma cada DAEMON_STATE_EVERY ciclos (commit): gold lee y reescribe una
+# vez las particiones y los cubos que toca, no una vez por batch, y guarda su estado; después van
+# el part de silver y los checkpoints. chain_* escribe silver y checkpoint en cada batch.
+# Cada fuente avanza fecha por fecha: las keys se toman por orden de llegada (LastModified) de a
+# DAEMON_MAX_KEYS y no se pasa a la fecha siguiente mientras la anterior tenga backlog; una fuente
+# que llenó el batch hace que el próximo ciclo arranque sin esperar. Eventos que igual llegan fuera
+# de orden (tardíos de un usuario ya visto) se resesionan en gold (resessionize).
+# Listado: las keys no ordenan por tiempo (event_<id>), así que no hay cursor de StartAfter; el
+# listado de un prefijo queda en memoria y se consume de a batches, y el prefijo se vuelve a listar
+# recién cuando se vació. Los días tardíos se re-listan a lo sumo cada DAEMON_LATE_LIST_EVERY ciclos.
+# Los clientes S3 y el estado quedan calientes entre ciclos. Checkpoint de keys procesadas en
+# dp-bronze/_daemon/<fuente>/date=D/<batch>.json: es lo último que se escribe, así un corte reprocesa
+# las keys sin checkpoint; los parts se nombran por contenido (catalog.py) y se pisan, no se duplican.
+# Métricas: un reporte (metrics.py) por intervalo de commit en el que se procesaron keys.
+# La corrida diaria por fecha (bronze/silver/gold) sigue siendo la que deja cada partición exacta
+# y su commit borra los parts de micro-batch (no correrla a la vez que el daemon sobre esa fecha).
+#   pipeline_daemon.py [--interval S] [--once]
+INTERVAL_S  = int(os.getenv("DAEMON_INTERVAL_S", "60"))
+MAX_KEYS    = int(os.getenv("DAEMON_MAX_KEYS", "20000"))
+LATE_DAYS   = int(os.getenv("DAEMON_LATE_DAYS", "1"))
+STATE_EVERY = int(os.getenv("DAEMON_STATE_EVERY", "10"))
+LATE_LIST_EVERY = int(os.getenv("DAEMON_LATE_LIST_EVERY", "10"))
+
+CHECKPOINT_PREFIX = "_daemon"
+GOLD_STATE_PREFIX = "_state/web2_daemon"
+SILVER_KEYS = {"web2": "event_id", "chain_mempool": "txid", "chain_blocks": "height"}
+
+def batch_name(keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()[:20]
+
+class Daemon:
+    def __init__(self):
+        attribution_models.require_full(gold.MODELS, "pipeline_daemon")
+        self.raw_done: Dict[Tuple[str, str], Set[str]] = {}     # (fuente, fecha) -> keys de raw ya procesadas
+        self.silver_keys: Dict[Tuple[str, str], Set[Any]] = {}  # (tabla, fecha) -> claves ya escritas en silver
+        self.pending: Dict[Tuple[str, str], List[str]] = {}     # (fuente, fecha) -> keys listadas sin procesar
+        self.listed_at: Dict[Tuple[str, str], int] = {}         # (fuente, fecha) -> ciclo del último listado
+        st = gold.load_state(GOLD_STATE_PREFIX)
+        self.gold_state = st or {"last_date": None, "open_sessions": pd.DataFrame(columns=gold.SESSION_COLS),
+                                 "carry": pd.DataFrame(columns=gold.CARRY_COLS)}
+        if gold.IDENTITY_STITCHING:
+            gold.identity(GOLD_STATE_PREFIX)
+        # batches de web2 sin confirmar: (fecha, keys, resumen del checkpoint, filas nuevas de silver)
+        self.web2_buf: List[Tuple[str, List[str], Dict[str, Any], pd.DataFrame]] = []
+        self.capped: Set[str] = set()  # fuentes que en el último ciclo llenaron MAX_KEYS
+        # el carry cubre el lookback de la fecha más vieja que todavía recibe eventos (LATE_DAYS)
+        self.carry_date: Optional[str] = None
+        self.cycles = 0
+        self.reported = 0  # keys procesadas desde el último reporte de métricas
+        self.stop = False
+        metrics.start("daemon", datetime.now(timezone.utc).strftime("%Y-%m-%d"))
+
+    # ---------- checkpoint / estado por fecha (se carga una vez y queda en memoria) ----------
+    def done_keys(self, source: str, date_str: str) -> Set[str]:
+        k = (source, date_str)
+        if k not in self.raw_done:
+            logs = s3fetch.list_keys(bronze.s3, bronze.BUCKET_BRONZE, f"{CHECKPOINT_PREFIX}/{source}/date={date_str}/", ".json")
+            done: Set[str] = set()
+            for _, b in s3fetch.fetch_many(bronze.s3, bronze.BUCKET_BRONZE, logs, json.loads):
+                done.update(b["keys"])
+            self.raw_done[k] = done
+        return self.raw_done[k]
+
+    def emitted(self, table: str, date_str: str) -> Set[Any]:
+        k = (table, date_str)
+        if k not in self.silver_keys:
+            col = SILVER_KEYS[table]
+            man = catalog.read_manifest(silver.s3, silver.BUCKET_SILVER, table, date_str)
+            parts = [p["key"] for p in man["parts"]] if man else []
+            read = lambda b: pd.read_parquet(io.BytesIO(b), columns=[col])[col]
+            self.silver_keys[k] = {v for _, s in s3fetch.fetch_many(silver.s3, silver.BUCKET_SILVER, parts, read)
+                                   for v in s.dropna().tolist()}
+        return self.silver_keys[k]
+
+    def forget_before(self, date_str: str):
+        for d in (self.raw_done, self.silver_keys, self.pending, self.listed_at):
+            for k in [k for k in d if k[1] < date_str]:
+                del d[k]
+
+    # ---------- un batch: keys nuevas de una fuente/fecha ----------
+    def new_keys(self, source: str, date_str: str, late: bool = False) -> List[str]:
+        # por orden de llegada (las keys de web2 son event_<id>, no ordenan por tiempo); se lista solo
+        # cuando lo listado antes ya se procesó y, en días tardíos, cada LATE_LIST_EVERY ciclos
+        k = (source, date_str)
+        done = self.done_keys(source, date_str)
+        pend = [key for key in self.pending.get(k, []) if key not in done]
+        if not pend and (not late or k not in self.listed_at
+                         or self.cycles - self.listed_at[k] >= LATE_LIST_EVERY):
+            objs = [o for o in s3fetch.list_objects(bronze.s3, bronze.BUCKET_RAW, f"{source}/date={date_str}/", ".jsonl")
+                    if o["Key"] not in done]
+            objs.sort(key=lambda o: (o["LastModified"], o["Key"]))
+            pend = [o["Key"] for o in objs]
+            self.listed_at[k] = self.cycles
+            metrics.count("daemon", listings=1)
+        self.pending[k] = pend
+        return pend[:MAX_KEYS]
+
+    def checkpoint(self, source: str, date_str: str, keys: List[str], doc: Dict[str, Any]):
+        s3fetch.put_bytes(bronze.s3, bronze.BUCKET_BRONZE,
+                          f"{CHECKPOINT_PREFIX}/{source}/date={date_str}/{batch_name(keys)}.json",
+                          json.dumps({"keys": keys, **doc, "at": datetime.now(timezone.utc).isoformat()}).encode("utf-8"),
+                          "application/json")
+
+    def process(self, source: str, date_str: str, keys: List[str]):
+        table, _, _, ts_col = bronze.SOURCES[source]
+        _, tbl = bronze.normalize_keys(source, date_str, keys)
+
+        df = silver.TRANSFORMS[table][0](tbl.to_pandas())
+        col = SILVER_KEYS[table]
+        seen = self.emitted(table, date_str)
+        df = df[~df[col].isin(seen).to_numpy(dtype=bool)]
+        seen.update(df[col].dropna().tolist())
+        doc = {"rows": tbl.num_rows, "silver_rows": len(df)}
+        if table == "web2":
+            self.web2_buf.append((date_str, keys, doc, df))
+        else:
+            if not df.empty:
+                silver.to_parquet_silver(df, f"{table}/date={date_str}", ts_col, append=True)
+            self.checkpoint(source, date_str, keys, doc)
+        self.done_keys(source, date_str).update(keys)
+        metrics.count("daemon", batches=1, keys=len(keys))
+
+    def commit(self):
+        # web2 acumulado, en orden: gold + estado, silver, checkpoints. Un corte en el medio deja keys
+        # sin checkpoint que se reprocesan: las que ya están en silver se descartan (emitted) y las que
+        # no, si gold ya las tenía, caen dentro de la sesión abierta de su usuario y van por
+        # resessionize (exacto contra silver + el batch); gold actualiza sesiones y conversiones por id
+        if not self.web2_buf:
+            return
+        buf, self.web2_buf = self.web2_buf, []
+        dfs = [(d, df) for d, _, _, df in buf if not df.empty]
+        if dfs:
+            self.apply_gold(dfs)
+        for d in sorted({d for d, _ in dfs}):
+            df = silver.categorize_web2(pd.concat([x for dd, x in dfs if dd == d], ignore_index=True))
+            silver.to_parquet_silver(df, f"web2/date={d}", "ts", append=True)
+        for d, keys, doc, _ in buf:
+            self.checkpoint("web2", d, keys, doc)
+
+    def apply_gold(self, dfs: List[Tuple[str, pd.DataFrame]]):
+        cols = [c for c in gold.GOLD_WEB2_COLS + ["properties_json"] if c in dfs[0][1].columns]
+        new = gold.prepare_web2(gold.concat_categorical([gold.gold_frame(df[cols].copy()) for _, df in dfs]))
+        if new.empty:
+            return
+        upto = max(d for d, _ in dfs)
+        st = self.gold_state
+        # upsert en todas las fechas: la partición de hoy ya tiene sesiones/conversiones de flushes anteriores
+        with metrics.span("gold"):
+            open_all, events = gold.apply_new_events(st, new, "9999-12-31", upsert_attribution=True)
+            gold.flush_rollups()
+        last = max(upto, st["last_date"] or upto)
+        carry_date = min(self.carry_date or last, last)
+        self.gold_state = {"last_date": last, "open_sessions": gold.open_sessions_of(open_all),
+                           "carry": gold.carry_of(events, carry_date)}
+        gold.save_state(last, self.gold_state["open_sessions"], self.gold_state["carry"], GOLD_STATE_PREFIX, carry_date)
+
+    # ---------- loop ----------
+    def cycle(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        dates = [(now - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(LATE_DAYS, -1, -1)]
+        self.forget_before(dates[0])
+        self.carry_date = (now - timedelta(days=LATE_DAYS + 1)).strftime("%Y-%m-%d")
+        t0 = time.perf_counter()
+        rows0 = {t: metrics.current().counters.get(t, {}).get("rows_out", 0) for t in SILVER_KEYS}
+        n = 0
+        self.capped = set()
+        for source in bronze.SOURCES:
+            for d in dates:
+                keys = self.new_keys(source, d, late=d != dates[-1])
+                if keys:
+                    self.process(source, d, keys)
+                    n += len(keys)
+                if len(keys) >= MAX_KEYS:
+                    # backlog en d: la fecha siguiente espera a que esta se vacíe
+                    self.capped.add(source)
+                    break
+        self.cycles += 1
+        self.reported += n
+        if n:
+            c = metrics.current().counters
+            print(f"[daemon] {n} keys en {round(time.perf_counter() - t0, 2)}s: "
+                  + ", ".join(f"{t} {int(c.get(t, {}).get('rows_out', 0) - rows0[t])} filas" for t in SILVER_KEYS))
+        if self.cycles % STATE_EVERY == 0:
+            self.commit()
+            self.report(dates[-1])
+        return n
+
+    def report(self, date_str: Optional[str] = None):
+        # cierra el reporte del intervalo (si hubo keys) y arranca el siguiente
+        if self.reported:
+            metrics.finish()
+            metrics.start("daemon", date_str)
+            self.reported = 0
+
+    def run(self, interval: int, once: bool = False):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: setattr(self, "stop", True))
+        try:
+            while not self.stop:
+                t0 = time.monotonic()
+                n = self.cycle()
+                if once:
+                    break
+                # si alguna fuente quedó con backlog (llenó MAX_KEYS) se sigue sin esperar
+                if not self.capped:
+                    while not self.stop and time.monotonic() - t0 < interval:
+                        time.sleep(min(1.0, interval))
+        finally:
+            self.commit()
+            self.report()
+
+def main():
+    args = sys.argv[1:]
+    interval = int(args[args.index("--interval")+1]) if "--interval" in args else INTERVAL_S
+    silver.ensure_bucket(silver.BUCKET_SILVER)
+    try: bronze.s3.head_bucket(Bucket=bronze.BUCKET_BRONZE)
+    except Exception: bronze.s3.create_bucket(Bucket=bronze.BUCKET_BRONZE)
+    d = Daemon()
+    print(f"DAEMON OK → cada {interval}s sobre {', '.join(bronze.SOURCES)}")
+    d.run(interval, once="--once" in args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+﻿import os, io, json, sys
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Iterator, Tuple, Set
+
+from dotenv import load_dotenv
+
+import s3fetch
+
+try:
+    import zstandard
+except ImportError:  # opcional: sin zstandard se escriben segmentos sin comprimir
+    zstandard = None
+
+# --- Carga .env.dev / .env ---
+for p in ["./.env.dev", "./.env"]:
+    if os.path.exists(p):
+        load_dotenv(p); break
+
+S3_ENDPOINT   = os.getenv("S3_ENDPOINT", "http://localhost:9000")
+S3_REGION     = os.getenv("S3_REGION", "us-east-1")
+AWS_ACCESS    = os.getenv("MINIO_ROOT_USER", "admin")
+AWS_SECRET    = os.getenv("MINIO_ROOT_PASSWORD", "adminadmin")
+BUCKET_RAW    = os.getenv("S3_BUCKET_RAW", "dp-raw")
+
+SEGMENT_MAX_BYTES = int(os.getenv("RAW_SEGMENT_MAX_MB", "64")) * 1024 * 1024
+# GETs de segmentos en paralelo al leerlos: hay 2*N segmentos enteros en memoria a la vez
+SEGMENT_READ_WORKERS = int(os.getenv("RAW_SEGMENT_READ_WORKERS", "2"))
+SOURCES = ["web2", "chain/mempool", "chain/blocks"]
+
+# Los segmentos viven fuera de los prefijos que escriben los ingestores:
+#   _compacted/<source>/date=YYYY-MM-DD/segment-<run>-NNNN.jsonl[.zst]
+#   _compacted/<source>/date=YYYY-MM-DD/manifest-<run>.json
+# El manifest se sube al final: si existe, sus segmentos están completos.
+COMPACT_ROOT = "_compacted"
+
+s3 = s3fetch.make_client(S3_ENDPOINT, AWS_ACCESS, AWS_SECRET, S3_REGION)
+
+def compacted_prefix(raw_prefix: str) -> str:
+    return f"{COMPACT_ROOT}/{raw_prefix.rstrip('/')}/"
+
+def encode_segment(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+def decode_segment(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("segmento zstd pero falta el paquete 'zstandard'")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+def load_manifests(client, bucket: str, raw_prefix: str) -> List[Dict[str, Any]]:
+    keys = s3fetch.list_keys(client, bucket, compacted_prefix(raw_prefix), ".json")
+    keys = [k for k in keys if k.rsplit("/", 1)[-1].startswith("manifest-")]
+    return [json.loads(b) for _, b in s3fetch.fetch_many(client, bucket, keys)]
+
+def covered_keys(manifests: List[Dict[str, Any]]) -> Set[str]:
+    return {src for m in manifests for seg in m["segments"] for src, _ in seg["sources"]}
+
+def iter_segment_lines(client, bucket: str, manifests: List[Dict[str, Any]]) -> Iterator[Tuple[str, bytes]]:
+    # (key original, línea) para cada línea de cada segmento, en el orden del manifest
+    segs = [seg for m in manifests for seg in m["segments"]]
+    by_key = {seg["key"]: seg for seg in segs}
+    for key, data in s3fetch.fetch_many(client, bucket, [seg["key"] for seg in segs], workers=SEGMENT_READ_WORKERS):
+        seg = by_key[key]
+        lines = decode_segment(data, seg.get("codec", "none")).splitlines()
+        i = 0
+        for src, n in seg["sources"]:
+            for line in lines[i:i+n]:
+                yield src, line
+            i += n
+
+def compact_prefix(raw_prefix: str, codec: str = "none", delete_sources: bool = False) -> List[str]:
+    manifests = load_manifests(s3, BUCKET_RAW, raw_prefix)
+    done = covered_keys(manifests)
+    keys = [k for k in s3fetch.list_keys(s3, BUCKET_RAW, raw_prefix, ".jsonl") if k not in done]
+    if not keys:
+        return []
+
+    out = compacted_prefix(raw_prefix)
+    run = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    ext = ".jsonl.zst" if codec == "zstd" else ".jsonl"
+    segments: List[Dict[str, Any]] = []
+    buf = io.BytesIO(); sources: List[Tuple[str, int]] = []
+
+    def flush():
+        key = f"{out}segment-{run}-{len(segments):04d}{ext}"
+        s3fetch.put_bytes(s3, BUCKET_RAW, key, encode_segment(buf.getvalue(), codec), "application/x-ndjson")
+        segments.append({"key": key, "codec": codec, "raw_bytes": buf.tell(), "sources": list(sources)})
+
+    for k, data in s3fetch.fetch_many(s3, BUCKET_RAW, keys):
+        lines = [l for l in data.splitlines() if l.strip()]
+        for l in lines:
+            buf.write(l); buf.write(b"\n")
+        sources.append((k, len(lines)))
+        if buf.tell() >= SEGMENT_MAX_BYTES:
+            flush(); buf = io.BytesIO(); sources = []
+    if sources:
+        flush()
+
+    manifest_key = f"{out}manifest-{run}.json"
+    s3fetch.put_bytes(s3, BUCKET_RAW, manifest_key,
+                      json.dumps({"raw_prefix": raw_prefix, "created_at": run, "segments": segments}).encode("utf-8"),
+                      "application/json")
+
+    if delete_sources:
+        s3fetch.delete_keys(s3, BUCKET_RAW, keys)
+    return [manifest_key] + [seg["key"] for seg in segments]
+
+def main():
+    # uso: raw_compact.py [--date YYYY-MM-DD] [--source web2] [--zstd] [--delete-sources]
+    args = sys.argv[1:]
+    date_str = args[args.index("--date")+1] if "--date" in args else datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    sources = [args[args.index("--source")+1]] if "--source" in args else SOURCES
+    codec = "zstd" if "--zstd" in args else "none"
+    if codec == "zstd" and zstandard is None:
+        print("[compact] falta 'zstandard' (pip install zstandard); se escribe sin comprimir")
+        codec = "none"
+
+    written: List[str] = []
+    for src in sources:
+        written += compact_prefix(f"{src}/date={date_str}/", codec, "--delete-sources" in args)
+
+    if written:
+        print("RAW COMPACT OK →")
+        for w in written:
+            print(" ", w)
+    else:
+        print("Nada para compactar en dp-raw para la fecha", date_str)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+﻿import os, io, time, random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Iterable, Iterator, Tuple, Callable, Any
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+import metrics
+
+# Capa común de acceso a S3/MinIO para bronze, silver y gold:
+#   - cliente boto3 con pool de conexiones dimensionado a la concurrencia
+#   - reintentos con backoff exponencial + jitter, solo en with_retry (botocore hace un intento)
+#   - GETs en paralelo (pool de threads acotado) devolviendo en orden de key o según terminan
+#   - contadores s3_get / s3_put / s3_list (requests, bytes, segundos) en el reporte de metrics
+
+def concurrency() -> int:
+    return max(1, int(os.getenv("S3_CONCURRENCY", "16")))
+
+def make_client(endpoint: str, access_key: str, secret_key: str, region: str):
+    cfg = Config(
+        max_pool_connections=max(10, concurrency() * 2),
+        # una sola capa de reintentos: with_retry (cubre también el read() del body); con los de
+        # botocore adentro un request fallido llegaba a S3_MAX_ATTEMPTS² intentos
+        retries={"total_max_attempts": 1, "mode": "standard"},
+        connect_timeout=int(os.getenv("S3_CONNECT_TIMEOUT_S", "5")),
+        read_timeout=int(os.getenv("S3_READ_TIMEOUT_S", "60")),
+        tcp_keepalive=True,
+    )
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        region_name=region,
+        config=cfg,
+    )
+
+# errores que no tiene sentido reintentar
+_FATAL = {"NoSuchKey", "NoSuchBucket", "AccessDenied", "404", "403", "InvalidRange"}
+
+def with_retry(fn: Callable[[], Any], attempts: Optional[int] = None) -> Any:
+    attempts = attempts or int(os.getenv("S3_MAX_ATTEMPTS", "5"))
+    base = float(os.getenv("S3_BACKOFF_BASE_S", "0.2"))
+    for i in range(attempts):
+        try:
+            return fn()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in _FATAL or i == attempts - 1:
+                raise
+        except (BotoCoreError, ConnectionError):
+            if i == attempts - 1:
+                raise
+        time.sleep(base * (2 ** i) * (0.5 + random.random()))
+
+def list_objects(client, bucket: str, prefix: str, suffix: Optional[str] = None) -> List[Dict[str, Any]]:
+    objs: List[Dict[str, Any]] = []
+    token = None
+    while True:
+        kw = dict(Bucket=bucket, Prefix=prefix)
+        if token: kw["ContinuationToken"] = token
+        t0 = time.perf_counter()
+        resp = with_retry(lambda: client.list_objects_v2(**kw))
+        metrics.count("s3_list", requests=1, seconds=time.perf_counter() - t0)
+        for it in resp.get("Contents", []):
+            if suffix is None or it["Key"].endswith(suffix):
+                objs.append(it)
+        if resp.get("IsTruncated"):
+            token = resp.get("NextContinuationToken")
+        else:
+            break
+    return objs
+
+def list_keys(client, bucket: str, prefix: str, suffix: Optional[str] = None) -> List[str]:
+    return [it["Key"] for it in list_objects(client, bucket, prefix, suffix)]
+
+def list_dirs(client, bucket: str, prefix: str) -> List[str]:
+    # "subdirectorios" inmediatos de prefix (CommonPrefixes), sin listar los objetos
+    out: List[str] = []
+    token = None
+    while True:
+        kw = dict(Bucket=bucket, Prefix=prefix, Delimiter="/")
+        if token: kw["ContinuationToken"] = token
+        t0 = time.perf_counter()
+        resp = with_retry(lambda: client.list_objects_v2(**kw))
+        metrics.count("s3_list", requests=1, seconds=time.perf_counter() - t0)
+        out += [cp["Prefix"] for cp in resp.get("CommonPrefixes", [])]
+        if resp.get("IsTruncated"):
+            token = resp.get("NextContinuationToken")
+        else:
+            break
+    return out
+
+def get_bytes(client, bucket: str, key: str, byte_range: Optional[str] = None) -> bytes:
+    # el read() del body va dentro del reintento: un corte a mitad de stream también se reintenta
+    def go():
+        kw = dict(Bucket=bucket, Key=key)
+        if byte_range: kw["Range"] = byte_range
+        return client.get_object(**kw)["Body"].read()
+    t0 = time.perf_counter()
+    data = with_retry(go)
+    metrics.count("s3_get", requests=1, bytes=len(data), seconds=time.perf_counter() - t0)
+    return data
+
+def put_bytes(client, bucket: str, key: str, body: bytes, content_type: str = "application/octet-stream"):
+    t0 = time.perf_counter()
+    resp = with_retry(lambda: client.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type))
+    metrics.count("s3_put", requests=1, bytes=len(body), seconds=time.perf_counter() - t0)
+    return resp
+
+def delete_keys(client, bucket: str, keys: List[str]):
+    # DeleteObjects en lotes de 1000 (máximo por request)
+    for i in range(0, len(keys), 1000):
+        chunk = keys[i:i+1000]
+        with_retry(lambda: client.delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True}))
+        metrics.count("s3_delete", requests=1, keys=len(chunk))
+
+def map_bounded(fn: Callable[[Any], Any], items: Iterable[Any], ordered: bool = True,
+                workers: Optional[int] = None) -> Iterator[Any]:
+    # Genera fn(item) con a lo sumo 2*workers tareas en vuelo, así la memoria queda
+    # acotada aunque la lista sea enorme. ordered=False entrega según terminan.
+    workers = workers or concurrency()
+    window = workers * 2
+    it = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for x in it:
+            pending.append(pool.submit(fn, x))
+            if len(pending) >= window:
+                break
+        while pending:
+            if ordered:
+                fut = pending.popleft()
+            else:
+                fut = next((f for f in pending if f.done()), None)
+                if fut is None:
+                    wait(list(pending), return_when=FIRST_COMPLETED)
+                    fut = next(f for f in pending if f.done())
+                pending.remove(fut)
+            yield fut.result()
+            for x in it:
+                pending.append(pool.submit(fn, x))
+                break
+
+def fetch_many(client, bucket: str, keys: Iterable[str], fn: Optional[Callable[[bytes], Any]] = None,
+               ordered: bool = True, workers: Optional[int] = None) -> Iterator[Tuple[str, Any]]:
+    # (key, fn(bytes)) para cada key, con GETs concurrentes
+    fn = fn or (lambda b: b)
+    return map_bounded(lambda k: (k, fn(get_bytes(client, bucket, k))), keys, ordered, workers)
+
+class RangedReader(io.RawIOBase):
+    # Archivo de solo lectura sobre un objeto S3 con GETs por rango: pyarrow lee el footer y
+    # solo los column chunks / row groups pedidos, sin bajar el objeto entero.
+    def __init__(self, client, bucket: str, key: str, size: Optional[int] = None):
+        self.client, self.bucket, self.key = client, bucket, key
+        self.size = size if size is not None else \
+            with_retry(lambda: client.head_object(Bucket=bucket, Key=key))["ContentLength"]
+        self.pos = 0
+        self.bytes_read = 0
+
+    def readable(self): return True
+    def seekable(self): return True
+    def tell(self): return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def readinto(self, b) -> int:
+        if self.pos >= self.size or len(b) == 0:
+            return 0
+        end = min(self.pos + len(b), self.size) - 1
+        data = get_bytes(self.client, self.bucket, self.key, f"bytes={self.pos}-{end}")
+        b[:len(data)] = data
+        self.pos += len(data)
+        self.bytes_read += len(data)
+        return len(data)
@@ -1,9 +1,19 @@
-﻿import os, io, json, sys
-from datetime import datetime, timezone
-from typing import List
+﻿import os, io, re, json, sys, hashlib
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
+from urllib.parse import urlparse, unquote
 from dotenv import load_dotenv
-import boto3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from botocore.exceptions import ClientError
+
+import s3fetch
+import catalog
+import metrics
+import duck_engine
+from timeutil import parse_ts_col
 
 for p in ["./.env.dev", "./.env"]:
     if os.path.exists(p):
@@ -16,112 +26,321 @@ AWS_SECRET     = os.getenv("MINIO_ROOT_PASSWORD", "adminadmin")
 BUCKET_BRONZE  = os.getenv("S3_BUCKET_BRONZE", "dp-bronze")
 BUCKET_SILVER  = os.getenv("S3_BUCKET_SILVER", "dp-silver")
 
-s3 = boto3.client("s3",
-    endpoint_url=S3_ENDPOINT,
-    aws_access_key_id=AWS_ACCESS,
-    aws_secret_access_key=AWS_SECRET,
-    region_name=S3_REGION,
-)
+s3 = s3fetch.make_client(S3_ENDPOINT, AWS_ACCESS, AWS_SECRET, S3_REGION)
+S3_CONF = {"endpoint": S3_ENDPOINT, "key": AWS_ACCESS, "secret": AWS_SECRET, "region": S3_REGION}
 
 def ensure_bucket(bucket: str):
     try: s3.head_bucket(Bucket=bucket)
     except Exception: s3.create_bucket(Bucket=bucket)
 
 def list_parquet(prefix: str) -> List[str]:
-    keys: List[str] = []; token = None
-    while True:
-        resp = s3.list_objects_v2(Bucket=BUCKET_BRONZE, Prefix=prefix, ContinuationToken=token) if token else \
-               s3.list_objects_v2(Bucket=BUCKET_BRONZE, Prefix=prefix)
-        for it in resp.get("Contents", []):
-            if it["Key"].endswith(".parquet"): keys.append(it["Key"])
-        if resp.get("IsTruncated"): token = resp.get("NextContinuationToken")
-        else: break
-    return keys
+    return s3fetch.list_keys(s3, BUCKET_BRONZE, prefix, ".parquet")
+
+def parquet_from_bytes(data: bytes) -> pd.DataFrame:
+    return pd.read_parquet(io.BytesIO(data))
 
 def read_parquet(key: str) -> pd.DataFrame:
-    obj = s3.get_object(Bucket=BUCKET_BRONZE, Key=key)
-    buf = io.BytesIO(obj["Body"].read())
-    return pd.read_parquet(buf)
+    return parquet_from_bytes(s3fetch.get_bytes(s3, BUCKET_BRONZE, key))
+
+def read_parquets(keys: List[str]) -> pd.DataFrame:
+    # descarga + decode en paralelo (pyarrow suelta el GIL al decodificar)
+    return pd.concat([df for _, df in s3fetch.fetch_many(s3, BUCKET_BRONZE, keys, parquet_from_bytes)], ignore_index=True)
+
+# row groups chicos + web2 ordenado por ts => estadísticas min/max útiles para la poda en gold
+# (ts/first_seen/fetched_at/timestamp se escriben como timestamp[us, UTC], no como string ISO)
+ROW_GROUP_ROWS = int(os.getenv("SILVER_ROW_GROUP_ROWS", "100000"))
+
+# --force reconstruye aunque el manifest de bronze no haya cambiado
+FORCE = False
+
+# versión de las transformaciones: subirla cuando un cambio de código cambia la salida de silver para
+# el mismo bronze, así la próxima corrida no saltea las fechas ya escritas (ver output_settings)
+TRANSFORM_VERSION = 1
+
+# --engine duckdb (o SILVER_ENGINE=duckdb): dedup/sort/parse en SQL con DuckDB (duck_engine.py);
+# --verify corre además el camino pandas y falla sin escribir si las salidas difieren
+ENGINE = os.getenv("SILVER_ENGINE", "pandas")
+VERIFY = False
+
+# SILVER_CATEGORICAL=1: columnas de baja cardinalidad de web2 como Categorical (dictionary en parquet,
+# categorías ordenadas); gold las lee como dictionary de todas formas
+CATEGORICAL = os.getenv("SILVER_CATEGORICAL", "0") == "1"
+WEB2_CATEGORICAL_COLS = ["type","utm_source","utm_medium","utm_campaign","utm_content","utm_term","client_lang",
+                         "device_os","device_browser","device_device","url_host","referrer_host","prop_currency"]
+
+def categorize_web2(df: pd.DataFrame) -> pd.DataFrame:
+    if CATEGORICAL:
+        for c in WEB2_CATEGORICAL_COLS:
+            if c in df.columns: df[c] = df[c].astype("category")
+    return df
+
+def bronze_inputs(table: str, date_str: str) -> Tuple[List[str], Optional[str]]:
+    # parts vivos según el manifest de bronze; si no hay manifest (datos viejos) se lista el prefijo.
+    # El fingerprint es el de bronze combinado con las opciones de la corrida (source_fingerprint)
+    man = catalog.read_manifest(s3, BUCKET_BRONZE, table, date_str)
+    if man is not None:
+        return [p["key"] for p in man["parts"]], source_fingerprint(table, man["fingerprint"])
+    return list_parquet(f"{table}/date={date_str}/"), None
+
+def unchanged(table: str, date_str: str, source_fp: Optional[str]) -> bool:
+    if FORCE or source_fp is None:
+        return False
+    man = catalog.read_manifest(s3, BUCKET_SILVER, table, date_str)
+    if man is not None and man.get("source_fingerprint") == source_fp:
+        print(f"[silver] {table} {date_str} sin cambios en bronze ni en opciones, skip")
+        return True
+    return False
 
-def to_parquet_silver(df: pd.DataFrame, silver_prefix: str) -> str:
+def to_parquet_silver(df: pd.DataFrame, silver_prefix: str, ts_col: Optional[str] = None,
+                      source_fp: Optional[str] = None, append: bool = False) -> str:
+    # reemplaza la partición (part por contenido + commit del manifest + GC, ver catalog.py) y deja en
+    # el manifest las opciones con que se escribió; append: agrega el part al manifest existente
+    # (micro-batches de pipeline_daemon.py), que conserva las opciones de la corrida diaria
     ensure_bucket(BUCKET_SILVER)
-    buf = io.BytesIO(); df.to_parquet(buf, index=False); buf.seek(0)
-    key = f"{silver_prefix}/part-{datetime.now(timezone.utc).strftime('%H%M%S%f')}.parquet"
-    s3.put_object(Bucket=BUCKET_SILVER, Key=key, Body=buf.getvalue(), ContentType="application/octet-stream")
+    buf = io.BytesIO(); df.to_parquet(buf, index=False, row_group_size=ROW_GROUP_ROWS)
+    body = buf.getvalue()
+    key = catalog.put_part(s3, BUCKET_SILVER, silver_prefix, body,
+                           () if append else catalog.live_keys(s3, BUCKET_SILVER, silver_prefix))
+    metrics.count(silver_prefix.split("/date=", 1)[0], rows_out=len(df), bytes_out=len(body), parts=1)
+    shash = catalog.schema_hash(pa.Schema.from_pandas(df, preserve_index=False))
+    extra: Dict[str, Any] = {"source_fingerprint": source_fp}
+    if not append:
+        extra["settings"] = output_settings(silver_prefix.split("/date=", 1)[0])
+    catalog.commit_partition(s3, BUCKET_SILVER, silver_prefix, [catalog.df_part_entry(key, len(body), df, ts_col)],
+                             shash, extra, append=append)
     return key
 
-from typing import Optional, Union
-def parse_ts(x: Union[str,int,float,None]) -> Optional[str]:
-    if x is None: return None
+# ---------- URLs ----------
+# url y referrer se repiten mucho entre eventos: cada valor distinto se parsea una vez (factorize
+# por partición + LRU compartido entre particiones y lotes del daemon), el costo es por URL distinta.
+#   url_host / url_path   netloc / path de urllib.parse.urlparse
+#   referrer_host         netloc del referrer
+#   utm_*                 con SILVER_UTM_FROM_URL=1, si el evento no trae ningún utm, los del query
+#                         string de url (primer valor no vacío, '+' como espacio y %XX decodificado
+#                         salvo que no forme UTF-8). Opt-in: cambia utm_* en silver y con eso los
+#                         canales de gold al reprocesar fechas viejas
+URL_CACHE_SIZE = int(os.getenv("SILVER_URL_CACHE_SIZE", "200000"))
+UTM_FROM_URL = os.getenv("SILVER_UTM_FROM_URL", "0") == "1"
+UTM_COLS = duck_engine.WEB2_UTM
+_NO_URL = ("", "") + ("",) * len(UTM_COLS)
+_URL_RE = re.compile(duck_engine.URL_RE + r"(?:\?([^#]*))?")
+_UTM_RE = {c: re.compile(rf"(?:^|&){c}=([^&]+)") for c in UTM_COLS}
+
+def _split_url_re(u: str) -> Tuple[str, str, str]:
+    # URLs que urlparse rechaza (p.ej. IPv6 sin cerrar): el regex del SQL de duck_engine
+    m = _URL_RE.match(re.sub(r"[\t\r\n]", "", u).lstrip("".join(map(chr, range(0x21)))))
+    scheme, host, path, query = ((g or "") for g in m.groups())
+    if scheme.lower() in duck_engine.USES_PARAMS:
+        path = re.match(r"^((?:.*/)?[^;/]*)", path).group(1)
+    return host, path, query
+
+@lru_cache(maxsize=URL_CACHE_SIZE)
+def split_url(u: str) -> Tuple[str, ...]:
+    # (netloc, path, utm_source .. utm_term)
     try:
-        if isinstance(x, (int,float)):
-            return datetime.fromtimestamp(float(x), tz=timezone.utc).isoformat()
-        return datetime.fromisoformat(str(x).replace("Z","+00:00")).astimezone(timezone.utc).isoformat()
-    except Exception:
-        return None
+        p = urlparse(u)
+        host, path, query = p.netloc, p.path, p.query
+    except ValueError:
+        host, path, query = _split_url_re(u)
+    return (host, path) + tuple(_query_param(query, c) if "utm_" in query else "" for c in UTM_COLS)
 
-def build_web2(date_str: str) -> List[str]:
-    prefix = f"web2/date={date_str}/"; ks = list_parquet(prefix)
-    if not ks: return []
-    df = pd.concat([read_parquet(k) for k in ks], ignore_index=True)
+def _query_param(query: str, name: str) -> str:
+    m = _UTM_RE[name].search(query)
+    if not m:
+        return ""
+    v = m.group(1).replace("+", " ")
+    try:
+        return unquote(v, errors="strict")
+    except UnicodeDecodeError:
+        return v
+
+def url_parts(col: pd.Series) -> np.ndarray:
+    # (filas, 2 + len(UTM_COLS)) object, una llamada a split_url por valor distinto
+    codes, uniq = pd.factorize(col)
+    parts = np.array([split_url(u) if isinstance(u, str) else _NO_URL for u in uniq] + [_NO_URL],
+                     dtype=object).reshape(len(uniq) + 1, len(_NO_URL))
+    return parts[codes]  # el código -1 (null) cae en la última fila, vacía
+
+def transform_web2(df: pd.DataFrame) -> pd.DataFrame:
     df["event_id"] = df["event_id"].astype("string")
-    df["ts"] = df["ts"].apply(parse_ts).astype("string")
+    df["ts"] = parse_ts_col(df["ts"])
     df["type"] = df["type"].astype("string")
-    for c in ["url","referrer","utm_source","utm_medium","utm_campaign","utm_content","utm_term",
-              "client_ua","client_lang","ids_cookie","ids_ga","device_os","device_browser","device_device"]:
+    for c in duck_engine.WEB2_FILL:
         if c in df.columns: df[c] = df[c].fillna("").astype("string")
     if "event_id" in df.columns:
         df = df.sort_values("ts").drop_duplicates(subset=["event_id"], keep="last")
-    try:
-        from urllib.parse import urlparse
-        parsed = df["url"].apply(lambda u: urlparse(u) if isinstance(u,str) else None)
-        df["url_host"] = parsed.apply(lambda p: p.netloc if p else "")
-        df["url_path"] = parsed.apply(lambda p: p.path if p else "")
-    except Exception:
-        df["url_host"] = ""; df["url_path"] = ""
-    return [to_parquet_silver(df, f"web2/date={date_str}")]
+    u = url_parts(df["url"]) if "url" in df.columns else np.full((len(df), len(_NO_URL)), "", dtype=object)
+    utm = [c for c in UTM_COLS if c in df.columns]
+    if utm and UTM_FROM_URL:
+        none = ~np.logical_or.reduce([(df[c] != "").to_numpy(dtype=bool) for c in utm])
+        fill = none & (u[:, 2:] != "").any(axis=1)
+        if fill.any():
+            for c in utm:
+                v = df[c].to_numpy(dtype=object)
+                v[fill] = u[fill, 2 + UTM_COLS.index(c)]
+                df[c] = pd.array(v, dtype="string")
+            metrics.count("web2", utm_from_url=int(fill.sum()))
+    df["url_host"] = pd.array(u[:, 0], dtype="string")
+    df["url_path"] = pd.array(u[:, 1], dtype="string")
+    df["referrer_host"] = pd.array(url_parts(df["referrer"])[:, 0] if "referrer" in df.columns else [""] * len(df),
+                                   dtype="string")
+    return df
 
-def build_chain_mempool(date_str: str) -> List[str]:
-    ks = list_parquet(f"chain_mempool/date={date_str}/")
-    if not ks: return []
-    df = pd.concat([read_parquet(k) for k in ks], ignore_index=True)
+def latest_per_key(df: pd.DataFrame, key: str, ts_col: Optional[str]) -> pd.DataFrame:
+    # una fila por key: la de ts_col más nuevo (empate: la última en la entrada; NaT pierde).
+    # argsort estable sobre int64 + duplicated (hash) en vez de ordenar por todas las columnas;
+    # la salida queda ordenada por ts_col
+    t = df[ts_col].to_numpy(dtype="datetime64[ns]").view("int64") if ts_col in df.columns \
+        else np.zeros(len(df), dtype="int64")
+    order = np.argsort(t, kind="stable")
+    last = ~df[key].iloc[order].duplicated(keep="last").to_numpy()
+    return df.iloc[order[last]]
+
+def transform_chain_mempool(df: pd.DataFrame) -> pd.DataFrame:
     for c in ["vsize","fee","value"]:
         if c in df.columns: df[c] = pd.to_numeric(df[c], errors="coerce").astype("Int64")
     df["txid"] = df["txid"].astype("string")
-    if "first_seen" in df.columns: df["first_seen"] = df["first_seen"].apply(parse_ts).astype("string")
-    if "fetched_at" in df.columns: df["fetched_at"] = df["fetched_at"].apply(parse_ts).astype("string")
+    if "first_seen" in df.columns: df["first_seen"] = parse_ts_col(df["first_seen"])
+    if "fetched_at" in df.columns: df["fetched_at"] = parse_ts_col(df["fetched_at"])
     if "fee" in df.columns and "vsize" in df.columns:
         df["fee_rate_sat_vb"] = (df["fee"].astype("float") / df["vsize"].astype("float")).replace([float("inf")], None)
-    df = df.sort_values(df.columns.tolist()).drop_duplicates(subset=["txid"], keep="last")
-    return [to_parquet_silver(df, f"chain_mempool/date={date_str}")]
+    # cada poll repite las mismas txids: se queda el snapshot más reciente de cada una, con el
+    # first_seen del primero (sin "time" en el snapshot, first_seen es su fetched_at). Cambio de
+    # contrato: antes first_seen era el del snapshot más reciente; solo difiere en txs sin "time"
+    if "first_seen" in df.columns:
+        df["first_seen"] = df.groupby("txid", dropna=False)["first_seen"].transform("min")
+    return latest_per_key(df, "txid", "fetched_at")
 
-def build_chain_blocks(date_str: str) -> List[str]:
-    ks = list_parquet(f"chain_blocks/date={date_str}/")
-    if not ks: return []
-    df = pd.concat([read_parquet(k) for k in ks], ignore_index=True)
+def transform_chain_blocks(df: pd.DataFrame) -> pd.DataFrame:
     for c in ["height","tx_count","size","weight"]:
         if c in df.columns: df[c] = pd.to_numeric(df[c], errors="coerce").astype("Int64")
-    if "timestamp" in df.columns: df["timestamp"] = df["timestamp"].apply(parse_ts).astype("string")
+    if "timestamp" in df.columns: df["timestamp"] = parse_ts_col(df["timestamp"])
     df["id"] = df["id"].astype("string")
     if "height" in df.columns:
         df = df.sort_values("timestamp").drop_duplicates(subset=["height"], keep="last")
-    return [to_parquet_silver(df, f"chain_blocks/date={date_str}")]
+    return df
 
-def main():
-    # --date opcional
-    date_arg = None
-    if len(sys.argv) > 2 and sys.argv[1] == "--date":
-        date_arg = sys.argv[2]
-    date_str = date_arg or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+# SILVER_MEMPOOL_SEEN=1: dedup también entre días (gold_chain no corre sobre esas particiones: su
+# lookahead de D+1 necesita las txids repetidas). Por fecha se guarda en dp-silver/_state/chain_mempool/
+# el set de txids vistas (hash uint64 ordenado, 8 bytes por tx) y cada día descarta las txids que
+# aparecieron en los SILVER_MEMPOOL_SEEN_DAYS días anteriores. Depende del orden de las fechas: backfill
+# fuerza un solo worker (fechas en serie, en orden) para que cada día vea los sets de los anteriores.
+MEMPOOL_SEEN      = os.getenv("SILVER_MEMPOOL_SEEN", "0") == "1"
+MEMPOOL_SEEN_DAYS = int(os.getenv("SILVER_MEMPOOL_SEEN_DAYS", "7"))
+SEEN_PREFIX = "_state/chain_mempool/seen"
+
+def txid_hashes(txid: pd.Series) -> np.ndarray:
+    return np.unique(pd.util.hash_array(txid.dropna().to_numpy(dtype=object)))
+
+def load_seen(date_str: str) -> np.ndarray:
+    day = datetime.strptime(date_str, "%Y-%m-%d")
+    keys = [f"{SEEN_PREFIX}/date={(day - timedelta(days=i)).strftime('%Y-%m-%d')}.npy"
+            for i in range(1, MEMPOOL_SEEN_DAYS + 1)]
+    sets = []
+    for k in keys:
+        try: sets.append(np.load(io.BytesIO(s3fetch.get_bytes(s3, BUCKET_SILVER, k))))
+        except ClientError: pass
+    return np.unique(np.concatenate(sets)) if sets else np.zeros(0, dtype="uint64")
+
+def save_seen(date_str: str, hashes: np.ndarray):
+    buf = io.BytesIO(); np.save(buf, hashes)
+    s3fetch.put_bytes(s3, BUCKET_SILVER, f"{SEEN_PREFIX}/date={date_str}.npy", buf.getvalue())
+
+def drop_seen(df: pd.DataFrame, date_str: str) -> pd.DataFrame:
+    # guarda las txids del día (todas, incluidas las ya vistas) y devuelve solo las nuevas
+    seen = load_seen(date_str)
+    save_seen(date_str, txid_hashes(df["txid"]))
+    if not len(seen):
+        return df
+    h = pd.util.hash_array(df["txid"].fillna("").to_numpy(dtype=object))
+    pos = np.minimum(np.searchsorted(seen, h), len(seen) - 1)
+    old = (seen[pos] == h) & df["txid"].notna().to_numpy()
+    metrics.count("chain_mempool", rows_seen_before=int(old.sum()))
+    return df[~old]
+
+# tabla -> (transformación pandas, transformación SQL, clave para --verify)
+TRANSFORMS = {
+    "web2":          (transform_web2, lambda con, files: duck_engine.silver_web2(con, files, UTM_FROM_URL), ["event_id"]),
+    "chain_mempool": (transform_chain_mempool, duck_engine.silver_chain_mempool, ["txid"]),
+    "chain_blocks":  (transform_chain_blocks, duck_engine.silver_chain_blocks, ["height"]),
+}
+
+def output_settings(table: str) -> Dict[str, Any]:
+    # opciones que cambian la salida de la tabla para el mismo bronze
+    s: Dict[str, Any] = {"version": TRANSFORM_VERSION, "engine": ENGINE}
+    if table == "web2":
+        s.update(categorical=CATEGORICAL, utm_from_url=UTM_FROM_URL)
+    elif table == "chain_mempool":
+        s.update(mempool_seen=MEMPOOL_SEEN, mempool_seen_days=MEMPOOL_SEEN_DAYS if MEMPOOL_SEEN else None)
+    return s
+
+def source_fingerprint(table: str, bronze_fp: str) -> str:
+    # lo que unchanged() compara: cambiar de bronze o de opciones (o de TRANSFORM_VERSION) reconstruye
+    sig = json.dumps([bronze_fp, output_settings(table)], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(sig.encode("utf-8")).hexdigest()[:16]
+
+def transform(table: str, keys: List[str]) -> pd.DataFrame:
+    pandas_fn, sql_fn, vkey = TRANSFORMS[table]
+    if ENGINE != "duckdb":
+        df = read_parquets(keys)
+        metrics.count(table, rows_in=len(df))
+        return pandas_fn(df)
+    with duck_engine.staged(s3, BUCKET_BRONZE, keys, S3_CONF) as (con, files):
+        metrics.count(table, rows_in=duck_engine.count_rows(con, files))
+        df = sql_fn(con, files)
+    if VERIFY:
+        with metrics.span("verify"):
+            duck_engine.verify(table, pandas_fn(read_parquets(keys)), df, vkey)
+    return df
 
+@metrics.timed()
+def build_web2(date_str: str) -> List[str]:
+    ks, fp = bronze_inputs("web2", date_str)
+    if not ks or unchanged("web2", date_str, fp): return []
+    df = categorize_web2(transform("web2", ks))
+    return [to_parquet_silver(df, f"web2/date={date_str}", "ts", fp)]
+
+@metrics.timed()
+def build_chain_mempool(date_str: str) -> List[str]:
+    ks, fp = bronze_inputs("chain_mempool", date_str)
+    if not ks or unchanged("chain_mempool", date_str, fp): return []
+    df = transform("chain_mempool", ks)
+    if MEMPOOL_SEEN:
+        df = drop_seen(df, date_str)
+    return [to_parquet_silver(df, f"chain_mempool/date={date_str}", "fetched_at", fp)]
+
+@metrics.timed()
+def build_chain_blocks(date_str: str) -> List[str]:
+    ks, fp = bronze_inputs("chain_blocks", date_str)
+    if not ks or unchanged("chain_blocks", date_str, fp): return []
+    df = transform("chain_blocks", ks)
+    return [to_parquet_silver(df, f"chain_blocks/date={date_str}", "timestamp", fp)]
+
+def run(date_str: str, strict: bool = False) -> List[str]:
+    # strict: propaga el primer error (backfill no marca la fecha como OK)
     ensure_bucket(BUCKET_SILVER)
     written: List[str] = []
-    try: written += build_web2(date_str)
-    except Exception as e: print("[silver] web2 skip:", e)
-    try: written += build_chain_mempool(date_str)
-    except Exception as e: print("[silver] mempool skip:", e)
-    try: written += build_chain_blocks(date_str)
-    except Exception as e: print("[silver] blocks skip:", e)
+    for name, fn in [("web2", build_web2), ("mempool", build_chain_mempool), ("blocks", build_chain_blocks)]:
+        try: written += fn(date_str)
+        except Exception as e:
+            if strict: raise
+            print(f"[silver] {name} skip:", e)
+    return written
+
+def main():
+    # --date opcional; --force; --engine pandas|duckdb [--verify]
+    args = sys.argv[1:]
+    date_arg = args[args.index("--date")+1] if "--date" in args else None
+    date_str = date_arg or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    global FORCE, ENGINE, VERIFY
+    FORCE = "--force" in args
+    ENGINE = args[args.index("--engine")+1] if "--engine" in args else ENGINE
+    VERIFY = "--verify" in args
+    if ENGINE == "duckdb": duck_engine.require()
+
+    metrics.start("silver", date_str)
+    written = run(date_str)
+    metrics.finish()
 
     if written:
         print("SILVER OK →"); [print(" ", k) for k in written]
@@ -0,0 +1,180 @@
+﻿import os, sys, json, hashlib
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, Iterator, Tuple, Callable, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Generador sintético reproducible (misma semilla => mismos bytes) con el formato que escriben
+# ingest-api (web2) y onchain-ingestor (chain/mempool, chain/blocks). Lo usa bench_pipeline.py;
+# por CLI sube los datos a dp-raw para pruebas locales contra MinIO.
+#   users / events_per_user : tamaño de la población (users = events / events_per_user si no se da)
+#   conv_rate               : fracción de eventos purchase (y otro tanto de leads)
+#   skew                    : actividad por usuario ~ 1/rank^skew (0 = uniforme)
+CHUNK = 100_000
+
+TYPES = ["pageview", "click", "lead", "purchase"]
+SOURCES = [("", "", ""), ("google", "cpc", "brand"), ("google", "cpc", "generic"), ("facebook", "paid_social", "retargeting"),
+           ("newsletter", "email", "weekly"), ("twitter", "social", ""), ("bing", "cpc", "brand")]
+SOURCE_P = [0.45, 0.15, 0.1, 0.1, 0.08, 0.07, 0.05]
+REFERRERS = ["", "https://www.google.com/", "https://t.co/x", "https://news.ycombinator.com/", "https://shop.example.com/"]
+UAS = ["Mozilla/5.0 (Windows NT 10.0; Win64; x64)", "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_0)",
+       "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X)", "Mozilla/5.0 (Linux; Android 14)"]
+LANGS = ["es-AR", "es-ES", "en-US", "pt-BR"]
+DEVICES = [("Windows", "Chrome", "desktop"), ("macOS", "Safari", "desktop"), ("iOS", "Safari", "mobile"), ("Android", "Chrome", "mobile")]
+
+def day_list(start: str, days: int) -> List[str]:
+    d0 = datetime.strptime(start, "%Y-%m-%d")
+    return [(d0 + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+def user_weights(users: int, skew: float, rng: np.random.Generator) -> np.ndarray:
+    w = 1.0 / np.arange(1, users + 1, dtype=np.float64) ** skew
+    rng.shuffle(w)  # que el usuario 0 no sea siempre el más activo
+    return w / w.sum()
+
+def web2_events(n: int, users: Optional[int] = None, events_per_user: float = 20.0, conv_rate: float = 0.02,
+                skew: float = 0.5, start: str = "2025-01-01", days: int = 1, id_rate: float = 0.3,
+                seed: int = 0) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # (fecha, evento) ordenado por chunk; ts uniforme en [start, start + days)
+    rng = np.random.default_rng(seed)
+    users = users or max(1, int(n / events_per_user))
+    p_user = user_weights(users, skew, rng)
+    has_uid = rng.random(users) < id_rate
+    t0 = int(datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+    span_ms = days * 86_400_000
+    p_type = [max(0.0, 0.75 - 2 * conv_rate), 0.25, conv_rate, conv_rate]
+    p_type = np.array(p_type) / sum(p_type)
+    emails: Dict[int, str] = {}
+
+    for c0 in range(0, n, CHUNK):
+        m = min(CHUNK, n - c0)
+        u = rng.choice(users, size=m, p=p_user)
+        ts = np.sort(t0 + rng.integers(0, span_ms, size=m))
+        ty = rng.choice(len(TYPES), size=m, p=p_type)
+        src = rng.choice(len(SOURCES), size=m, p=SOURCE_P)
+        ref = rng.integers(0, len(REFERRERS), size=m)
+        page = rng.integers(0, 200, size=m)
+        value = np.round(rng.lognormal(3.5, 0.8, size=m), 2)
+        for i in range(m):
+            uu = int(u[i]); k = uu % 4
+            s, med, camp = SOURCES[src[i]]
+            t = TYPES[ty[i]]
+            dt = datetime.fromtimestamp(int(ts[i]) / 1000, tz=timezone.utc)
+            if has_uid[uu] and uu not in emails:
+                emails[uu] = hashlib.sha256(f"user{uu}@example.com".encode()).hexdigest()
+            props: Dict[str, Any] = {}
+            if t == "purchase":
+                props = {"value": float(value[i]), "currency": "USD", "order_id": f"o-{seed}-{c0 + i}"}
+            elif t == "lead":
+                props = {"form": "newsletter"}
+            ev = {
+                "event_id": f"{seed:04x}-{c0 + i:012x}",
+                "ts": dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z",
+                "type": t,
+                "url": f"https://shop.example.com/p/{page[i]}" + (f"?utm_source={s}&utm_medium={med}" if s and page[i] % 5 == 0 else ""),
+                "referrer": REFERRERS[ref[i]],
+                "utm": {"source": s, "medium": med, "campaign": camp, "content": "", "term": ""},
+                "client": {"ip": "", "ua": UAS[k], "lang": LANGS[k]},
+                "ids": {"cookie": f"ck-{uu}", "ga": f"GA1.1.{uu}" if uu % 3 else "",
+                        "uid": f"u-{uu}" if has_uid[uu] else None, "email_sha256": emails.get(uu)},
+                "device": dict(zip(("os", "browser", "device"), DEVICES[k])),
+                "properties": props,
+            }
+            yield ev["ts"][:10], ev
+
+def mempool_records(n: int, per_snapshot: int = 25, dup: int = 3, start: str = "2025-01-01", days: int = 1,
+                    seed: int = 0) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # snapshots de "mempool recent": cada tx aparece en ~dup snapshots consecutivos (dedup en silver)
+    rng = np.random.default_rng(seed + 1)
+    snaps = max(1, n // per_snapshot)
+    t0 = datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    step = days * 86400 / snaps
+    stride = max(1, per_snapshot // dup)
+    for s in range(snaps):
+        when = t0 + timedelta(seconds=s * step)
+        fetched = when.strftime("%Y-%m-%dT%H:%M:%S.") + f"{when.microsecond // 1000:03d}Z"
+        for j in range(per_snapshot):
+            tx = s * stride + j
+            txid = hashlib.sha256(f"{seed}:{tx}".encode()).hexdigest()
+            vsize = int(rng.integers(110, 2000))
+            yield fetched[:10], {"source": "mempool.space", "kind": "mempool_recent", "fetched_at": fetched,
+                                 "data": {"txid": txid, "fee": int(vsize * rng.gamma(2.0, 8.0)), "vsize": vsize,
+                                          "value": int(rng.integers(1_000, 500_000_000))}}
+
+def block_records(start: str = "2025-01-01", days: int = 1, per_day: int = 144, height0: int = 880_000,
+                  seed: int = 0) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    rng = np.random.default_rng(seed + 2)
+    t0 = int(datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
+    t = t0
+    for h in range(days * per_day):
+        t = max(t + 1, t0 + int(h * 86400 / per_day + rng.normal(0, 120)))
+        fetched = datetime.fromtimestamp(t + 30, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        yield datetime.fromtimestamp(t, tz=timezone.utc).strftime("%Y-%m-%d"), {
+            "source": "mempool.space", "kind": "block", "fetched_at": fetched,
+            "data": {"id": hashlib.sha256(f"blk{seed}:{h}".encode()).hexdigest(), "height": height0 + h,
+                     "timestamp": t, "tx_count": int(rng.integers(1500, 5000)),
+                     "size": int(rng.integers(1_000_000, 2_000_000)), "weight": int(rng.integers(3_000_000, 4_000_000))}}
+
+def write_raw(put: Callable[[str, bytes], Any], records: Iterator[Tuple[str, Dict[str, Any]]],
+              key_fn: Callable[[str, int], str], per_object: int) -> Tuple[int, int]:
+    # agrupa per_object líneas por objeto ndjson (los ingestores escriben 1; a 10^7 eso son 10^7 PUTs)
+    buf: Dict[str, List[str]] = {}
+    seq: Dict[str, int] = {}
+    n_obj = n_rec = 0
+
+    def flush(date: str):
+        nonlocal n_obj
+        put(key_fn(date, seq.get(date, 0)), ("\n".join(buf.pop(date)) + "\n").encode("utf-8"))
+        seq[date] = seq.get(date, 0) + 1
+        n_obj += 1
+
+    for date, r in records:
+        buf.setdefault(date, []).append(json.dumps(r, ensure_ascii=False, separators=(",", ":")))
+        n_rec += 1
+        if len(buf[date]) >= per_object:
+            flush(date)
+    for date in list(buf):
+        flush(date)
+    return n_rec, n_obj
+
+def generate(put: Callable[[str, bytes], Any], events: int, users: Optional[int] = None, events_per_user: float = 20.0,
+             conv_rate: float = 0.02, skew: float = 0.5, start: str = "2025-01-01", days: int = 1,
+             per_object: int = 1000, mempool: Optional[int] = None, seed: int = 0) -> Dict[str, Any]:
+    # escribe web2 + mempool (events/10 por defecto) + blocks con las keys de los ingestores
+    tag = f"synth{seed}"
+    mempool = events // 10 if mempool is None else mempool
+    w = write_raw(put, web2_events(events, users, events_per_user, conv_rate, skew, start, days, seed=seed),
+                  lambda d, i: f"web2/date={d}/event_{tag}-{i:06d}.jsonl", per_object)
+    m = write_raw(put, mempool_records(mempool, start=start, days=days, seed=seed),
+                  lambda d, i: f"chain/mempool/date={d}/tx_{tag}-{i:06d}.jsonl", per_object)
+    b = write_raw(put, block_records(start, days, seed=seed),
+                  lambda d, i: f"chain/blocks/date={d}/block_{tag}_{i:06d}.jsonl", per_object)
+    return {"web2": {"records": w[0], "objects": w[1]}, "chain_mempool": {"records": m[0], "objects": m[1]},
+            "chain_blocks": {"records": b[0], "objects": b[1]}, "dates": day_list(start, days)}
+
+def main():
+    # uso: synth.py --events N [--start YYYY-MM-DD] [--days D] [--users U] [--conv-rate R] [--skew S]
+    #               [--per-object K] [--seed X]   -> sube a dp-raw (S3_ENDPOINT)
+    import s3fetch
+    for p in ["./.env.dev", "./.env"]:
+        if os.path.exists(p):
+            load_dotenv(p); break
+    args = sys.argv[1:]
+    def opt(name: str, default: str) -> str:
+        return args[args.index(name)+1] if name in args else default
+
+    s3 = s3fetch.make_client(os.getenv("S3_ENDPOINT", "http://localhost:9000"), os.getenv("MINIO_ROOT_USER", "admin"),
+                             os.getenv("MINIO_ROOT_PASSWORD", "adminadmin"), os.getenv("S3_REGION", "us-east-1"))
+    bucket = os.getenv("S3_BUCKET_RAW", "dp-raw")
+    try: s3.head_bucket(Bucket=bucket)
+    except Exception: s3.create_bucket(Bucket=bucket)
+    users = opt("--users", "")
+    out = generate(lambda k, b: s3fetch.put_bytes(s3, bucket, k, b, "application/x-ndjson"),
+                   int(float(opt("--events", "100000"))), int(users) if users else None,
+                   conv_rate=float(opt("--conv-rate", "0.02")), skew=float(opt("--skew", "0.5")),
+                   start=opt("--start", "2025-01-01"), days=int(opt("--days", "1")),
+                   per_object=int(opt("--per-object", "1000")), seed=int(opt("--seed", "0")))
+    print("SYNTH OK →", json.dumps(out))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os, sys, io, glob, contextlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import catalog
+import metrics
+import gold_attribution as gold
+import gold_chain
+from bench_pipeline import LocalS3
+
+# gold_chain: el as-of por searchsorted contra merge_asof hacia adelante (bloque estrictamente
+# posterior), el lookahead de D+1 (la tx que sigue en el mempool se cuenta al día siguiente con el
+# first_seen mínimo) y las bandas de fee rate sin valores negativos, NaN ni infinitos.
+T0 = pd.Timestamp("2025-01-01", tz="UTC")
+
+def mempool(n: int = 500, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    first = T0 + pd.to_timedelta(rng.integers(0, 86400, n), unit="s")
+    fetched = first + pd.to_timedelta(rng.integers(0, 3600, n), unit="s")
+    m = pd.DataFrame({"txid": [f"tx{i}" for i in range(n)], "fee_rate_sat_vb": rng.gamma(2, 10, n),
+                      "vsize": rng.integers(100, 1000, n), "first_seen": first, "fetched_at": fetched})
+    m.loc[m.index[::13], "fetched_at"] = pd.NaT  # cae a first_seen
+    m.loc[m.index[::29], ["fetched_at", "first_seen"]] = pd.NaT  # sin ts: sin confirmar
+    return m
+
+def blocks(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    ts = T0 + pd.to_timedelta(np.sort(rng.integers(0, 86400 + 7200, 150)), unit="s")
+    b = pd.DataFrame({"height": np.arange(880_000, 880_150), "timestamp": ts})
+    return b.sample(frac=1, random_state=seed)  # desordenados
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_confirm_matches_merge_asof(seed):
+    m, b = mempool(seed=seed), blocks(seed)
+    # snapshots justo en el timestamp de un bloque: ese bloque no cuenta, va el siguiente
+    m.loc[m.index[1:40:3], "fetched_at"] = b["timestamp"].iloc[:13].to_numpy()
+    got = gold_chain.confirm(m, b)
+
+    seen = m["fetched_at"].fillna(m["first_seen"])
+    left = m.assign(seen=seen).reset_index().dropna(subset=["seen"]).sort_values("seen")
+    right = b.sort_values("timestamp").rename(columns={"height": "block_height", "timestamp": "block_ts"})
+    want = pd.merge_asof(left, right, left_on="seen", right_on="block_ts", direction="forward",
+                         allow_exact_matches=False).set_index("index").reindex(m.index)
+    assert got["block_height"].notna().sum() > len(m) // 2 and got["block_height"].isna().any()
+    np.testing.assert_array_equal(got["block_height"].astype("float64").to_numpy(),
+                                  want["block_height"].astype("float64").to_numpy())
+    pd.testing.assert_series_equal(got["block_ts"], want["block_ts"], check_names=False, check_dtype=False)
+    assert (got["delay_s"].dropna() >= 0).all()
+
+def test_deferred_and_carry_first_seen():
+    t = lambda h: T0 + pd.Timedelta(hours=h)
+    day = pd.DataFrame({"txid": ["a", "b", "c"], "first_seen": [t(1), t(2), pd.NaT]})
+    nxt = pd.DataFrame({"txid": ["b", None, "x"], "first_seen": [t(25), t(26), t(27)]})
+    assert gold_chain.deferred(day, nxt).tolist() == [False, True, False]
+    assert gold_chain.deferred(day, nxt.iloc[:0]).tolist() == [False, False, False]
+    # D+1 hereda el first_seen más viejo de D; uno faltante se completa, uno más nuevo no pisa
+    cur = pd.DataFrame({"txid": ["b", "c", "a", "y"], "first_seen": [t(25), t(30), t(0), t(31)]})
+    prev = pd.DataFrame({"txid": ["a", "b", "c"], "first_seen": [t(1), t(2), pd.NaT]})
+    got = gold_chain.carry_first_seen(cur, prev)
+    assert got["first_seen"].tolist() == [t(2), t(30), t(0), t(31)]
+    cur.loc[1, "first_seen"] = pd.NaT
+    prev.loc[2, "first_seen"] = t(3)
+    assert gold_chain.carry_first_seen(cur, prev)["first_seen"].iloc[1] == t(3)
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    s3 = LocalS3(str(tmp_path))
+    for b in (gold.BUCKET_SILVER, gold.BUCKET_GOLD):
+        s3.create_bucket(Bucket=b)
+    monkeypatch.setattr(gold, "s3", s3)
+    return s3
+
+def put_silver(s3: LocalS3, table: str, d: str, df: pd.DataFrame, settings=None):
+    buf = io.BytesIO(); df.to_parquet(buf, index=False)
+    key = catalog.put_part(s3, gold.BUCKET_SILVER, f"{table}/date={d}", buf.getvalue())
+    catalog.commit_partition(s3, gold.BUCKET_SILVER, f"{table}/date={d}",
+                             [catalog.part_entry(key, len(buf.getvalue()), len(df))], "test",
+                             extra={"settings": settings} if settings else None)
+
+def read_gold(s3: LocalS3, prefix: str) -> pd.DataFrame:
+    return pd.concat([pd.read_parquet(f) for f in glob.glob(os.path.join(s3.root, gold.BUCKET_GOLD, prefix, "*.parquet"))])
+
+def test_run_defers_tx_seen_next_day(s3):
+    t = lambda h: T0 + pd.Timedelta(hours=h)
+    mem = lambda ids, fs, fa: pd.DataFrame({"txid": ids, "fee_rate_sat_vb": 5.0, "vsize": 200,
+                                            "first_seen": fs, "fetched_at": fa})
+    # b sigue en el mempool el 02: se cuenta ahí, con first_seen del 01
+    put_silver(s3, "chain_mempool", "2025-01-01", mem(["a", "b", "c"], [t(1), t(2), t(3)], [t(1.5), t(23), t(3.5)]))
+    put_silver(s3, "chain_mempool", "2025-01-02", mem(["b", "d"], [t(24.5), t(30)], [t(26), t(30.5)]))
+    put_silver(s3, "chain_blocks", "2025-01-01", pd.DataFrame({"height": [1, 2], "timestamp": [t(2), t(4)]}))
+    put_silver(s3, "chain_blocks", "2025-01-02", pd.DataFrame({"height": [3, 4], "timestamp": [t(27), t(31)]}))
+    with contextlib.redirect_stdout(io.StringIO()):
+        gold_chain.run(["2025-01-01", "2025-01-02"])
+
+    d1 = read_gold(s3, "chain_confirmations/date=2025-01-01").iloc[0]
+    d2 = read_gold(s3, "chain_confirmations/date=2025-01-02").iloc[0]
+    assert (d1["txs"], d1["confirmed"], d1["blocks"]) == (2, 2, 2)
+    assert (d2["txs"], d2["confirmed"], d2["blocks"]) == (2, 2, 2)
+    # demoras del 02: b = 27h - 2h (first_seen del 01), d = 31h - 30h
+    assert sorted([d2["delay_s_p10"], d2["delay_s_p99"]]) == pytest.approx(
+        [3600 + 0.1 * 24 * 3600, 3600 + 0.99 * 24 * 3600])
+
+def test_run_rejects_mempool_seen_partition(s3):
+    mem = pd.DataFrame({"txid": ["a"], "fee_rate_sat_vb": [1.0], "vsize": [100],
+                        "first_seen": [T0], "fetched_at": [T0]})
+    put_silver(s3, "chain_mempool", "2025-01-01", mem, settings={"mempool_seen": True})
+    with pytest.raises(ValueError, match="SILVER_MEMPOOL_SEEN"):
+        gold_chain.run(["2025-01-01"])
+
+def test_fee_bands_drop_invalid_rates():
+    fee = [-1.0, np.nan, np.inf, -np.inf, 0.0, 0.5, 2.0, 2.5, 1500.0]
+    n = len(fee)
+    c = pd.DataFrame({"fee_rate_sat_vb": fee, "vsize": 100, "block_height": pd.array([1] * n, dtype="Int64"),
+                      "delay_s": np.arange(n, dtype="float64") * 60})
+    metrics.start("test_gold_chain")
+    summary, hist = gold_chain.summarize(c, "2025-01-01", 1)
+    counters = metrics.current().counters["chain_fee_histogram"]
+    assert (counters["fee_rate_missing"], counters["fee_rate_invalid"]) == (1, 3)
+    # las filas inválidas cuentan en txs del día pero no en ninguna banda ni en los percentiles
+    assert summary["txs"].iloc[0] == n
+    assert summary["fee_rate_p10"].iloc[0] >= 0 and np.isfinite(summary["fee_rate_p99"].iloc[0])
+    assert hist["fee_lo"].tolist() == [0.0, 2.0, 1000.0]
+    assert hist["txs"].tolist() == [2, 2, 1] and (hist["fee_lo"] >= 0).all()
+    assert hist["fee_hi"].iloc[-1] == np.inf
@@ -0,0 +1,114 @@
+import os, sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import identity_graph
+import gold_attribution as gold
+from bench_pipeline import LocalS3
+
+# Grafo de identidades: la clave canónica de cada evento coincide con un union-find de referencia
+# (raíz = hash mínimo de la componente) sin importar el orden ni el corte en lotes de los links, y
+# rekey / rekey_state llevan las claves emitidas antes de un merge a la canónica actual.
+def events(n: int = 600, seed: int = 0) -> pd.DataFrame:
+    # pocos ids por tipo y eventos con 1-3 ids: componentes que se funden a lo largo del stream
+    rng = np.random.default_rng(seed)
+    pick = lambda p, k: np.where(rng.random(n) < p, [f"{k}{i}" for i in rng.integers(0, 60, n)], "")
+    df = pd.DataFrame({"ids_cookie": pick(.8, "ck"), "ids_uid": pick(.25, "u"),
+                       "ids_email_sha256": pick(.15, "em"), "ids_ga": pick(.1, "ga")})
+    df.loc[df.index[::50], :] = ""  # eventos sin ids
+    return df
+
+def ref_canonical(df: pd.DataFrame) -> np.ndarray:
+    H = identity_graph.id_hashes(df)
+    parent = {}
+    def find(x):
+        while parent[x] != x:
+            x = parent[x]
+        return x
+    for row in H:
+        ids = [int(h) for h in row if h]
+        for h in ids:
+            parent.setdefault(h, h)
+        for h in ids[1:]:
+            a, b = find(ids[0]), find(h)
+            parent[max(a, b)] = min(a, b)
+    return np.array([find(int(next(h for h in row if h))) if row.any() else 0 for row in H], dtype="uint64")
+
+def canonical_in_batches(df: pd.DataFrame, bounds) -> np.ndarray:
+    g = identity_graph.IdentityGraph()
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        g.link(df.iloc[lo:hi])
+    # el canónico se lee al final: las claves de lotes viejos cambian con los merges posteriores
+    return g.canonical(g.link(df))
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_canonical_matches_union_find(seed):
+    df = events(seed=seed)
+    want = ref_canonical(df)
+    assert len(np.unique(want)) < len(df) // 4  # hubo merges
+    np.testing.assert_array_equal(canonical_in_batches(df, [0, len(df)]), want)
+    np.testing.assert_array_equal(canonical_in_batches(df, [0, 7, 100, 101, 350, len(df)]), want)
+    rev = df.iloc[::-1]
+    np.testing.assert_array_equal(canonical_in_batches(rev, [0, 200, len(df)]), want[::-1])
+
+def test_components_without_scipy(monkeypatch):
+    monkeypatch.setattr(identity_graph, "connected_components", None)
+    df = events(seed=3)
+    np.testing.assert_array_equal(canonical_in_batches(df, [0, 50, 300, len(df)]), ref_canonical(df))
+
+def test_save_load_roundtrip(tmp_path):
+    s3 = LocalS3(str(tmp_path)); s3.create_bucket(Bucket="dp-gold")
+    df = events(seed=4)
+    g = identity_graph.IdentityGraph()
+    g.link(df.iloc[:300])
+    identity_graph.save(g, s3, "dp-gold", "_state/identity.npz")
+    h = identity_graph.load(s3, "dp-gold", "_state/identity.npz")
+    # el grafo cargado sigue recibiendo lotes igual que el que quedó en memoria
+    g.link(df.iloc[300:]); h.link(df.iloc[300:])
+    np.testing.assert_array_equal(h.canonical(h.link(df)), g.canonical(g.link(df)))
+    np.testing.assert_array_equal(h.canonical(h.link(df)), ref_canonical(df))
+
+def key_of(g: identity_graph.IdentityGraph, **ids) -> str:
+    return identity_graph.labels(g.canonical(g.link(pd.DataFrame([ids]))))[0]
+
+def test_rekey_after_merge():
+    g = identity_graph.IdentityGraph()
+    a, b = key_of(g, ids_cookie="c1"), key_of(g, ids_cookie="c2", ids_uid="u2")
+    assert a != b
+    merged = key_of(g, ids_cookie="c1", ids_uid="u2")  # login en el navegador de c1
+    assert merged == min(a, b, key=lambda k: int(k[len(identity_graph.PREFIX):], 16))
+    keys = pd.Series([a, b, "ua:ffff", a, None], index=[10, 11, 12, 13, 14], dtype=object)
+    got = g.rekey(keys)
+    assert got.index.tolist() == keys.index.tolist()
+    assert got.tolist() == [merged, merged, "ua:ffff", merged, None]
+
+def test_rekey_state_merges_open_sessions(monkeypatch):
+    g = identity_graph.IdentityGraph()
+    monkeypatch.setattr(gold, "IDENTITY", g)
+    a, b = key_of(g, ids_cookie="c1"), key_of(g, ids_cookie="c2", ids_uid="u2")
+    c = key_of(g, ids_cookie="c3")
+    t = lambda s: pd.Timestamp(f"2025-01-01 {s}", tz="UTC")
+    open_s = pd.DataFrame({
+        "session_id": ["sa", "sb", "sc"], "user_key": [a, b, c],
+        "start_ts": [t("10:00"), t("11:00"), t("09:00")], "end_ts": [t("10:20"), t("11:05"), t("09:30")],
+        "n_events": [3, 1, 2], "channels": ["direct/none", "google/cpc", "direct/none"],
+        "conv_count": [0, 0, 0], "conv_value_sum": [0.0, 0.0, 0.0]}, columns=gold.SESSION_COLS)
+    carry = pd.DataFrame({
+        "event_id": ["e1", "e2", "e3"], "ts": [t("10:00"), t("11:00"), t("09:00")], "type": "pageview",
+        "user_key": [a, b, c], "channel": ["direct/none", "google/cpc", "direct/none"],
+        "utm_campaign": None, "conv_value": 0.0}, columns=gold.CARRY_COLS)
+    st = {"last_date": "2025-01-01", "open_sessions": open_s, "carry": carry}
+
+    key_of(g, ids_cookie="c1", ids_uid="u2")
+    merged = g.rekey(pd.Series([a]))[0]
+    got = gold.rekey_state(st)
+    # de las dos sesiones abiertas del usuario fundido queda la última; c3 no cambia
+    o = got["open_sessions"].set_index("user_key")
+    assert sorted(o.index) == sorted([merged, c])
+    assert o.loc[merged, "session_id"] == "sb" and o.loc[c, "session_id"] == "sc"
+    assert got["carry"]["user_key"].tolist() == [merged, merged, c]
+    assert got["last_date"] == st["last_date"]
+    assert st["open_sessions"]["user_key"].tolist() == [a, b, c]  # no muta el estado de entrada
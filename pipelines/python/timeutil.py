@@ -0,0 +1,30 @@
+﻿import pandas as pd
+
+# Parseo vectorizado de timestamps mixtos (epoch en segundos / ISO-8601) a datetime64[us, UTC].
+# Lo usan silver (columnas de bronze, que pueden venir como string, int o mezcla en particiones viejas)
+# y gold (particiones de silver escritas antes de que ts fuera timestamp).
+#   - numérico o string numérico -> epoch en segundos
+#   - string ISO-8601 con Z / offset -> UTC; sin offset se toma como UTC
+#   - inválido / vacío -> NaT
+TS_DTYPE = "datetime64[us, UTC]"
+
+def parse_ts_col(s: pd.Series) -> pd.Series:
+    if pd.api.types.is_datetime64_any_dtype(s):
+        s = s.dt.tz_localize("UTC") if s.dt.tz is None else s.dt.tz_convert("UTC")
+        return s.astype(TS_DTYPE)
+    if pd.api.types.is_bool_dtype(s):
+        return pd.Series(pd.NaT, index=s.index, dtype=TS_DTYPE)
+    if pd.api.types.is_numeric_dtype(s):
+        return pd.to_datetime(s.astype("float64"), unit="s", utc=True, errors="coerce").astype(TS_DTYPE)
+
+    out = pd.Series(pd.NaT, index=s.index, dtype=TS_DTYPE)
+    s = s.astype(object).where(s.notna(), None)
+    num = pd.to_numeric(s, errors="coerce")
+    isnum = num.notna()
+    if isnum.any():
+        out[isnum] = pd.to_datetime(num[isnum].astype("float64"), unit="s", utc=True, errors="coerce")
+    rest = ~isnum & s.notna()
+    if rest.any():
+        txt = s[rest].astype(str).str.strip()
+        out[rest] = pd.to_datetime(txt, utc=True, errors="coerce", format="ISO8601")
+    return out